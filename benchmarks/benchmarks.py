@@ -0,0 +1,142 @@
+''' asv benchmarks for emotioncf.
+
+Every benchmark is run for each model class over a grid of subject counts,
+item counts and missing-data fractions.  ``time_*`` methods record wall time
+and ``peakmem_*`` methods record peak resident memory of the benchmark process.
+
+Run with ``asv run`` (or ``asv run --python=same --quick`` for a smoke test)
+from the repository root.
+'''
+
+import numpy as np
+import pandas as pd
+from emotioncf.cf import Mean, KNN, NNMF_multiplicative, NNMF_sgd, TemporalMF
+
+MODELS = {'Mean': Mean,
+          'KNN': KNN,
+          'NNMF_multiplicative': NNMF_multiplicative,
+          'NNMF_sgd': NNMF_sgd,
+          'TemporalMF': TemporalMF}
+
+# Keep iterative models short so the grid stays tractable; per-iteration cost
+# is what we are tracking.
+FIT_KWARGS = {'Mean': {},
+              'KNN': {'metric': 'pearson'},
+              'NNMF_multiplicative': {'max_iterations': 20},
+              'NNMF_sgd': {'n_iterations': 2},
+              'TemporalMF': {'n_factors': 10, 'n_iterations': 5}}
+
+N_SUBJECTS = [50, 200]
+N_ITEMS = [100, 400]
+MISSING = [0.1, 0.5, 0.9]
+
+
+def simulate_ratings(n_subjects, n_items, missing=0.0, seed=0):
+    ''' Simulate a subject by item ratings matrix with two groups of subjects.
+
+        Missing data is expressed as a training mask so that every model sees
+        the same observed cells and can still be evaluated on the held out ones.
+
+        Args:
+            n_subjects: (int) number of subjects (rows)
+            n_items: (int) number of items (columns)
+            missing: (float) fraction of ratings left out of the mask
+            seed: (int) random seed so every run sees the same data
+
+        Returns:
+            ratings: (pd.DataFrame) subject by item ratings
+            mask: (pd.DataFrame) boolean mask of observed ratings
+
+    '''
+
+    rng = np.random.RandomState(seed)
+    ratings = rng.rand(n_subjects, n_items)*50
+    half = n_subjects//2
+    ratings[:half, ::5] += np.arange(0, n_items, 5)
+    ratings[half:, ::3] += np.arange(0, n_items, 3)
+    ratings[half:] = ratings[half:, ::-1]
+    mask = rng.rand(n_subjects, n_items) >= missing
+    return pd.DataFrame(ratings), pd.DataFrame(mask)
+
+
+class _ModelBenchmark(object):
+    params = (sorted(MODELS), N_SUBJECTS, N_ITEMS, MISSING)
+    param_names = ['model', 'n_subjects', 'n_items', 'missing']
+    timeout = 600
+    # Several benchmarks mutate the model, so every sample gets a fresh setup.
+    number = 1
+    warmup_time = 0
+
+    def setup(self, model, n_subjects, n_items, missing):
+        np.random.seed(0)
+        ratings, mask = simulate_ratings(n_subjects, n_items, missing=missing)
+        self.cf = MODELS[model](ratings, mask=mask)
+        self.fit_kwargs = FIT_KWARGS[model]
+
+
+class _FittedBenchmark(_ModelBenchmark):
+    def setup(self, model, n_subjects, n_items, missing):
+        super(_FittedBenchmark, self).setup(model, n_subjects, n_items, missing)
+        self.cf.fit(**self.fit_kwargs)
+        self.cf.predict()
+
+
+class Fit(_ModelBenchmark):
+    def time_fit(self, *args):
+        self.cf.fit(**self.fit_kwargs)
+
+    def peakmem_fit(self, *args):
+        self.cf.fit(**self.fit_kwargs)
+
+
+class Predict(_ModelBenchmark):
+    def setup(self, model, n_subjects, n_items, missing):
+        super(Predict, self).setup(model, n_subjects, n_items, missing)
+        self.cf.fit(**self.fit_kwargs)
+
+    def time_predict(self, *args):
+        self.cf.predict()
+
+    def peakmem_predict(self, *args):
+        self.cf.predict()
+
+
+class SubCorr(_FittedBenchmark):
+    def time_get_sub_corr(self, *args):
+        self.cf.get_sub_corr()
+
+    def peakmem_get_sub_corr(self, *args):
+        self.cf.get_sub_corr()
+
+
+class DilateTs(_ModelBenchmark):
+    def time_dilate_ts_rating_samples(self, *args):
+        self.cf._dilate_ts_rating_samples(n_samples=5)
+
+    def peakmem_dilate_ts_rating_samples(self, *args):
+        self.cf._dilate_ts_rating_samples(n_samples=5)
+
+
+class Downsample(_FittedBenchmark):
+    def time_downsample(self, *args):
+        self.cf.downsample(sampling_freq=10, target=2, target_type='samples')
+
+    def peakmem_downsample(self, *args):
+        self.cf.downsample(sampling_freq=10, target=2, target_type='samples')
+
+
+class ToLongDf(_FittedBenchmark):
+    def time_to_long_df(self, *args):
+        self.cf.to_long_df()
+
+    def peakmem_to_long_df(self, *args):
+        self.cf.to_long_df()
+
+
+class Import(object):
+    ''' Import time of the package modules, each in a fresh interpreter.'''
+    params = ['emotioncf', 'emotioncf.predictor', 'emotioncf.cf']
+    param_names = ['module']
+
+    def timeraw_import(self, module):
+        return 'import ' + module
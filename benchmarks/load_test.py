@@ -0,0 +1,138 @@
+''' Load test of the emotioncf prediction server on localhost.
+
+Starts a PredictionServer in a background thread (or targets a running one
+with --port) and sends requests from many concurrent keep-alive connections.
+A fraction of the requests are new-subject fold-ins, the others single
+(subject, item) cells.  Reports client-side throughput and latency and the
+server's own counters from /stats.
+
+    python benchmarks/load_test.py --concurrency 64 --requests 20000
+    python benchmarks/load_test.py --model model.npz --window 0.005
+    python -m emotioncf.server model.npz --port 8000 &
+    python benchmarks/load_test.py --model model.npz --port 8000
+'''
+
+import argparse
+import asyncio
+import json
+import threading
+from timeit import default_timer as timer
+import numpy as np
+
+
+def simulated_model(n_subjects=200, n_items=100, n_factors=5, seed=0):
+    ''' Predictor of an NNMF_sgd model fit to simulated low-rank ratings.'''
+
+    import pandas as pd
+    from emotioncf.cf import NNMF_sgd
+
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    ratings = np.dot(rng.rand(n_subjects, n_factors), rng.rand(n_factors, n_items))
+    cf = NNMF_sgd(pd.DataFrame(ratings))
+    cf.split_train_test(n_train_items=n_items//2)
+    cf.fit(n_factors=n_factors, n_iterations=5, learning_rate=.01)
+    return cf.to_predictor()
+
+
+def start_server(predictor, window, max_batch):
+    ''' Run a PredictionServer on a free localhost port in a daemon thread.'''
+
+    from emotioncf.server import PredictionServer
+
+    server = PredictionServer(predictor, port=0, window=window, max_batch=max_batch)
+    started = threading.Event()
+
+    def run():
+        async def main():
+            await server.start()
+            started.set()
+            await server.serve_forever()
+        asyncio.run(main())
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return server.port
+
+
+async def request(reader, writer, method, path, payload=None):
+    body = b'' if payload is None else json.dumps(payload).encode()
+    writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                  'Content-Length: %d\r\n\r\n' % (method, path, len(body))).encode('latin-1') + body)
+    await writer.drain()
+    status = (await reader.readline()).split()[1]
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b''):
+            break
+        key, value = header.decode('latin-1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return int(status), json.loads(await reader.readexactly(length))
+
+
+async def client(port, requests, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        for method, path, payload in requests:
+            tic = timer()
+            status, _ = await request(reader, writer, method, path, payload)
+            latencies.append(timer() - tic)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(port, subjects, n_items, concurrency, n_requests, new_fraction, seed):
+    rng = np.random.RandomState(seed)
+    requests = []
+    for _ in range(n_requests):
+        if rng.rand() < new_fraction:
+            ratings = np.where(rng.rand(n_items) < .2, rng.rand(n_items), np.nan)
+            requests.append(('POST', '/predict_new',
+                             {'ratings': np.where(np.isnan(ratings), None, ratings).tolist()}))
+        else:
+            requests.append(('POST', '/predict', {'subject': subjects[rng.randint(len(subjects))],
+                                                  'item': int(rng.randint(n_items))}))
+
+    latencies, errors = [], []
+    tic = timer()
+    await asyncio.gather(*[client(port, requests[c::concurrency], latencies, errors)
+                           for c in range(concurrency)])
+    duration = timer() - tic
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    _, stats = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+
+    latencies = 1000*np.array(latencies)
+    print('requests      %d (%d errors) in %.2fs' % (n_requests, len(errors), duration))
+    print('throughput    %.0f requests/s' % (n_requests/duration))
+    print('latency (ms)  mean %.2f  p50 %.2f  p95 %.2f  p99 %.2f' % (
+        (latencies.mean(),) + tuple(np.percentile(latencies, [50, 95, 99]))))
+    print('server        %s' % json.dumps(stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the emotioncf prediction server.')
+    parser.add_argument('--model', help='.npz file written by save() (default: simulated NNMF_sgd model)')
+    parser.add_argument('--port', type=int, help='port of a running server (default: start one)')
+    parser.add_argument('--concurrency', type=int, default=64, help='number of concurrent connections')
+    parser.add_argument('--requests', type=int, default=20000, help='total number of requests')
+    parser.add_argument('--new-fraction', type=float, default=.05, help='fraction of new-subject requests')
+    parser.add_argument('--window', type=float, default=.002, help='batching window of a started server')
+    parser.add_argument('--max-batch', type=int, default=1024, help='maximum batch of a started server')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from emotioncf.predictor import Predictor
+    predictor = Predictor.load(args.model) if args.model else simulated_model()
+    port = args.port or start_server(predictor, args.window, args.max_batch)
+    asyncio.run(run(port, predictor.index.tolist(), predictor.shape[1], args.concurrency,
+                    args.requests, args.new_fraction, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,27 @@
-# Import key objects into namespace
+# Import key objects into namespace.  They are loaded on first access, so that
+# e.g. emotioncf.predictor can be used without importing pandas or scipy
+# (module __getattr__, PEP 562, requires Python 3.7).
 
-from .cf import Mean, KNN
-from .data import create_sub_by_item_matrix
\ No newline at end of file
+import importlib
+
+__all__ = ['Mean',
+           'KNN',
+           'create_sub_by_item_matrix',
+           'Ratings',
+           'Predictor']
+
+_lazy = {'Mean': 'cf',
+         'KNN': 'cf',
+         'create_sub_by_item_matrix': 'data',
+         'Ratings': 'data',
+         'Predictor': 'predictor'}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module('.' + _lazy[name], __name__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,43 +1,51 @@
 from __future__ import division
-from scipy import linalg
-import os
 import pandas as pd
 import numpy as np
-from scipy.stats import pearsonr
-from copy import deepcopy
+from timeit import default_timer as timer
+from .data import Ratings, dilate_samples, downsample_bins, downsample_n_samples, bin_mean, bin_any, readonly_frame
+from .similarity import similarity
+from .factorization import mean_impute, randomized_svd, nndsvd, estimate_rank, fold_in_multiplicative
+from .distributed import multiplicative_updates
+from .profiling import Timings, _Phase, NULL_PHASE
 
 __all__ = ['Mean',
 			'KNN',
 			'NNMF_multiplicative',
-			'NNMF_sgd']
+			'NNMF_sgd',
+			'TemporalMF']
 __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
-# Notes might consider making a ratings data class that can accomodate timeseries and tensors
-
 class BaseCF(object):
 
-	''' Base Collaborative Filtering Class '''
+	''' Base Collaborative Filtering Class
+
+		Ratings are held internally in a compact array container (see
+		emotioncf.data.Ratings) with boolean masks.  The `ratings`, `train_mask`,
+		`masked_ratings`, `dilated_mask` and `predicted_ratings` fields convert
+		to and from pandas dataframes on access.  The returned dataframes are
+		read-only views of the arrays: modify a copy and assign it back to the
+		field (e.g., cf.train_mask = mask) so that derived state is updated.
+
+	'''
 
 	def __init__(self, ratings, mask=None, n_train_items=None):
-		if not isinstance(ratings, pd.DataFrame):
-			raise ValueError('ratings must be a pandas dataframe instance')
-		self.ratings = ratings
-		self.predicted_ratings = None
+		self._data = self._from_ratings(ratings)
+		self._train_mask = None
+		self._masked = None
+		self._dilated_mask = None
+		self._predicted = None
 		self.is_fit = False
 		self.is_predict = False
+		self.is_mask = False
 		self.is_mask_dilated = False
-		self.dilated_mask = None
+		self.timings_ = None
+		self._callbacks = []
+		self._eval_cache = {}
 		if mask is not None:
 			self.train_mask = mask
-			self.masked_ratings = self.ratings[self.train_mask]
-			self.is_mask = True
-		elif self.ratings.isnull().any().any():
-			self.train_mask = ~self.ratings.isnull()
-			self.masked_ratings = self.ratings[self.train_mask]
-			self.is_mask = True
-		else:
-			self.is_mask = False
+		elif not self._data.mask.all():
+			self._set_train_mask(self._data.mask.copy())
 
 		if n_train_items is not None:
 			self.split_train_test(n_train_items=n_train_items)
@@ -45,12 +53,128 @@ class BaseCF(object):
 	def __repr__(self):
 		return '%s(rating=%s)' % (
 			self.__class__.__name__,
-			self.ratings.shape
+			self._data.shape
 			)
 
+	@property
+	def ratings(self):
+		return self._data.to_dataframe()
+
+	@ratings.setter
+	def ratings(self, ratings):
+		self._data = self._from_ratings(ratings)
+
+	@property
+	def train_mask(self):
+		if self._train_mask is None:
+			return None
+		return self._data.to_dataframe(self._train_mask)
+
+	@train_mask.setter
+	def train_mask(self, mask):
+		self._set_train_mask(self._to_array(mask, dtype=bool))
+
+	@property
+	def masked_ratings(self):
+		if self._masked is None:
+			return None
+		return self._data.to_dataframe(self._masked)
+
+	@masked_ratings.setter
+	def masked_ratings(self, masked_ratings):
+		self._masked = self._to_array(masked_ratings)
+
+	@property
+	def dilated_mask(self):
+		if self._dilated_mask is None:
+			return None
+		return self._data.to_dataframe(self._dilated_mask)
+
+	@dilated_mask.setter
+	def dilated_mask(self, mask):
+		self._dilated_mask = self._to_array(mask, dtype=bool)
+
+	@property
+	def predicted_ratings(self):
+		if self._predicted is None:
+			return None
+		return self._data.to_dataframe(self._predicted)
+
+	@predicted_ratings.setter
+	def predicted_ratings(self, predicted_ratings):
+		self._predicted = self._to_array(predicted_ratings)
+
+	def _from_ratings(self, ratings):
+		''' Ratings container of a subject by item dataframe (or a copy of a Ratings instance).
+			Read-only Ratings (e.g., memory-mapped) are shared, not copied, as fit() and
+			predict() only read them.'''
+
+		if isinstance(ratings, Ratings):
+			return ratings.copy() if ratings.values.flags.writeable else ratings
+		if not isinstance(ratings, pd.DataFrame):
+			raise ValueError('ratings must be a pandas dataframe instance')
+		return Ratings.from_dataframe(ratings)
+
+	def _to_array(self, df, dtype=float):
+		''' Convert a dataframe aligned to the ratings (or an array) to a contiguous array.'''
+
+		if df is None:
+			return None
+		if isinstance(df, pd.DataFrame):
+			if not (np.array_equal(df.index.values, self._data.index) and
+					np.array_equal(df.columns.values, self._data.columns)):
+				df = df.reindex(index=self._data.index, columns=self._data.columns)
+				if dtype is bool:
+					df = df.fillna(False)
+			df = df.to_numpy(dtype=dtype)
+		arr = np.array(df, dtype=dtype, order='C') # copy, the model writes to its arrays
+		if arr.shape != self._data.shape:
+			raise ValueError('Array must have the same shape as ratings %s' % (self._data.shape,))
+		return arr
+
+	def _set_train_mask(self, mask):
+		self._train_mask = mask
+		self._masked = np.where(mask, self._data.values, np.nan)
+		self.is_mask = True
+
+	def instrument(self, callbacks=None):
+		''' Enable instrumentation of fit() and predict().  Afterwards `timings_`
+			holds per-phase wall time, per-iteration duration, bytes of the main
+			arrays and the loss trace of the most recent fit.
+
+			Args:
+				callbacks: (list) additional Callback instances to notify (e.g., a metrics exporter)
+
+		'''
+
+		self.timings_ = Timings()
+		self._callbacks = [self.timings_]
+		if callbacks is not None:
+			self._callbacks.extend(callbacks)
+
+	def _phase(self, name):
+		''' Context manager timing a named phase.  No-op unless instrumented.'''
+
+		if self._callbacks:
+			return _Phase(self, name)
+		return NULL_PHASE
+
+	def _fit_begin(self):
+		for callback in self._callbacks:
+			callback.on_fit_begin(self)
+
+	def _record_iteration(self, iteration, duration, loss=None):
+		for callback in self._callbacks:
+			callback.on_iteration(self, iteration, duration, loss)
+
+	def _record_arrays(self, **arrays):
+		for name, arr in arrays.items():
+			for callback in self._callbacks:
+				callback.on_array(self, name, arr.nbytes)
+
 	def get_mse(self, data='all'):
 		''' Get overall mean squared error for predicted compared to actual for all items and subjects.
-			
+
 			Args:
 				data: (str) Get mse on 'all' data, the 'training' data, or the 'test' data
 
@@ -69,8 +193,8 @@ class BaseCF(object):
 		return np.mean((pred-actual)**2)
 
 	def get_corr(self, data='all'):
-		'''Get overall correlation for predicted compared to actual for all items and subjects. 
-			
+		'''Get overall correlation for predicted compared to actual for all items and subjects.
+
 			Args:
 				data: (str) Get correlation on 'all' data, the 'training' data, or the 'test' data
 
@@ -84,6 +208,8 @@ class BaseCF(object):
 		if not self.is_predict:
 			raise ValueError('You must predict() model first before using this method.')
 
+		from scipy.stats import pearsonr
+
 		actual, pred = self._retrieve_predictions(data)
 
 		return pearsonr(actual, pred)[0]
@@ -104,34 +230,12 @@ class BaseCF(object):
 		if not self.is_predict:
 			raise ValueError('You must predict() model first before using this method.')
 
-		r = []
-		# Note: the following mask prevents NaN values from being passed to `pearsonr()`.
-		# However, it does not guaratee that no correlation values will be NaN, e.g. if only one
-		# rating for a given subject is non-null in both test and train groups for a given
-		# dataset, or variance is otherwise zero.
-		if data is 'all':
-			noNanMask = (~np.isnan(self.ratings)) & (~np.isnan(self.predicted_ratings))
-			for i in self.ratings.index:
-				r.append(pearsonr(self.ratings.loc[i,:][noNanMask.loc[i, :]], self.predicted_ratings.loc[i,:][noNanMask.loc[i, :]])[0])
-		elif self.is_mask:
-			if data is 'training':
-				noNanMask = (~np.isnan(self.masked_ratings)) & (~np.isnan(self.predicted_ratings))
-				if self.is_mask_dilated:
-					for i in self.masked_ratings.index:
-						r.append(pearsonr(self.masked_ratings.loc[i, self.dilated_mask.loc[i, :]][noNanMask.loc[i, :]], 
-						self.predicted_ratings.loc[i, self.dilated_mask.loc[i, :]][noNanMask.loc[i, :]])[0])
-				else:
-					for i in self.masked_ratings.index:
-						r.append(pearsonr(self.masked_ratings.loc[i, self.train_mask.loc[i, :]][noNanMask.loc[i, :]], 
-						self.predicted_ratings.loc[i, self.train_mask.loc[i, :]][noNanMask.loc[i, :]])[0])
-			else: #test
-				noNanMask = (~np.isnan(self.ratings)) & (~np.isnan(self.predicted_ratings))
-				for i in self.masked_ratings.index:
-					r.append(pearsonr(self.ratings.loc[i, ~self.train_mask.loc[i, :]][noNanMask.loc[i, :]], 
-					self.predicted_ratings.loc[i, ~self.train_mask.loc[i, :]][noNanMask.loc[i, :]])[0])
-		else:
-			raise ValueError('Must run split_train_test() before using this option.')
-		return np.array(r)
+		# Note: NaN values are excluded from each subject's correlation. However, this does not
+		# guarantee that no correlation values will be NaN, e.g. if only one rating for a given
+		# subject is non-null in both test and train groups for a given dataset, or variance is
+		# otherwise zero.
+		actual, select = self._retrieve_sub_cells(data)
+		return _row_corr(actual, self._predicted, select)
 
 	def get_sub_mse(self, data='all'):
 		'''Calculate observed/predicted mse for each subject in matrix
@@ -149,32 +253,96 @@ class BaseCF(object):
 		if not self.is_predict:
 			raise ValueError('You must predict() model first before using this method.')
 
-		mse = []
-		if data is 'all':
-			for i in self.ratings.index:
-				actual = self.ratings.loc[i,:]
-				pred = self.predicted_ratings.loc[i,:]
-				mse.append(np.mean((pred[(~np.isnan(actual)) & (~np.isnan(pred))] - actual[(~np.isnan(actual)) & (~np.isnan(pred))])**2))
-		elif self.is_mask:
-			if data is 'training':
-				if self.is_mask_dilated:
-					for i in self.masked_ratings.index:
-						actual = self.masked_ratings.loc[i, self.dilated_mask.loc[i, :]]
-						pred = self.predicted_ratings.loc[i, self.dilated_mask.loc[i, :]]
-						mse.append(np.mean((pred[(~np.isnan(actual)) & (~np.isnan(pred))] - actual[(~np.isnan(actual)) & (~np.isnan(pred))])**2))
-				else:
-					for i in self.ratings.index:
-						actual = self.masked_ratings.loc[i, self.train_mask.loc[i, :]]
-						pred = self.predicted_ratings.loc[i, self.train_mask.loc[i, :]]
-						mse.append(np.mean((pred[(~np.isnan(actual)) & (~np.isnan(pred))] - actual[(~np.isnan(actual)) & (~np.isnan(pred))])**2))
-			else:
-				for i in self.ratings.index:
-					actual = self.ratings.loc[i, ~self.train_mask.loc[i, :]]
-					pred = self.predicted_ratings.loc[i, ~self.train_mask.loc[i,:]]
-					mse.append(np.mean((pred[(~np.isnan(actual)) & (~np.isnan(pred))] - actual[(~np.isnan(actual)) & (~np.isnan(pred))])**2))
-		else:
-			raise ValueError('Must run split_train_test() before using this option.')
-		return np.array(mse)
+		actual, select = self._retrieve_sub_cells(data)
+		return _row_mse(actual, self._predicted, select)
+
+	def bootstrap(self, metric=('mse', 'corr'), data='all', unit='cells', n_boot=1000, ci=95,
+				seed=None, return_samples=False, max_elements=2**22):
+		''' Bootstrap confidence intervals of model metrics.
+
+			All n_boot resamples are drawn as an index matrix and every metric is
+			computed from sufficient statistics (sums of actual, predicted, their
+			squares and products) with one matrix product per chunk of resamples.
+
+			Args:
+				metric: (str or list) metrics {'mse','corr','sub_corr'}.  'mse' and 'corr' use the
+						cells of get_mse() and get_corr(), 'sub_corr' is the mean of get_sub_corr()
+				data: (str) Get metrics on 'all' data, the 'training' data, or the 'test' data
+				unit: (str) resample 'cells' or 'subjects' (with all of their cells).  'sub_corr'
+					  requires 'subjects'
+				n_boot: (int) number of bootstrap resamples (default=1000)
+				ci: (float) width of the percentile interval in percent (default=95)
+				seed: (int) seed of the resampling
+				return_samples: (bool) also return the metric of every resample
+				max_elements: (int) maximum size of the index matrix of one chunk of resamples
+
+			Returns:
+				stats: (pd.DataFrame) estimate, lower and upper bound, and bootstrap standard error of each metric
+				samples: (pd.DataFrame) n_boot by metric values, if return_samples
+
+		'''
+
+		if not self.is_fit:
+			raise ValueError('You must fit() model first before using this method.')
+		if not self.is_predict:
+			raise ValueError('You must predict() model first before using this method.')
+		metric = [metric] if isinstance(metric, str) else list(metric)
+		for m in metric:
+			if m not in ['mse', 'corr', 'sub_corr']:
+				raise ValueError("metric must be ['mse','corr','sub_corr']")
+		if unit not in ['cells', 'subjects']:
+			raise ValueError("unit must be ['cells','subjects']")
+		if unit == 'cells' and 'sub_corr' in metric:
+			raise ValueError("sub_corr can only be bootstrapped with unit='subjects'")
+
+		# one row of sufficient statistics per resampling unit
+		stats = self._cached(('bootstrap', unit, data), self._bootstrap_stats, (unit, data))
+		if 'sub_corr' in metric:
+			sub_corr = self.get_sub_corr(data=data)
+			observed = np.isfinite(sub_corr)
+			stats = np.column_stack([stats, np.where(observed, sub_corr, 0), observed])
+
+		rng = np.random if seed is None else np.random.RandomState(seed)
+		n_units = stats.shape[0]
+		chunk = max(1, max_elements//n_units)
+		totals = np.empty((n_boot, stats.shape[1]))
+		for start in range(0, n_boot, chunk):
+			n = min(chunk, n_boot - start)
+			index = rng.randint(n_units, size=(n, n_units))
+			# how often each unit is drawn in each resample
+			counts = np.bincount((index + n_units*np.arange(n)[:, np.newaxis]).ravel(),
+								minlength=n*n_units).reshape(n, n_units)
+			totals[start:start + n] = np.dot(counts, stats)
+
+		samples = pd.DataFrame(_bootstrap_metrics(totals, metric), columns=metric)
+		estimate = _bootstrap_metrics(stats.sum(axis=0)[np.newaxis], metric)[0]
+		lower, upper = np.nanpercentile(samples.values, [(100 - ci)/2, 100 - (100 - ci)/2], axis=0)
+		out = pd.DataFrame({'estimate': estimate, 'lower': lower, 'upper': upper,
+							'std': np.nanstd(samples.values, axis=0, ddof=1)},
+							index=metric, columns=['estimate', 'lower', 'upper', 'std'])
+		if return_samples:
+			return out, samples
+		return out
+
+	def _bootstrap_stats(self, unit_data):
+		''' Sums of [1, squared error, actual, predicted, actual**2, predicted**2, actual*predicted]
+			of each cell (unit='cells') or of the cells of each subject (unit='subjects').
+			Cells with a NaN actual or predicted value are left out.'''
+
+		unit, data = unit_data
+		actual, predicted = self._retrieve_predictions(data)
+		rows = np.nonzero(self._prediction_cells(data)[1])[0]
+		valid = ~np.isnan(actual) & ~np.isnan(predicted)
+		actual, predicted, rows = actual[valid], predicted[valid], rows[valid]
+		# center for numerical stability, correlation and mse are unaffected
+		center = actual.mean() if len(actual) else 0
+		actual, predicted = actual - center, predicted - center
+		stats = np.column_stack([np.ones(len(actual)), (predicted - actual)**2, actual, predicted,
+								actual**2, predicted**2, actual*predicted])
+		if unit == 'subjects':
+			n_subjects = self._data.shape[0]
+			stats = np.column_stack([np.bincount(rows, weights=s, minlength=n_subjects) for s in stats.T])
+		return stats
 
 	def split_train_test(self, n_train_items=20):
 		''' Split ratings matrix into train and test items.  mask indicating training items
@@ -185,15 +353,15 @@ class BaseCF(object):
 		'''
 
 		self.n_train_items = int(n_train_items)
-		self.train_mask = self.ratings.copy()
-		self.train_mask.loc[:,:] = np.zeros(self. ratings.shape).astype(bool)
+		n_subjects, n_items = self._data.shape
+		if self.n_train_items > n_items:
+			raise ValueError('n_train_items must not be larger than the number of items.')
 
-		for sub in self.ratings.index:
-			sub_train_rating_item =  np.random.choice(self.ratings.columns,replace=False, size=n_train_items)
-			self.train_mask.loc[sub, sub_train_rating_item] = True
-
-		self.masked_ratings = self.ratings[self.train_mask]
-		self.is_mask = True
+		# A random permutation of items for each subject
+		train_items = np.argsort(np.random.rand(n_subjects, n_items), axis=1)[:, :self.n_train_items]
+		mask = np.zeros((n_subjects, n_items), dtype=bool)
+		mask[np.arange(n_subjects)[:, np.newaxis], train_items] = True
+		self._set_train_mask(mask)
 
 	def plot_predictions(self, data='training', heatmapkwargs = {}):
 		''' Create plot of actual and predicted ratings
@@ -206,25 +374,28 @@ class BaseCF(object):
 
 		'''
 
-		import matplotlib.pyplot as plt
-		import seaborn as sns
+		try:
+			import matplotlib.pyplot as plt
+			import seaborn as sns
+		except ImportError:
+			raise ImportError('plot_predictions() requires matplotlib and seaborn, install emotioncf[plots].')
 
 		if not self.is_fit:
 			raise ValueError('You must fit() model first before using this method.')
-		
+
 		if not self.is_predict:
 			raise ValueError('You must predict() model first before using this method.')
 
 		if self.is_mask:
-			ratings = self.masked_ratings.copy()
+			ratings = self.masked_ratings
 		else:
-			ratings = self.ratings.copy()
+			ratings = self.ratings
 
 		heatmapkwargs.setdefault("square", False)
 		heatmapkwargs.setdefault("xticklabels", False)
 		heatmapkwargs.setdefault("yticklabels", False)
-		vmax = ratings.max().max() if ratings.max().max() > self.predicted_ratings.max().max() else self.predicted_ratings.max().max()
-		vmin = ratings.min().min() if ratings.min().min() < self.predicted_ratings.min().min() else self.predicted_ratings.min().min()
+		vmax = max(np.nanmax(ratings.values), np.nanmax(self._predicted))
+		vmin = min(np.nanmin(ratings.values), np.nanmin(self._predicted))
 
 		heatmapkwargs.setdefault("vmax", vmax)
 		heatmapkwargs.setdefault("vmin", vmin)
@@ -241,12 +412,12 @@ class BaseCF(object):
 		f.tight_layout()
 
 		actual, pred = self._retrieve_predictions(data)
-		
+
 		ax[2].scatter(actual[(~np.isnan(actual)) & (~np.isnan(pred))],pred[(~np.isnan(actual)) & (~np.isnan(pred))])
 		ax[2].set_xlabel('Actual Ratings')
 		ax[2].set_ylabel('Predicted Ratings')
 		ax[2].set_title('Predicted Ratings')
-		
+
 		r = self.get_corr(data=data)
 		print('Correlation: %s' % r)
 
@@ -270,138 +441,176 @@ class BaseCF(object):
 		if target_type is None:
 			raise ValueError('Please specify the type of target to downsample to [samples,seconds,hz].')
 
-
-		def ds(ratings, sampling_freq=sampling_freq, target=None, target_type='samples'):
-			if target_type is 'samples':
-				n_samples = target
-			elif target_type is 'seconds':
-				n_samples = target*sampling_freq
-			elif target_type is 'hz':
-				n_samples = sampling_freq/target
-			else:
-				raise ValueError('Make sure target_type is "samples", "seconds", or "hz".')
-
-			ratings = ratings.T
-			idx = np.sort(np.repeat(np.arange(1,ratings.shape[0]/n_samples,1),n_samples))
-			if ratings.shape[0] > len(idx):
-				idx = np.concatenate([idx, np.repeat(idx[-1]+1,ratings.shape[0]-len(idx))])
-			return ratings.groupby(idx).mean().T
-
-		self.ratings = ds(self.ratings, sampling_freq=sampling_freq, target=target,
-			target_type=target_type)
+		n_samples = downsample_n_samples(sampling_freq, target, target_type)
+		bins = downsample_bins(self._data.shape[1], n_samples)
+		values, columns = bin_mean(self._data.values, bins)
+		self._data = self._data.with_values(values, columns=columns)
 
 		if self.is_mask:
-			self.train_mask = ds(self.train_mask, sampling_freq=sampling_freq,
-				target=target, target_type=target_type)
-			self.train_mask.loc[:,:] = self.train_mask>0
-			self.masked_ratings = ds(self.masked_ratings, sampling_freq=sampling_freq,
-				target=target, target_type=target_type)
+			self._train_mask = bin_any(self._train_mask, bins)
+			self._masked = bin_mean(self._masked, bins)[0]
 			if self.is_mask_dilated:
-				self.dilated_mask = ds(self.dilated_mask, sampling_freq=sampling_freq,
-					target=target, target_type=target_type)
-				self.dilated_mask.loc[:,:] = self.dilated_mask>0
+				self._dilated_mask = bin_any(self._dilated_mask, bins)
 
 		if self.is_predict:
-			self.predicted_ratings = ds(self.predicted_ratings,
-				sampling_freq=sampling_freq, target=target, target_type=target_type)
+			self._predicted = bin_mean(self._predicted, bins)[0]
 
 	def to_long_df(self):
 
 		''' Create a long format pandas dataframe with observed, predicted, and mask.'''
 
-		observed = pd.DataFrame(columns=['Subject','Item','Rating','Condition'])
-		for row in self.ratings.iterrows():
-			tmp = pd.DataFrame(columns=observed.columns)
-			tmp['Rating'] = row[1]
-			tmp['Item'] = self.ratings.columns
-			tmp['Subject'] = row[0]
-			tmp['Condition'] = 'Observed'
-			if self.is_mask:
-				if self.is_mask_dilated:
-					tmp['Mask'] = self.dilated_mask.loc[row[0]]
-				else:
-					tmp['Mask'] = self.train_mask.loc[row[0]]
-			observed = observed.append(tmp)
+		def long_df(values, condition, mask=None):
+			n_subjects, n_items = values.shape
+			df = pd.DataFrame({'Subject': np.repeat(self._data.index, n_items),
+								'Item': np.tile(self._data.columns, n_subjects),
+								'Rating': values.ravel(),
+								'Condition': condition},
+								columns=['Subject','Item','Rating','Condition'],
+								index=np.tile(self._data.columns, n_subjects))
+			if mask is not None:
+				df['Mask'] = mask.ravel()
+			return df
+
+		if self.is_mask:
+			mask = self._dilated_mask if self.is_mask_dilated else self._train_mask
+		else:
+			mask = None
+		observed = long_df(self._data.values, 'Observed', mask)
 
 		if self.is_predict:
-			predicted = pd.DataFrame(columns=['Subject','Item','Rating','Condition'])
-			for row in self.predicted_ratings.iterrows():
-				tmp = pd.DataFrame(columns=predicted.columns)
-				tmp['Rating'] = row[1]
-				tmp['Item'] = self.predicted_ratings.columns
-				tmp['Subject'] = row[0]
-				tmp['Condition'] = 'Predicted'
-				if self.is_mask:
-					tmp['Mask'] = self.train_mask.loc[row[0]]
-				predicted = predicted.append(tmp)
-			observed = observed.append(predicted)
+			predicted = long_df(self._predicted, 'Predicted', self._train_mask)
+			observed = pd.concat([observed, predicted])
 		return observed
 
+	def to_predictor(self):
+
+		''' Export the fitted model as a predict-only emotioncf.predictor.Predictor,
+			which only needs NumPy to load and predict.
+
+			Returns:
+				predictor: Predictor instance
+
+		'''
+
+		from .predictor import Predictor
+
+		if not self.is_fit:
+			raise ValueError('You must fit() model first before using this method.')
+		kind, arrays = self._export()
+		return Predictor(kind, np.asarray(self._data.index), np.asarray(self._data.columns), **arrays)
+
+	def save(self, path):
+
+		''' Save the fitted model to a .npz file that can be loaded with
+			emotioncf.predictor.Predictor.load() (the extension is added if missing).
+
+			Args:
+				path: (str) file name
+
+		'''
+
+		self.to_predictor().save(path)
+
+	def _export(self):
+		''' Kind and arrays of the model for a Predictor.  Models that can predict
+			from their parameters override this, the default exports the predictions.'''
+
+		if not self.is_predict:
+			raise ValueError('You must predict() model first before using this method.')
+		return 'table', {'predicted': self._predicted}
+
 	def _retrieve_predictions(self, data):
 		'''Helper function to extract predicted values
-		
+
 			Args:
 				data: (str) can be ['all', 'training', 'test']
-			
+
 			Returns:
 				actual: (np.array) true values
-				predicted:	(np.array) predicted values
+				predicted:    (np.array) predicted values
 		'''
-		
+
 		if data not in ['all', 'training', 'test']:
 			raise ValueError("data must be ['all','training','test']")
+		return self._cached(('predictions', data), self._select_predictions, data)
+
+	def _select_predictions(self, data):
+		''' Uncached _retrieve_predictions().'''
+
+		actual, select = self._prediction_cells(data)
+		actual = actual[select]
+		if data == 'test' and np.all(np.isnan(actual)):
+			raise ValueError("No test data available. Use data='all' or 'training'")
+		return actual, self._predicted[select]
+
+	def _prediction_cells(self, data):
+		''' Subject by item true values and the boolean mask of cells used by _retrieve_predictions().'''
 
-		if data is 'all':
+		if data == 'all':
 			if self.is_mask:
-				if self.is_mask_dilated:
-					actual = self.masked_ratings.values[self.dilated_mask]
-					predicted = self.predicted_ratings.values[self.dilated_mask]
-				else:
-					actual = self.masked_ratings.values[self.train_mask]
-					predicted = self.predicted_ratings.values[self.train_mask]
+				actual = self._masked
+				select = self._dilated_mask if self.is_mask_dilated else self._train_mask
 			else:
-				actual = self.ratings.values.flatten()
-				predicted = self.predicted_ratings.values.flatten()
+				actual = self._data.values
+				select = np.ones(self._data.shape, dtype=bool)
 		elif self.is_mask:
-			if data is 'training':
-				actual = self.masked_ratings.values[self.train_mask]
-				predicted = self.predicted_ratings.values[self.train_mask]
+			if data == 'training':
+				actual = self._masked
+				select = self._train_mask
 			else: # test
-				actual = self.ratings.values[~self.train_mask]
-				predicted = self.predicted_ratings.values[~self.train_mask]
-				if np.all(np.isnan(actual)):
-					raise ValueError("No test data available. Use data='all' or 'training'")
+				actual = self._data.values
+				select = ~self._train_mask
 		else:
 			raise ValueError('Must run split_train_test() before using this option.')
+		return actual, select
 
-		return actual, predicted
-
-	def _conv_ts_mean_overlap(self, sub_rating, n_samples=5):
-
-		'''Dilate each rating by n samples (centered).  If dilated samples are overlapping they will be averaged.
+	def _retrieve_sub_cells(self, data):
+		'''Helper function to select the cells used for each subject's metrics
 
 			Args:
-				sub_rating: vector of ratings for subject
-				n_samples:  number of samples to dilate each rating
+				data: (str) can be ['all', 'training', 'test']
 
 			Returns:
-				sub_rating_conv_mn: subject rating vector with each rating dilated n_samples (centered) with mean of overlapping
-
+				actual: (np.array) subject by item true values
+				select: (np.array) subject by item boolean mask of non-NaN cells to compare
 		'''
 
-		# Notes:  Could add custom filter input
-		bin_sub_rating = ~sub_rating.isnull()
-		if np.any(sub_rating.isnull()):
-			sub_rating.fillna(0, inplace=True)
-		filt = np.ones(n_samples)
-		bin_sub_rating_conv = np.convolve(bin_sub_rating, filt, mode='same')
-		sub_rating_conv = np.convolve(sub_rating, filt, mode='same')
-		sub_rating_conv_mn = deepcopy(sub_rating_conv)
-		sub_rating_conv_mn[bin_sub_rating_conv>=1] = (sub_rating_conv_mn[bin_sub_rating_conv>=1]/
-			bin_sub_rating_conv[bin_sub_rating_conv>=1])
-		new_mask = bin_sub_rating_conv==0
-		sub_rating_conv_mn[new_mask] = np.nan
-		return sub_rating_conv_mn
+		if data not in ['all', 'training', 'test']:
+			raise ValueError("data must be ['all','training','test']")
+		return self._cached(('sub_cells', data), self._select_sub_cells, data)
+
+	def _select_sub_cells(self, data):
+		''' Uncached _retrieve_sub_cells().'''
+
+		if data == 'all':
+			actual = self._data.values
+			select = ~np.isnan(actual)
+		elif self.is_mask:
+			if data == 'training':
+				actual = self._masked
+				select = self._dilated_mask if self.is_mask_dilated else self._train_mask
+			else: # test
+				actual = self._data.values
+				select = ~self._train_mask
+			select = select & ~np.isnan(actual)
+		else:
+			raise ValueError('Must run split_train_test() before using this option.')
+		return actual, select & ~np.isnan(self._predicted)
+
+	def _cached(self, key, compute, data):
+		''' Evaluation arrays computed once per split and reused by every metric.
+			An entry is valid while the ratings, masks, predictions and mask flags
+			are the same objects it was computed from, so fit(), predict(),
+			split_train_test(), downsample() and the property setters, which all
+			replace these arrays, invalidate it.  In-place updates clear the cache.'''
+
+		state = (self._data, self._train_mask, self._masked, self._dilated_mask, self._predicted,
+				self.is_mask, self.is_mask_dilated)
+		entry = self._eval_cache.get(key)
+		if entry is None or any(a is not b for a, b in zip(entry[0], state)):
+			entry = (state, compute(data))
+			self._eval_cache[key] = entry
+		return entry[1]
 
 	def _dilate_ts_rating_samples(self, n_samples=None):
 
@@ -421,15 +630,86 @@ class BaseCF(object):
 		if not self.is_mask:
 			raise ValueError('Make sure cf instance has been masked.')
 
-		self.masked_ratings = self.ratings[self.train_mask]
-		self.masked_ratings = self.masked_ratings.apply(lambda x: self._conv_ts_mean_overlap(x,
-									n_samples=n_samples),
-									axis=1,
-									result_type='broadcast')
-		self.dilated_mask = ~self.masked_ratings.isnull()
-		self.is_mask_dilated = True
+		with self._phase('dilation'):
+			self._masked = dilate_samples(np.where(self._train_mask, self._data.values, np.nan), n_samples)
+			self._dilated_mask = ~np.isnan(self._masked)
+			self.is_mask_dilated = True
 		return self.masked_ratings
 
+	def _update_ratings(self, rows, cols, values, dilate_ts_n_samples=None):
+
+		''' Write new training ratings into cells of the ratings matrix.  If the
+			masked ratings are dilated only the window around the new cells is
+			re-dilated, and if the model has predicted, only the predictions
+			affected by the new cells are updated (see _update_predictions).
+
+			Args:
+				rows: (np.array) subject positions of the new ratings
+				cols: (np.array) item positions of the new ratings
+				values: (np.array) new ratings (cell by dimension for tensor ratings)
+				dilate_ts_n_samples: (int) number of samples the masked ratings were dilated by
+
+			Returns:
+				rows, cols: (np.array) positions of the updated training cells
+		'''
+
+		if not self.is_fit:
+			raise ValueError('You must fit() model first before using this method.')
+		if self.is_mask_dilated and dilate_ts_n_samples is None:
+			raise ValueError('Masked ratings are dilated, please specify dilate_ts_n_samples.')
+		if dilate_ts_n_samples is not None and not self.is_mask_dilated:
+			raise ValueError('Masked ratings are not dilated, fit() with dilate_ts_n_samples first.')
+		if not (self._data.values.flags.writeable and self._data.mask.flags.writeable):
+			raise ValueError('Ratings are read-only, create the cf instance from a copy to update them.')
+		if not self.is_mask:
+			self._set_train_mask(self._data.mask.copy())
+
+		rows = np.asarray(rows, dtype=int)
+		cols = np.asarray(cols, dtype=int)
+		self._data.values[rows, cols] = values
+		self._data.mask[rows, cols] = True
+		self._train_mask[rows, cols] = True
+
+		self._eval_cache.clear()
+		with self._phase('update'):
+			if dilate_ts_n_samples is None:
+				self._masked[rows, cols] = values
+			else:
+				rows, cols = self._dilate_cells(rows, cols, dilate_ts_n_samples)
+			if self.is_predict:
+				self._update_predictions(rows, cols)
+		return rows, cols
+
+	def _dilate_cells(self, rows, cols, n_samples):
+		''' Re-dilate the items of each subject whose window covers one of the given cells.'''
+
+		n_items = self._data.shape[1]
+		updated_rows, updated_cols = [], []
+		for s in np.unique(rows):
+			c = cols[rows == s]
+			# Items whose window [j - n//2, j + (n-1)//2] contains a new cell
+			start = max(c.min() - (n_samples - 1)//2, 0)
+			stop = min(c.max() + n_samples//2 + 1, n_items)
+			# ...and all samples within those windows
+			lo = max(start - n_samples//2, 0)
+			hi = min(stop + (n_samples - 1)//2, n_items)
+			window = np.where(self._train_mask[s, lo:hi], self._data.values[s, lo:hi], np.nan)
+			# items along the first axis of the window, any dimension axis as rows to dilate
+			dilated = dilate_samples(window.T, n_samples).T[start - lo:stop - lo]
+			dilated = dilated.reshape(self._masked[s, start:stop].shape)
+			self._masked[s, start:stop] = dilated
+			self._dilated_mask[s, start:stop] = ~np.isnan(dilated)
+			updated = start + np.flatnonzero((~np.isnan(dilated)).reshape(len(dilated), -1).any(axis=1))
+			updated_rows.append(np.full(len(updated), s))
+			updated_cols.append(updated)
+		return np.concatenate(updated_rows), np.concatenate(updated_cols)
+
+	def _update_predictions(self, rows, cols):
+		''' Update predictions after the training cells (rows, cols) changed.
+			Models override this to only recompute the affected predictions.'''
+
+		self.predict()
+
 class Mean(BaseCF):
 
 	''' CF using Item Mean across subjects'''
@@ -449,14 +729,20 @@ class Mean(BaseCF):
 
 		'''
 
+		self._fit_begin()
 		if self.is_mask:
 			if dilate_ts_n_samples is not None:
 				_ = self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
-				self.mean = self.masked_ratings[self.dilated_mask].mean(skipna=True, axis=0)
+				select = self._dilated_mask
 			else:
-				self.mean = self.masked_ratings[self.train_mask].mean(skipna=True, axis=0)
+				select = self._train_mask
+			ratings = self._masked
 		else:
-			self.mean = self.ratings.mean(skipna=True, axis=0)
+			ratings = self._data.values
+			select = self._data.mask
+		with self._phase('mean'):
+			mean = _nanmean(np.where(select, ratings, np.nan), axis=0)
+		self.mean = pd.Series(mean, index=self._data.columns)
 		self.is_fit = True
 
 	def predict(self):
@@ -474,66 +760,105 @@ class Mean(BaseCF):
 		if not self.is_fit:
 			raise ValueError('You must fit() model first before using this method.')
 
-		self.predicted_ratings = self.ratings.copy()
-		for row in self.ratings.iterrows():
-			self.predicted_ratings.loc[row[0]] = self.mean
+		with self._phase('predict'):
+			self._predicted = np.tile(self.mean.values, (self._data.shape[0], 1))
+		self._record_arrays(predicted_ratings=self._predicted)
 		self.is_predict = True
 
+	def _update_predictions(self, rows, cols):
+		''' Recompute the means of the updated items.'''
+
+		cols = np.unique(cols)
+		mean = _nanmean(self._masked[:, cols], axis=0)
+		self.mean.iloc[cols] = mean
+		self._predicted[:, cols] = mean
+
+	def _export(self):
+		return 'mean', {'item_mean': self.mean.values}
+
 class KNN(BaseCF):
 
-	''' K-Nearest Neighbors CF algorithm'''
+	''' K-Nearest Neighbors CF algorithm
+
+		Similarity is either computed between subjects (mode='subject'), or
+		between items (mode='item').  The item-based mode keeps a compact table
+		of each item's top-k most similar items, so predicting for any subject,
+		including new subjects, only depends on that subject's rated items.
+
+	'''
 
 	def __init__(self, ratings, mask=None, n_train_items=None):
 		super(KNN, self).__init__(ratings, mask, n_train_items)
-		self.subject_similarity = None
+		self._similarity = None
+		self.mode = 'subject'
+		self.item_neighbors = None
+		self.item_weights = None
+
+	@property
+	def subject_similarity(self):
+		if self._similarity is None:
+			return None
+		return readonly_frame(self._similarity, self._data.index, self._data.index)
+
+	@subject_similarity.setter
+	def subject_similarity(self, sim):
+		self._similarity = None if sim is None else np.asarray(sim, dtype=float)
 
-	def fit(self, metric='pearson', dilate_ts_n_samples=None):
+	def fit(self, metric='pearson', dilate_ts_n_samples=None, n_jobs=1, block_size=None, memmap=None,
+			mode='subject', n_item_neighbors=20):
 
 		''' Fit collaborative model to training data.  Calculate similarity between subjects across items
 
 		Args:
-			metric: type of similarity {"pearson",,"spearman","correlation","cosine"}.  Note pearson and spearman are way faster.
+			metric: type of similarity {"pearson","spearman","kendall","correlation","cosine"}.
+					See emotioncf.similarity.similarity() for details.
 			dilate_ts_n_samples: will dilate masked samples by n_samples to leverage auto-correlation
 								in estimating time-series ratings
+			n_jobs: (int) number of threads used to compute similarity tiles, -1 uses all cores (default=1)
+			block_size: (int) number of subjects per similarity tile (default=256)
+			memmap: (str) optional .npy path to memory-map the similarity matrix to
+			mode: (str) compute similarity between 'subject's or between 'item's (default='subject')
+			n_item_neighbors: (int) number of neighbors kept per item when mode='item' (default=20)
 
 		'''
 
+		if mode not in ['subject', 'item']:
+			raise ValueError("mode must be ['subject','item']")
+
+		self._fit_begin()
+		with self._phase('mask'):
+			if self.is_mask:
+				ratings = np.where(self._train_mask, self._data.values, np.nan)
+			else:
+				ratings = self._data.values
 
-		if self.is_mask:
-			ratings = self.ratings[self.train_mask]
-		else:
-			ratings = self.ratings.copy()
-		
 		if dilate_ts_n_samples is not None:
-			ratings = self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
-			ratings = ratings[self.dilated_mask]
-
-		def cosine_similarity(x,y):
-			return np.dot(x,y)/(np.linalg.norm(x)*np.linalg.norm(y))
-
-		if metric in ['pearson','kendall','spearman']:
-			sim = ratings.T.corr(method=metric)
-		elif metric in ['correlation','cosine']:
-			sim = pd.DataFrame(np.zeros((ratings.shape[0], ratings.shape[0])))
-			sim.columns = ratings.index
-			sim.index = ratings.index
-			for x in ratings.iterrows():
-				for y in ratings.iterrows():
-					if metric is 'correlation':
-						sim.loc[x[0],y[0]] = pearsonr(x[1][(~x[1].isnull()) & (~y[1].isnull())],y[1][(~x[1].isnull()) & (~y[1].isnull())])[0]
-					elif metric is 'cosine':
-						sim.loc[x[0],y[0]] = cosine_similarity(x[1][(~x[1].isnull()) & (~y[1].isnull())],y[1][(~x[1].isnull()) & (~y[1].isnull())])
+			self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+			ratings = self._masked
+
+		self.mode = mode
+		if mode == 'subject':
+			with self._phase('similarity'):
+				sim = similarity(ratings, metric=metric, block_size=block_size, n_jobs=n_jobs, out=memmap)
+			self._similarity = sim
+			self._record_arrays(ratings=ratings, subject_similarity=sim)
 		else:
-			raise NotImplementedError("%s is not implemented yet. Try ['pearson','spearman','correlation','cosine']" % metric )
-		self.subject_similarity = sim
+			with self._phase('similarity'):
+				sim = similarity(ratings.T, metric=metric, block_size=block_size, n_jobs=n_jobs, out=memmap)
+			with self._phase('neighbors'):
+				self.item_neighbors, self.item_weights, _ = _top_neighbors(sim, n_item_neighbors)
+			self._similarity = None
+			self._fit_ratings = ratings
+			self._item_mean = _nanmean(ratings, axis=0)
+			self._record_arrays(ratings=ratings, item_neighbors=self.item_neighbors, item_weights=self.item_weights)
 		self.is_fit = True
 
 	def predict(self, k=None):
 		''' Predict Subject's missing items using similarity based collaborative filtering.
 
 			Args:
-				ratings: pandas dataframe instance of ratings
-				k: number of closest neighbors to use
+				k: number of closest neighbors to use.  In item mode at most the
+				   n_item_neighbors stored at fit() can be used.
 
 			Returns:
 				predicted_rating: (pd.DataFrame instance) adds field to object instance
@@ -543,25 +868,93 @@ class KNN(BaseCF):
 		if not self.is_fit:
 			raise ValueError('You must fit() model first before using this method.')
 
-		if self.is_mask:
-			ratings = self.masked_ratings.copy()
-		else:
-			ratings = self.ratings.copy()
-
-		pred = pd.DataFrame(np.zeros(ratings.shape))
-		pred.columns = ratings.columns
-		pred.index = ratings.index
-		for row in ratings.iterrows():
-			if k is not None:
-				top_subjects = self.subject_similarity.loc[row[0]].drop(row[0]).sort_values(ascending=False)[0:k]
-			else:
-				top_subjects = self.subject_similarity.loc[row[0]].drop(row[0]).sort_values(ascending=False)
-			top_subjects = top_subjects[~top_subjects.isnull()] # remove nan subjects
-			for col in ratings.iteritems():
-				pred.loc[row[0],col[0]] = np.dot(top_subjects, self.ratings.loc[top_subjects.index,col[0]].T)/len(top_subjects)
-		self.predicted_ratings = pred
+		self._k = k
+		if self.mode == 'item':
+			with self._phase('predict'):
+				self._predicted = self._predict_items(self._fit_ratings, k=k)
+			self._record_arrays(predicted_ratings=self._predicted)
+			self.is_predict = True
+			return
+
+		with self._phase('neighbors'):
+			self._neighbor_index, self._neighbor_weights, self._neighbor_valid = _top_neighbors(self._similarity, k)
+		with self._phase('predict'):
+			pred = self._predict_subjects(self._data.values)
+		self._predicted = pred
+		self._record_arrays(predicted_ratings=pred)
 		self.is_predict = True
 
+	def _predict_subjects(self, ratings):
+		''' Predictions of the subjects from their top neighbors, see _neighbor_predictions().'''
+
+		return _neighbor_predictions(ratings, self._neighbor_index, self._neighbor_weights, self._neighbor_valid)
+
+	def _update_predictions(self, rows, cols):
+		''' Recompute the predictions depending on the updated cells.'''
+
+		if self.mode == 'item':
+			self._fit_ratings[rows, cols] = self._masked[rows, cols]
+			rows, cols = np.unique(rows), np.unique(cols)
+			self._item_mean[cols] = _nanmean(self._fit_ratings[:, cols], axis=0)
+			self._predicted[:, cols] = self._predict_items(self._fit_ratings, k=self._k, items=cols)
+			self._predicted[rows] = self._predict_items(self._fit_ratings[rows], k=self._k)
+		else:
+			cols = np.unique(cols)
+			self._predicted[:, cols] = self._predict_subjects(self._data.values[:, cols])
+
+	def _export(self):
+		if self.mode != 'item':
+			return super(KNN, self)._export()
+		k = getattr(self, '_k', None)
+		return 'knn_item', {'ratings': self._fit_ratings,
+							'item_neighbors': self.item_neighbors[:, :k],
+							'item_weights': self.item_weights[:, :k],
+							'item_mean': self._item_mean}
+
+	def predict_new(self, ratings, k=None):
+		''' Predict ratings of new subjects from the item neighbor table.  Requires fit(mode='item').
+
+			Args:
+				ratings: (pd.DataFrame or pd.Series) ratings of new subjects for the fitted items, NaN if unrated
+				k: number of closest neighbors to use
+
+			Returns:
+				predicted_rating: (pd.DataFrame) predicted subject by item ratings
+
+		'''
+
+		if not self.is_fit:
+			raise ValueError('You must fit() model first before using this method.')
+		if self.mode != 'item':
+			raise ValueError("predict_new() requires fit(mode='item').")
+
+		if isinstance(ratings, pd.Series):
+			ratings = ratings.to_frame().T
+		if not isinstance(ratings, pd.DataFrame):
+			raise ValueError('ratings must be a pandas dataframe instance')
+		ratings = ratings.reindex(columns=self._data.columns)
+		return pd.DataFrame(self._predict_items(ratings.to_numpy(dtype=float), k=k),
+							index=ratings.index, columns=self._data.columns)
+
+	def _predict_items(self, ratings, k=None, items=None, max_elements=2**22):
+		''' Similarity weighted mean of each subject's ratings of the neighbors of every item
+			(or of the given item positions).  Falls back to the item mean if a subject rated
+			none of an item's neighbors.'''
+
+		if items is None:
+			items = slice(None)
+		neighbors = self.item_neighbors[items, :k]
+		weights = self.item_weights[items, :k]
+		pred = np.empty((ratings.shape[0], neighbors.shape[0]))
+		chunk = max(1, max_elements//neighbors.size)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			for start in range(0, ratings.shape[0], chunk):
+				rows = slice(start, start + chunk)
+				neighbor_ratings = ratings[rows][:, neighbors]
+				rated = ~np.isnan(neighbor_ratings)
+				pred[rows] = (np.where(rated, neighbor_ratings, 0)*weights).sum(axis=2)/(rated*np.abs(weights)).sum(axis=2)
+		return np.where(np.isfinite(pred), pred, self._item_mean[items])
+
 class NNMF_multiplicative(BaseCF):
 	''' Train non negative matrix factorization model using multiplicative updates.
 		Allows masking to only learn the training weights.
@@ -582,68 +975,118 @@ class NNMF_multiplicative(BaseCF):
 		error_limit = 1e-6,
 		fit_error_limit = 1e-6,
 		verbose = False,
-		dilate_ts_n_samples = None):
+		dilate_ts_n_samples = None,
+		init = 'random',
+		n_blocks = None,
+		client = None):
 
 		''' Fit NNMF collaborative filtering model to training data using multiplicative updating.
 
 		Args:
-			n_factors (int): Number of factors or components
+			n_factors (int): Number of factors or components.  'auto' estimates the rank
+							of the mean-imputed training ratings (see emotioncf.factorization.estimate_rank)
 			max_iterations (int):  maximum number of interations (default=100)
 			error_limit (float): error tolerance (default=1e-6)
-			fit_error_limit (float): fit error tolerance (default=1e-6)
+			fit_error_limit (float): fit error tolerance, stops once the change in fit falls below it (default=1e-6)
 			verbose (bool): verbose output during fitting procedure (default=True)
 			dilate_ts_n_samples (int): will dilate masked samples by n_samples to leverage auto-correlation
 										in estimating time-series ratings
+			init (str): initialization of W and H {'random','nndsvd','nndsvda'}.  The NNDSVD variants
+						start from a truncated SVD of the mean-imputed training ratings and reach a loose
+						tolerance in far fewer iterations.  'nndsvd' keeps zeros, which multiplicative
+						updates barely move, so prefer 'nndsvda' for tight tolerances (default='random')
+			n_blocks (int): split the ratings into n_blocks row blocks updated by separate worker
+							processes, see emotioncf.distributed.multiplicative_updates() (default=None, dense updates).
+							The model still holds the full ratings and predictions, ratings larger than
+							memory can be fit with emotioncf.distributed.multiplicative_updates_blocks()
+			client: dask.distributed Client to run the row block workers on (default=None).  Uses one
+					block per dask worker unless n_blocks is given
 
 		'''
 
-		eps = 1e-5
+		if init not in ['random', 'nndsvd', 'nndsvda']:
+			raise ValueError("init must be ['random','nndsvd','nndsvda']")
 
-		n_users, n_items = self.ratings.shape
-
-		if n_factors is None:
-			n_factors = n_items
+		eps = 1e-5
 
-		# Initial guesses for solving X ~= WH. H is random [0,1] scaled by sqrt(X.mean() / n_factors)
-		avg = np.sqrt(np.nanmean(self.ratings)/n_factors)
-		self.H = avg*np.random.rand(n_items, n_factors) # H = Y
-		self.W = avg*np.random.rand(n_users, n_factors)	# W = A
+		self._fit_begin()
+		n_users, n_items = self._data.shape
 
 		if self.is_mask:
 			if dilate_ts_n_samples is not None:
-				masked_X = self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples).values
-				mask = self.dilated_mask.values
+				self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+				mask = self._dilated_mask
+				masked_X = np.where(mask, self._masked, 0)
 			else:
-				mask = self.train_mask.values
-				masked_X = self.ratings.values * mask
-			masked_X[np.isnan(masked_X)]=0
+				with self._phase('mask'):
+					mask = self._train_mask
+					masked_X = np.where(mask, self._data.values, 0)
 		else:
-			masked_X = self.ratings.values
-			mask = np.ones(self.ratings.shape)
+			masked_X = self._data.values
+			mask = np.ones(self._data.shape)
+
+		with self._phase('init'):
+			if init != 'random' or n_factors == 'auto':
+				imputed = mean_impute(masked_X, mask.astype(bool))
+			if n_factors is None:
+				n_factors = n_items
+			elif n_factors == 'auto':
+				n_factors = estimate_rank(imputed)
+			self.n_factors = n_factors
+
+			if init == 'random':
+				# Initial guesses for solving X ~= WH. H is random [0,1] scaled by sqrt(X.mean() / n_factors)
+				avg = np.sqrt(np.nanmean(self._data.values)/n_factors)
+				self.H = avg*np.random.rand(n_factors, n_items) # H = Y
+				self.W = avg*np.random.rand(n_users, n_factors)    # W = A
+			else:
+				# zeros would stay fixed under multiplicative updates, floor them like the updates do
+				W, H = nndsvd(imputed, n_factors, variant=init)
+				self.W, self.H = np.maximum(W, eps), np.maximum(H, eps)
+		self._record_arrays(masked_X=masked_X, mask=mask, W=self.W, H=self.H)
+
+		if n_blocks is not None or client is not None:
+			if n_blocks is None:
+				n_blocks = len(client.scheduler_info()['workers'])
+			with self._phase('blocked_updates'):
+				self.W, self.H = multiplicative_updates(masked_X, mask, self.W, self.H,
+														max_iterations=max_iterations,
+														fit_error_limit=fit_error_limit,
+														n_blocks=n_blocks, client=client,
+														callback=self._record_iteration if self._callbacks else None,
+														verbose=verbose, eps=eps)
+			self.is_fit = True
+			return
 
 		X_est_prev = np.dot(self.W, self.H)
 
 		ctr = 1; fit_residual = 100;
-		while ctr <= max_iterations or fit_residual < fit_error_limit:
+		while ctr <= max_iterations and fit_residual >= fit_error_limit:
 		# while ctr <= max_iterations or curRes < error_limit or fit_residual < fit_error_limit:
+			tic = timer()
 			# Update W: A=A.*(((W.*X)*Y')./((W.*(A*Y))*Y'));
-			self.W *= np.dot(masked_X, self.H.T) / np.dot(mask * np.dot(self.W, self.H), self.H.T)
-			self.W = np.maximum(self.W, eps)
+			with self._phase('update_W'):
+				self.W *= np.dot(masked_X, self.H.T) / np.dot(mask * np.dot(self.W, self.H), self.H.T)
+				self.W = np.maximum(self.W, eps)
 
 			# Update H: Matlab: Y=Y.*((A'*(W.*X))./(A'*(W.*(A*Y))));
-			self.H *= np.dot(self.W.T, masked_X) / np.dot(self.W.T, mask * np.dot(self.W, self.H))
-			self.H = np.maximum(self.H, eps)
+			with self._phase('update_H'):
+				self.H *= np.dot(self.W.T, masked_X) / np.dot(self.W.T, mask * np.dot(self.W, self.H))
+				self.H = np.maximum(self.H, eps)
 
 			# Evaluate
-			X_est = np.dot(self.W, self.H)
-			err = mask * (X_est_prev - X_est)
-			fit_residual = np.sqrt(np.sum(err ** 2))
-			X_est_prev = X_est
+			with self._phase('residual'):
+				X_est = np.dot(self.W, self.H)
+				err = mask * (X_est_prev - X_est)
+				fit_residual = np.sqrt(np.sum(err ** 2))
+				X_est_prev = X_est
 			# curRes = linalg.norm(mask * (masked_X - X_est), ord='fro')
 			if ctr % 10 == 0 and verbose:
 				print('\tCurrent Iteration {}:'.format(ctr))
 				print('\tfit residual', np.round(fit_residual, 4))
 				# print('\ttotal residual', np.round(curRes, 4))
+			if self._callbacks:
+				self._record_iteration(ctr, timer() - tic, fit_residual)
 			ctr += 1
 		self.is_fit = True
 
@@ -661,10 +1104,24 @@ class NNMF_multiplicative(BaseCF):
 		if not self.is_fit:
 			raise ValueError('You must fit() model first before using this method.')
 
-		self.predicted_ratings = self.ratings.copy()
-		self.predicted_ratings.loc[:,:] = np.dot(self.W, self.H)
+		with self._phase('predict'):
+			self._predicted = np.dot(self.W, self.H)
+		self._record_arrays(predicted_ratings=self._predicted)
 		self.is_predict = True
 
+	def _update_predictions(self, rows, cols, n_iterations=10):
+		''' Fold the updated subjects' ratings into their rows of W with H held fixed.'''
+
+		rows = np.unique(rows)
+		mask = (self._dilated_mask if self.is_mask_dilated else self._train_mask)[rows]
+		masked_X = np.where(mask, self._masked[rows], 0)
+		W = fold_in_multiplicative(masked_X, mask, self.H, W=self.W[rows], n_iterations=n_iterations)
+		self.W[rows] = W
+		self._predicted[rows] = np.dot(W, self.H)
+
+	def _export(self):
+		return 'nnmf', {'W': self.W, 'H': self.H}
+
 class NNMF_sgd(BaseCF):
 	''' Train non negative matrix factorization model using stochastic gradient descent.
 		Allows masking to only learn the training weights.
@@ -687,46 +1144,79 @@ class NNMF_sgd(BaseCF):
 			learning_rate=0.001,
 			n_iterations=10,
 			verbose=False,
-			dilate_ts_n_samples=None):
+			dilate_ts_n_samples=None,
+			init='random',
+			patience=None,
+			min_delta=0.0,
+			learning_rate_decay=1.0):
 
 		''' Fit NNMF collaborative filtering model to training data using stochastic gradient descent.
 
+			After every epoch the training RMSE and, if the ratings were split with
+			split_train_test(), the validation RMSE on the held-out (test) cells are
+			stored in `history`.
+
 		Args:
-			n_factors (int): Number of factors or components
+			n_factors (int): Number of factors or components.  'auto' estimates the rank
+							of the mean-imputed training ratings (see emotioncf.factorization.estimate_rank)
 			max_iterations (int):  maximum number of interations (default=100)
 			error_limit (float): error tolerance (default=1e-6)
 			fit_error_limit (float): fit error tolerance (default=1e-6)
 			verbose (bool): verbose output during fitting procedure (default=True)
 			dilate_ts_n_samples (int): will dilate masked samples by n_samples to leverage auto-correlation
 										in estimating time-series ratings
+			init (str): initialization of the latent vectors {'random','svd'}.  'svd' starts from a
+						randomized truncated SVD of the mean-imputed training ratings (default='random')
+			patience (int): stop once the validation RMSE has not improved for patience epochs and
+							restore the factors of the best epoch (default=None, run all n_iterations)
+			min_delta (float): minimum decrease of the validation RMSE counted as an improvement (default=0)
+			learning_rate_decay (float): multiply the learning rate by this factor after every epoch (default=1)
 
 		'''
 
+		if init not in ['random', 'svd']:
+			raise ValueError("init must be ['random','svd']")
+		if patience is not None and not (self.is_mask and (self._data.mask & ~self._train_mask).any()):
+			raise ValueError('Early stopping requires held-out ratings, run split_train_test() first.')
+
 		# initialize variables
-		n_users, n_items = self.ratings.shape
-		if n_factors is  None:
-			n_factors = n_items
-			
+		self._fit_begin()
+		n_users, n_items = self._data.shape
+
 		if dilate_ts_n_samples is not None:
 			self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
 
-		if self.is_mask:
-			if self.is_mask_dilated:
-				ratings = self.masked_ratings[self.dilated_mask]
-				sample_row, sample_col = self.dilated_mask.values.nonzero()
-				self.global_bias = ratings[self.dilated_mask].mean().mean()
+		with self._phase('mask'):
+			if self.is_mask:
+				select = self._dilated_mask if self.is_mask_dilated else self._train_mask
+				ratings = np.where(select, self._masked, np.nan)
+				sample_row, sample_col = select.nonzero()
+				# mean of item means
+				self.global_bias = _nanmean(_nanmean(ratings, axis=0), axis=0)
 			else:
-				ratings = self.masked_ratings[self.train_mask]
-				sample_row, sample_col = self.train_mask.values.nonzero()
-				self.global_bias = ratings[self.train_mask].mean().mean()
-		else:
-			ratings = self.ratings.copy()
-			sample_row, sample_col = zip(*np.argwhere(~np.isnan(ratings.values)))
-			self.global_bias = ratings.values[~np.isnan(ratings.values)].mean()
+				ratings = self._data.values
+				sample_row, sample_col = self._data.mask.nonzero()
+				self.global_bias = ratings[self._data.mask].mean()
 
 		# initialize latent vectors
-		self.user_vecs = np.random.normal(scale=1./n_factors, size=(n_users, n_factors))
-		self.item_vecs = np.random.normal(scale=1./n_factors, size=(n_items, n_factors))
+		with self._phase('init'):
+			if init != 'random' or n_factors == 'auto':
+				residual = mean_impute(ratings, ~np.isnan(ratings)) - self.global_bias
+			if n_factors is None:
+				n_factors = n_items
+			elif n_factors == 'auto':
+				n_factors = estimate_rank(residual)
+			self.n_factors = n_factors
+
+			if init == 'random':
+				self.user_vecs = np.random.normal(scale=1./n_factors, size=(n_users, n_factors))
+				self.item_vecs = np.random.normal(scale=1./n_factors, size=(n_items, n_factors))
+			else:
+				U, S, Vt = randomized_svd(residual, n_factors)
+				self.user_vecs = U*np.sqrt(S)
+				self.item_vecs = Vt.T*np.sqrt(S)
+				self.n_factors = len(S) # at most the rank of the ratings
+		self._record_arrays(ratings=ratings, user_vecs=self.user_vecs, item_vecs=self.item_vecs)
 
 		# Initialize biases
 		self.user_bias = np.zeros(n_users)
@@ -736,30 +1226,57 @@ class NNMF_sgd(BaseCF):
 		self.item_bias_reg = item_bias_reg
 		self.user_bias_reg = user_bias_reg
 
+		# held-out cells for validation
+		if self.is_mask:
+			val_row, val_col = (self._data.mask & ~self._train_mask).nonzero()
+		else:
+			val_row, val_col = np.array([], dtype=int), np.array([], dtype=int)
+		self.history = {'learning_rate': [], 'train_rmse': [], 'validation_rmse': []}
+		self.best_iteration = None
+		best = None
+		n_worse = 0
+
 		# train weights
 		ctr = 1
 		while ctr <= n_iterations:
-			if ctr % 10 == 0 and verbose:
-				print('\tCurrent Iteration: {}'.format(ctr))
+			tic = timer()
 
 			training_indices = np.arange(len(sample_row))
 			np.random.shuffle(training_indices)
 
-			for idx in training_indices:
-				u = sample_row[idx]
-				i = sample_col[idx]
-				prediction = self._predict_single(u, i)
-
-				e = (ratings.iloc[u, i] - prediction) # error
-
-				# Update biases
-				self.user_bias[u] += (learning_rate * (e - self.user_bias_reg * self.user_bias[u]))
-				self.item_bias[i] += (learning_rate * (e - self.item_bias_reg * self.item_bias[i]))
+			with self._phase('updates'):
+				self._sgd_updates(sample_row[training_indices], sample_col[training_indices], ratings, learning_rate)
 
-				# Update latent factors
-				self.user_vecs[u, :] += (learning_rate * (e * self.item_vecs[i, :] - self.user_fact_reg * self.user_vecs[u,:]))
-				self.item_vecs[i, :] += (learning_rate * (e * self.user_vecs[u, :] - self.item_fact_reg * self.item_vecs[i,:]))
+			with self._phase('residual'):
+				train_rmse = self._rmse(ratings, sample_row, sample_col)
+				validation_rmse = self._rmse(self._data.values, val_row, val_col) if len(val_row) else np.nan
+			self.history['learning_rate'].append(learning_rate)
+			self.history['train_rmse'].append(train_rmse)
+			self.history['validation_rmse'].append(validation_rmse)
+			if ctr % 10 == 0 and verbose:
+				print('\tCurrent Iteration: {}'.format(ctr))
+				print('\ttrain rmse', np.round(train_rmse, 4), 'validation rmse', np.round(validation_rmse, 4))
+			if self._callbacks:
+				self._record_iteration(ctr, timer() - tic, train_rmse)
+
+			if patience is not None:
+				if np.isfinite(validation_rmse) and (best is None or validation_rmse < best[0] - min_delta):
+					best = (validation_rmse, self.user_vecs.copy(), self.item_vecs.copy(),
+							self.user_bias.copy(), self.item_bias.copy())
+					self.best_iteration = ctr
+					n_worse = 0
+				else:
+					n_worse += 1
+					if n_worse >= patience:
+						if verbose:
+							print('\tStopping early at iteration {}, best iteration {}'.format(ctr, self.best_iteration))
+						break
+			learning_rate *= learning_rate_decay
 			ctr += 1
+
+		if best is not None:
+			_, self.user_vecs, self.item_vecs, self.user_bias, self.item_bias = best
+		self.learning_rate = learning_rate
 		self.is_fit = True
 
 	def predict(self):
@@ -772,14 +1289,344 @@ class NNMF_sgd(BaseCF):
 			Returns:
 				predicted_rating: (pd.DataFrame instance) adds field to object instance
 		'''
-		self.predicted_ratings = self.ratings.copy()
-		for u in range(self.user_vecs.shape[0]):
-			for i in range(self.item_vecs.shape[0]):
-				self.predicted_ratings.iloc[u, i] = self._predict_single(u, i)
+
+		with self._phase('predict'):
+			self._predicted = (self.global_bias + self.user_bias[:, np.newaxis] + self.item_bias[np.newaxis, :] +
+								np.dot(self.user_vecs, self.item_vecs.T))
+		self._record_arrays(predicted_ratings=self._predicted)
 		self.is_predict = True
 
+	def _sgd_updates(self, rows, cols, ratings, learning_rate):
+		""" One stochastic gradient step for each (row, col) training cell in order."""
+
+		for u, i in zip(rows, cols):
+			prediction = self._predict_single(u, i)
+
+			e = (ratings[u, i] - prediction) # error
+
+			# Update biases
+			self.user_bias[u] += (learning_rate * (e - self.user_bias_reg * self.user_bias[u]))
+			self.item_bias[i] += (learning_rate * (e - self.item_bias_reg * self.item_bias[i]))
+
+			# Update latent factors
+			self.user_vecs[u, :] += (learning_rate * (e * self.item_vecs[i, :] - self.user_fact_reg * self.user_vecs[u,:]))
+			self.item_vecs[i, :] += (learning_rate * (e * self.user_vecs[u, :] - self.item_fact_reg * self.item_vecs[i,:]))
+
+	def _update_predictions(self, rows, cols):
+		""" Online SGD step on the updated cells, then recompute the affected subjects and items."""
+
+		order = np.random.permutation(len(rows))
+		self._sgd_updates(rows[order], cols[order], self._masked, self.learning_rate)
+		rows, cols = np.unique(rows), np.unique(cols)
+		self._predicted[rows] = (self.global_bias + self.user_bias[rows, np.newaxis] + self.item_bias[np.newaxis, :] +
+								np.dot(self.user_vecs[rows], self.item_vecs.T))
+		self._predicted[:, cols] = (self.global_bias + self.user_bias[:, np.newaxis] + self.item_bias[np.newaxis, cols] +
+									np.dot(self.user_vecs, self.item_vecs[cols].T))
+
+	def _export(self):
+		return 'sgd', {'global_bias': self.global_bias, 'user_bias': self.user_bias,
+						'item_bias': self.item_bias, 'user_vecs': self.user_vecs,
+						'item_vecs': self.item_vecs, 'user_fact_reg': self.user_fact_reg,
+						'user_bias_reg': self.user_bias_reg}
+
 	def _predict_single(self, u, i):
 			""" Single user and item prediction."""
 			prediction = self.global_bias + self.user_bias[u] + self.item_bias[i]
 			prediction += self.user_vecs[u, :].dot(self.item_vecs[i, :].T)
 			return prediction
+
+	def _rmse(self, ratings, rows, cols):
+		""" Root mean squared error of the predictions for arrays of user and item indices."""
+		return np.sqrt(np.mean((ratings[rows, cols] - self._predict_cells(rows, cols))**2))
+
+	def _predict_cells(self, rows, cols):
+		""" Vectorized prediction for arrays of user and item indices."""
+		return (self.global_bias + self.user_bias[rows] + self.item_bias[cols] +
+				np.sum(self.user_vecs[rows] * self.item_vecs[cols], axis=1))
+
+class TemporalMF(BaseCF):
+	''' Matrix factorization of continuous ratings with a temporal smoothness penalty.
+
+		Ratings are modeled as r_ui ~= mu + u_s.v_i, fit with alternating least
+		squares on the observed (training) cells only.  Adjacent items (timepoints)
+		are tied together by penalizing the order-th differences of the item
+		factors, so items without any rating are interpolated from their
+		neighbors and predictions vary smoothly over time, without dilating the
+		ratings into a denser training matrix.  The item step is a block banded
+		linear system solved with scipy.linalg.solveh_banded.
+
+	'''
+
+	def __init__(self, ratings, mask=None, n_train_items=None):
+		super(TemporalMF, self).__init__(ratings, mask, n_train_items)
+		self.user_vecs = None
+		self.item_vecs = None
+
+	def fit(self,
+			n_factors=None,
+			smoothness=1.0,
+			order=1,
+			user_fact_reg=0.1,
+			item_fact_reg=0.1,
+			n_iterations=50,
+			tol=1e-5,
+			verbose=False,
+			max_elements=2**22):
+
+		''' Fit the temporal factorization model to the training data.
+
+			The training RMSE and the penalized loss of every iteration are stored in `history`.
+
+		Args:
+			n_factors (int): Number of factors (default: estimated from the mean-imputed
+							training ratings, see emotioncf.factorization.estimate_rank)
+			smoothness (float): weight of the penalty on differences of adjacent item factors (default=1)
+			order (int): order of the differences, 1 penalizes changes and 2 changes of slope (default=1)
+			user_fact_reg (float): regularization of the subject factors (default=0.1)
+			item_fact_reg (float): regularization of the item factors (default=0.1)
+			n_iterations (int): maximum number of alternating updates (default=50)
+			tol (float): stop once the relative decrease of the loss falls below tol (default=1e-5)
+			verbose (bool): print the training RMSE every 10 iterations
+			max_elements (int): maximum number of elements of the per-rating outer products held at once
+
+		'''
+
+		from scipy.linalg import solveh_banded
+
+		if order < 1:
+			raise ValueError('order must be at least 1')
+		if user_fact_reg <= 0 or item_fact_reg <= 0:
+			raise ValueError('user_fact_reg and item_fact_reg must be positive')
+
+		self._fit_begin()
+		n_users, n_items = self._data.shape
+		if n_items <= order:
+			raise ValueError('order must be smaller than the number of items')
+
+		with self._phase('mask'):
+			select = self._data.mask & self._train_mask if self.is_mask else self._data.mask
+			rows, cols = select.nonzero()
+			values = self._data.values[rows, cols]
+			self.global_bias = values.mean()
+			values = values - self.global_bias
+			# observations sorted by subject and by item for the grouped sums
+			by_item = np.argsort(cols, kind='mergesort')
+
+		with self._phase('init'):
+			if n_factors is None:
+				n_factors = estimate_rank(mean_impute(self._data.values, select) - self.global_bias)
+			self.n_factors = n_factors
+			self.user_vecs = np.random.normal(scale=1./n_factors, size=(n_users, n_factors))
+			self.item_vecs = np.zeros((n_items, n_factors))
+			penalty = _difference_penalty(n_items, order)
+		self.smoothness = smoothness
+		self.order = order
+		self.user_fact_reg = user_fact_reg
+		self.item_fact_reg = item_fact_reg
+		self._record_arrays(values=values, user_vecs=self.user_vecs, item_vecs=self.item_vecs)
+
+		self.history = {'train_rmse': [], 'loss': []}
+		loss_prev = np.inf
+		ctr = 1
+		while ctr <= n_iterations:
+			tic = timer()
+			with self._phase('update_items'):
+				gram, rhs = _grouped_gram(self.user_vecs[rows[by_item]], cols[by_item], values[by_item],
+										  n_items, max_elements)
+				ab = _banded_system(gram, item_fact_reg, smoothness*penalty)
+				self.item_vecs = solveh_banded(ab, rhs.ravel()).reshape(n_items, n_factors)
+
+			with self._phase('update_users'):
+				gram, rhs = _grouped_gram(self.item_vecs[cols], rows, values, n_users, max_elements)
+				gram += user_fact_reg*np.eye(n_factors)
+				self.user_vecs = np.linalg.solve(gram, rhs[:, :, np.newaxis])[:, :, 0]
+
+			with self._phase('residual'):
+				sse = np.sum((values - np.sum(self.user_vecs[rows]*self.item_vecs[cols], axis=1))**2)
+				diff = np.diff(self.item_vecs, n=order, axis=0)
+				loss = (sse + user_fact_reg*np.sum(self.user_vecs**2) + item_fact_reg*np.sum(self.item_vecs**2) +
+						smoothness*np.sum(diff**2))
+				train_rmse = np.sqrt(sse/max(len(values), 1))
+			self.history['train_rmse'].append(train_rmse)
+			self.history['loss'].append(loss)
+			if ctr % 10 == 0 and verbose:
+				print('\tCurrent Iteration: {}'.format(ctr))
+				print('\ttrain rmse', np.round(train_rmse, 4))
+			if self._callbacks:
+				self._record_iteration(ctr, timer() - tic, loss)
+			if loss_prev - loss <= tol*loss:
+				break
+			loss_prev = loss
+			ctr += 1
+		self.is_fit = True
+
+	def predict(self):
+
+		''' Predict Subject's missing items from the subject and item factors
+
+			Returns:
+				predicted_rating: (pd.DataFrame instance) adds field to object instance
+
+		'''
+
+		if not self.is_fit:
+			raise ValueError('You must fit() model first before using this method.')
+
+		with self._phase('predict'):
+			self._predicted = self.global_bias + np.dot(self.user_vecs, self.item_vecs.T)
+		self._record_arrays(predicted_ratings=self._predicted)
+		self.is_predict = True
+
+	def _update_predictions(self, rows, cols):
+		''' Refit the updated subjects' factors with the item factors held fixed.'''
+
+		rows = np.unique(rows)
+		select = (self._dilated_mask if self.is_mask_dilated else self._train_mask)[rows]
+		sub_rows, sub_cols = select.nonzero()
+		values = self._masked[rows][sub_rows, sub_cols] - self.global_bias
+		gram, rhs = _grouped_gram(self.item_vecs[sub_cols], sub_rows, values, len(rows), 2**22)
+		gram += self.user_fact_reg*np.eye(self.n_factors)
+		self.user_vecs[rows] = np.linalg.solve(gram, rhs[:, :, np.newaxis])[:, :, 0]
+		self._predicted[rows] = self.global_bias + np.dot(self.user_vecs[rows], self.item_vecs.T)
+
+def _grouped_gram(factors, groups, values, n_groups, max_elements=2**22):
+	''' Sums of the outer products factors[j] factors[j].T and of values[j]*factors[j]
+		over the observations j of each group.  groups must be sorted.'''
+
+	n_factors = factors.shape[1]
+	gram = np.zeros((n_groups, n_factors, n_factors))
+	rhs = np.zeros((n_groups, n_factors))
+	chunk = max(1, max_elements//(n_factors*n_factors))
+	for start in range(0, len(groups), chunk):
+		g = groups[start:start + chunk]
+		f = factors[start:start + chunk]
+		starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+		gram[g[starts]] += np.add.reduceat(f[:, :, np.newaxis]*f[:, np.newaxis, :], starts)
+		rhs[g[starts]] += np.add.reduceat(values[start:start + chunk, np.newaxis]*f, starts)
+	return gram, rhs
+
+def _difference_penalty(n, order):
+	''' Bands of D.T D for the order-th difference matrix D of n items.  Row d holds
+		the d-th superdiagonal (padded with zeros at the end).'''
+
+	stencil = np.diff(np.eye(order + 1), n=order, axis=0)[0]
+	bands = np.zeros((order + 1, n))
+	for d in range(order + 1):
+		for t in range(order + 1 - d):
+			bands[d, t:n - order + t] += stencil[t]*stencil[t + d]
+	return bands
+
+def _banded_system(gram, reg, penalty):
+	''' Upper banded form (see scipy.linalg.solveh_banded) of the item factor system:
+		block diagonal gram + reg*I, coupled by penalty (see _difference_penalty)
+		between the same factor of items d apart.  Unknowns are ordered item by item.'''
+
+	n_items, n_factors = gram.shape[:2]
+	order = penalty.shape[0] - 1
+	u = order*n_factors
+	ab = np.zeros((u + 1, n_items*n_factors))
+	diagonal = gram + reg*np.eye(n_factors) + penalty[0][:, np.newaxis, np.newaxis]*np.eye(n_factors)
+	for o in range(n_factors):
+		for f in range(n_factors - o):
+			ab[u - o, f + o::n_factors] = diagonal[:, f, f + o]
+	for d in range(1, order + 1):
+		# entry (i*k + f, (i + d)*k + f) for i < n_items - d
+		ab[u - d*n_factors, d*n_factors:] += np.repeat(penalty[d, :n_items - d], n_factors)
+	return ab
+
+def _top_neighbors(sim, k=None, max_elements=2**22):
+	''' Top k most similar rows (other than the row itself) of every row of a square
+		similarity matrix, sorted by decreasing similarity.  The matrix (e.g., a
+		memmap) is read a tile of rows at a time and not modified, and only k
+		neighbors per row are kept.
+
+		Returns:
+			neighbors: (np.array) row by k positions of the neighbors
+			weights: (np.array) row by k similarities, 0 where undefined
+			valid: (np.array) row by k mask of neighbors with a defined similarity
+	'''
+
+	n = sim.shape[0]
+	k = n - 1 if k is None else max(0, min(k, n - 1))
+	neighbors = np.zeros((n, k), dtype=int)
+	weights = np.zeros((n, k))
+	valid = np.zeros((n, k), dtype=bool)
+	if k == 0:
+		return neighbors, weights, valid
+	chunk = max(1, max_elements//n)
+	for start in range(0, n, chunk):
+		tile = np.array(sim[start:start + chunk], dtype=float)
+		tile[np.arange(tile.shape[0]), np.arange(start, start + tile.shape[0])] = np.nan # drop row itself
+		key = np.where(np.isnan(tile), np.inf, -tile) # undefined similarities last
+		if k < n - 1:
+			top = np.argpartition(key, k - 1, axis=1)[:, :k]
+			# sort the selected neighbors by similarity, ties by position
+			top = np.take_along_axis(top, np.lexsort((top, np.take_along_axis(key, top, axis=1)), axis=1), axis=1)
+		else:
+			top = np.argsort(key, axis=1, kind='mergesort')[:, :k]
+		top_sim = np.take_along_axis(tile, top, axis=1)
+		rows = slice(start, start + tile.shape[0])
+		neighbors[rows] = top
+		valid[rows] = ~np.isnan(top_sim)
+		weights[rows] = np.where(valid[rows], top_sim, 0)
+	return neighbors, weights, valid
+
+def _neighbor_predictions(ratings, neighbors, weights, valid, max_elements=2**22):
+	''' Similarity weighted sum of the top neighbors' ratings divided by the number of
+		neighbors (see _top_neighbors()).  NaN if any neighbor is missing a rating of the item.'''
+
+	observed = ~np.isnan(ratings)
+	filled = np.where(observed, ratings, 0)
+	n_neighbors = valid.sum(axis=1)[:, np.newaxis]
+	pred = np.empty(ratings.shape)
+	chunk = max(1, max_elements//max(neighbors.shape[1]*ratings.shape[1], 1))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		for start in range(0, ratings.shape[0], chunk):
+			rows = slice(start, start + chunk)
+			pred[rows] = np.einsum('sk,ski->si', weights[rows], filled[neighbors[rows]])/n_neighbors[rows]
+			missing = np.einsum('sk,ski->si', valid[rows].astype(float), ~observed[neighbors[rows]])
+			pred[rows][missing > 0] = np.nan
+	return pred
+
+def _nanmean(x, axis=0):
+	''' Mean ignoring NaN that returns NaN (without warning) for empty slices.'''
+
+	observed = ~np.isnan(x)
+	n = observed.sum(axis=axis)
+	total = np.where(observed, x, 0).sum(axis=axis)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return total/n
+
+def _bootstrap_metrics(totals, metric):
+	''' Metrics of each resample from its sums, see BaseCF._bootstrap_stats().'''
+
+	n = totals[:, 0]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean_actual = totals[:, 2]/n
+		mean_predicted = totals[:, 3]/n
+		cov = totals[:, 6]/n - mean_actual*mean_predicted
+		var_actual = totals[:, 4]/n - mean_actual**2
+		var_predicted = totals[:, 5]/n - mean_predicted**2
+		values = {'mse': totals[:, 1]/n,
+				'corr': np.clip(cov/np.sqrt(var_actual*var_predicted), -1, 1)}
+		if totals.shape[1] > 7:
+			values['sub_corr'] = totals[:, 7]/totals[:, 8]
+	return np.column_stack([values[m] for m in metric])
+
+def _row_corr(actual, predicted, select, axis=1):
+	''' Pearson correlation of actual and predicted within each row (slice along axis) over selected cells.'''
+
+	n = select.sum(axis=axis, keepdims=True)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		a = np.where(select, actual, 0)
+		p = np.where(select, predicted, 0)
+		a = np.where(select, a - a.sum(axis=axis, keepdims=True)/n, 0)
+		p = np.where(select, p - p.sum(axis=axis, keepdims=True)/n, 0)
+		r = (a*p).sum(axis=axis)/np.sqrt((a**2).sum(axis=axis)*(p**2).sum(axis=axis))
+	return np.clip(r, -1, 1)
+
+def _row_mse(actual, predicted, select, axis=1):
+	''' Mean squared error of actual and predicted within each row (slice along axis) over selected cells.'''
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return (np.where(select, predicted - actual, 0.)**2).sum(axis=axis)/select.sum(axis=axis)
@@ -1,21 +1,233 @@
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 
-__all__ = ['create_sub_by_item_matrix']
+__all__ = ['create_sub_by_item_matrix',
+           'Ratings',
+           'RatingsTensor',
+           'dilate_samples',
+           'downsample_bins',
+           'downsample_n_samples',
+           'bin_mean',
+           'bin_any',
+           'readonly_frame']
 __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
-# class Ratings(object):
-#    def __init__():
+
+class Ratings(object):
+
+    ''' Compact array container for a subject by item ratings matrix.
+
+        Holds a C-contiguous float array of ratings, a boolean mask of observed
+        (non-NaN) cells, and separate label arrays for subjects (index) and items
+        (columns).  Models compute on these arrays and only convert to pandas at
+        the API boundary.
+
+        Args:
+            values: (np.array) subject by item ratings, NaN where missing
+            mask: (np.array) boolean mask of observed ratings (default: ~isnan(values))
+            index: (np.array) subject labels (default: range)
+            columns: (np.array) item labels (default: range)
+
+    '''
+
+    __slots__ = ('values', 'mask', 'index', 'columns')
+
+    def __init__(self, values, mask=None, index=None, columns=None):
+        self.values = np.ascontiguousarray(values, dtype=float)
+        if self.values.ndim != 2:
+            raise ValueError('values must be a 2-D subject by item array')
+        if mask is None:
+            mask = ~np.isnan(self.values)
+        self.mask = np.ascontiguousarray(mask, dtype=bool)
+        if self.mask.shape != self.values.shape:
+            raise ValueError('mask must have the same shape as values')
+        self.index = np.arange(self.values.shape[0]) if index is None else np.asarray(index)
+        self.columns = np.arange(self.values.shape[1]) if columns is None else np.asarray(columns)
+        if len(self.index) != self.values.shape[0] or len(self.columns) != self.values.shape[1]:
+            raise ValueError('index and columns must match the shape of values')
+
+    def __repr__(self):
+        return '%s(shape=%s, observed=%s)' % (
+            self.__class__.__name__,
+            self.shape,
+            int(self.mask.sum())
+            )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @classmethod
+    def from_dataframe(cls, df):
+        ''' Create a Ratings instance from a subject by item pandas dataframe.'''
+
+        if not isinstance(df, pd.DataFrame):
+            raise ValueError('df must be pandas instance')
+        return cls(df.to_numpy(dtype=float, copy=True), index=df.index.values, columns=df.columns.values)
+
+    def to_dataframe(self, values=None):
+        ''' Wrap values (default: ratings) with the subject and item labels.
+
+            Args:
+                values: (np.array) subject by item array with the same shape as ratings
+
+            Returns:
+                df: (pd.DataFrame) labelled subject by item dataframe
+
+        '''
+
+        if values is None:
+            values = self.values
+        return readonly_frame(values, self.index, self.columns)
+
+    def copy(self):
+        return self.__class__(self.values.copy(), mask=self.mask.copy(),
+                              index=self.index.copy(), columns=self.columns.copy())
+
+    def with_values(self, values, columns=None):
+        ''' Ratings of the same subjects with new values, e.g., downsampled items.'''
+
+        return self.__class__(values, index=self.index, columns=self.columns if columns is None else columns)
+
+
+class RatingsTensor(object):
+
+    ''' Compact array container for subject by item by dimension ratings, e.g.,
+        several emotion ratings (valence, arousal, ...) of the same items.
+
+        Args:
+            values: (np.array) subject by item by dimension ratings, NaN where missing
+            mask: (np.array) boolean mask of observed ratings (default: ~isnan(values))
+            index: (np.array) subject labels (default: range)
+            columns: (np.array) item labels (default: range)
+            dimensions: (np.array) dimension labels (default: range)
+
+    '''
+
+    __slots__ = ('values', 'mask', 'index', 'columns', 'dimensions')
+
+    def __init__(self, values, mask=None, index=None, columns=None, dimensions=None):
+        self.values = np.ascontiguousarray(values, dtype=float)
+        if self.values.ndim != 3:
+            raise ValueError('values must be a 3-D subject by item by dimension array')
+        if mask is None:
+            mask = ~np.isnan(self.values)
+        self.mask = np.ascontiguousarray(mask, dtype=bool)
+        if self.mask.shape != self.values.shape:
+            raise ValueError('mask must have the same shape as values')
+        n_subjects, n_items, n_dimensions = self.values.shape
+        self.index = np.arange(n_subjects) if index is None else np.asarray(index)
+        self.columns = np.arange(n_items) if columns is None else np.asarray(columns)
+        self.dimensions = np.arange(n_dimensions) if dimensions is None else np.asarray(dimensions)
+        if (len(self.index), len(self.columns), len(self.dimensions)) != self.values.shape:
+            raise ValueError('index, columns and dimensions must match the shape of values')
+
+    def __repr__(self):
+        return '%s(shape=%s, dimensions=%s)' % (
+            self.__class__.__name__,
+            self.shape,
+            list(self.dimensions)
+            )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @classmethod
+    def from_dataframes(cls, ratings):
+        ''' Stack subject by item dataframes into a tensor.
+
+            Args:
+                ratings: (dict) {dimension: pd.DataFrame}.  All dataframes are aligned
+                         to the subjects and items of the first one.
+
+        '''
+
+        if not isinstance(ratings, dict) or not len(ratings):
+            raise ValueError('ratings must be a dictionary of pandas dataframes')
+        dimensions = list(ratings.keys())
+        first = ratings[dimensions[0]]
+        for df in ratings.values():
+            if not isinstance(df, pd.DataFrame):
+                raise ValueError('ratings must be a dictionary of pandas dataframes')
+        values = np.stack([ratings[d].reindex(index=first.index, columns=first.columns).to_numpy(dtype=float)
+                           for d in dimensions], axis=2)
+        return cls(values, index=first.index.values, columns=first.columns.values, dimensions=dimensions)
+
+    @classmethod
+    def from_long_df(cls, df, dimension='Dimension'):
+        ''' Create a tensor from a long format dataframe.
+
+            Args:
+                df: pandas dataframe instance.  Must have column names ['Subject','Item','Rating',dimension]
+                dimension: (str) name of the column holding the rating dimension
+
+        '''
+
+        if not isinstance(df, pd.DataFrame):
+            raise ValueError('df must be pandas instance')
+        if np.any([not x in df.columns for x in ['Subject','Item','Rating',dimension]]):
+            raise ValueError("df must contain ['Subject','Item','Rating','%s'] as column names" % dimension)
+        wide = df.pivot_table(index='Subject', columns=[dimension, 'Item'], values='Rating', aggfunc='mean')
+        return cls.from_dataframes(dict((d, wide[d].astype(float)) for d in wide.columns.levels[0]
+                                        if d in wide.columns.get_level_values(0)))
+
+    def to_dataframes(self, values=None):
+        ''' Split values (default: ratings) into a {dimension: pd.DataFrame} dictionary.'''
+
+        if values is None:
+            values = self.values
+        return OrderedDict((d, readonly_frame(values[:, :, i], self.index, self.columns))
+                           for i, d in enumerate(self.dimensions))
+
+    def dimension(self, dimension):
+        ''' Ratings of a single dimension.'''
+
+        i = list(self.dimensions).index(dimension)
+        return Ratings(self.values[:, :, i], mask=self.mask[:, :, i], index=self.index, columns=self.columns)
+
+    def copy(self):
+        return self.__class__(self.values.copy(), mask=self.mask.copy(), index=self.index.copy(),
+                              columns=self.columns.copy(), dimensions=self.dimensions.copy())
+
+    def with_values(self, values, columns=None):
+        ''' Ratings of the same subjects and dimensions with new values, e.g., downsampled items.'''
+
+        return self.__class__(values, index=self.index, columns=self.columns if columns is None else columns,
+                              dimensions=self.dimensions)
+
+
+def readonly_frame(values, index=None, columns=None):
+
+    ''' Wrap an array in a dataframe without copying it.  The dataframe is a
+        read-only view, so in-place writes (e.g., df.iloc[i, j] = x) raise a
+        ValueError instead of silently bypassing the state derived from the
+        array.  Use df.copy() to get a writable dataframe.
+
+        Args:
+            values: (np.array) 2-D array
+            index: row labels
+            columns: column labels
+
+        Returns:
+            df: (pd.DataFrame) read-only view of values
+
+    '''
+
+    view = values.view()
+    view.flags.writeable = False
+    return pd.DataFrame(view, index=index, columns=columns, copy=False)
 
 
 def create_sub_by_item_matrix(df):
 
     ''' Convert a pandas long data frame of a single rating into a subject by item matrix
-    
+
         Args:
             df: pandas dataframe instance.  Must have column names ['Subject','Item','Rating]
-            
+
     '''
 
     if not isinstance(df,pd.DataFrame):
@@ -27,3 +239,119 @@ def create_sub_by_item_matrix(df):
     ratings = df.pivot(index='Subject', columns='Item', values='Rating').reset_index(drop=True)
     return ratings.astype(float)
 
+
+def dilate_samples(values, n_samples):
+
+    ''' Dilate each rating by n samples (centered) along the item axis.  If dilated
+        samples are overlapping they will be averaged.
+
+        Args:
+            values: (np.array) subject by item ratings, NaN where missing
+            n_samples: (int) number of samples to dilate each rating
+
+        Returns:
+            dilated: (np.array) ratings with each rating dilated n_samples, NaN where
+                     no rating falls within the window
+
+    '''
+
+    values = np.atleast_2d(values)
+    observed = ~np.isnan(values)
+    n_items = values.shape[1]
+
+    # Equivalent to np.convolve(x, np.ones(n_samples), mode='same') on each row
+    lo = np.clip(np.arange(n_items) - n_samples//2, 0, n_items)
+    hi = np.clip(np.arange(n_items) + (n_samples - 1)//2 + 1, 0, n_items)
+    pad = np.zeros((values.shape[0], 1))
+    sums = np.hstack([pad, np.cumsum(np.where(observed, values, 0), axis=1)])
+    counts = np.hstack([pad, np.cumsum(observed, axis=1)])
+    n = counts[:, hi] - counts[:, lo]
+    dilated = np.full(values.shape, np.nan)
+    np.divide(sums[:, hi] - sums[:, lo], n, out=dilated, where=n >= 1)
+    return dilated
+
+
+def downsample_n_samples(sampling_freq, target, target_type='samples'):
+
+    ''' Number of samples averaged into each bin when downsampling.
+
+        Args:
+            sampling_freq:  Sampling frequency of data
+            target: downsampling target
+            target_type: type of target can be [samples,seconds,hz]
+
+        Returns:
+            n_samples: number of samples per bin
+
+    '''
+
+    if target_type == 'samples':
+        return target
+    elif target_type == 'seconds':
+        return target*sampling_freq
+    elif target_type == 'hz':
+        return sampling_freq/target
+    raise ValueError('Make sure target_type is "samples", "seconds", or "hz".')
+
+
+def downsample_bins(n_items, n_samples):
+
+    ''' Bin labels for averaging consecutive items into groups of n_samples.
+        Any remaining items are assigned to a final bin.
+
+        Args:
+            n_items: (int) number of items (time samples)
+            n_samples: (int) number of samples per bin
+
+        Returns:
+            bins: (np.array) bin label for each item
+
+    '''
+
+    bins = np.sort(np.repeat(np.arange(1, n_items/n_samples, 1), n_samples))
+    if n_items > len(bins):
+        bins = np.concatenate([bins, np.repeat(bins[-1]+1 if len(bins) else 1, n_items-len(bins))])
+    return bins[:n_items]
+
+
+def _bin_starts(bins):
+    return np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+
+
+def bin_mean(values, bins):
+
+    ''' Average ratings within contiguous bins of items, ignoring NaN.
+
+        Args:
+            values: (np.array) subject by item (by dimension) ratings
+            bins: (np.array) sorted bin label for each item, see downsample_bins()
+
+        Returns:
+            binned: (np.array) subject by bin (by dimension) averages, NaN where a bin has no ratings
+            labels: (np.array) label of each bin
+
+    '''
+
+    starts = _bin_starts(bins)
+    observed = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(observed, values, 0), starts, axis=1)
+    counts = np.add.reduceat(observed.astype(int), starts, axis=1)
+    binned = np.full(sums.shape, np.nan)
+    np.divide(sums, counts, out=binned, where=counts > 0)
+    return binned, bins[starts]
+
+
+def bin_any(mask, bins):
+
+    ''' Combine a boolean mask within contiguous bins of items.
+
+        Args:
+            mask: (np.array) subject by item (by dimension) boolean mask
+            bins: (np.array) sorted bin label for each item, see downsample_bins()
+
+        Returns:
+            binned: (np.array) True where any item within the bin is True
+
+    '''
+
+    return np.logical_or.reduceat(mask, _bin_starts(bins), axis=1)
@@ -0,0 +1,247 @@
+from __future__ import division
+import numpy as np
+from timeit import default_timer as timer
+
+__all__ = ['multiplicative_updates',
+           'multiplicative_updates_blocks']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+def multiplicative_updates(masked_X, mask, W, H, max_iterations=100, fit_error_limit=1e-6,
+                           n_blocks=2, client=None, callback=None, verbose=False, eps=1e-5):
+
+    ''' Masked NNMF multiplicative updates (X ~= WH) on row blocks of in-memory
+        ratings.  The arrays are split into n_blocks row blocks that are sent to
+        the workers, see multiplicative_updates_blocks().  Ratings larger than
+        the memory of one machine should be passed to
+        multiplicative_updates_blocks() as blocks that the workers load themselves.
+
+        Args:
+            masked_X: (np.array) subject by item ratings, 0 where masked
+            mask: (np.array) subject by item mask of training cells
+            W: (np.array) initial subject by factor matrix
+            H: (np.array) initial factor by item matrix
+            max_iterations (int): maximum number of interations (default=100)
+            fit_error_limit (float): stop once the change in fit falls below it (default=1e-6)
+            n_blocks: (int) number of row blocks (default=2)
+            client: dask.distributed Client to run the workers as actors on
+                    (default: one local process per block)
+            callback: function(iteration, duration, fit_residual) called after every iteration
+            verbose (bool): print the fit residual every 10 iterations
+            eps: (float) lower bound of W and H
+
+        Returns:
+            W: (np.array) fitted subject by factor matrix
+            H: (np.array) fitted factor by item matrix
+
+    '''
+
+    blocks = [(masked_X[b], mask[b], W[b]) for b in np.array_split(np.arange(masked_X.shape[0]), n_blocks)
+              if len(b)]
+    return multiplicative_updates_blocks(blocks, H, max_iterations=max_iterations,
+                                         fit_error_limit=fit_error_limit, client=client,
+                                         callback=callback, verbose=verbose, eps=eps)
+
+
+def multiplicative_updates_blocks(blocks, H, max_iterations=100, fit_error_limit=1e-6,
+                                  client=None, callback=None, verbose=False, eps=1e-5):
+
+    ''' Masked NNMF multiplicative updates (X ~= WH) on row blocks of the ratings,
+        each held by its own worker.
+
+        Every iteration a worker updates its rows of W with the current H and
+        returns its partial products W_b.T @ X_b and W_b.T @ (M_b * W_b @ H),
+        which are summed to update H.  Only H and the partial products
+        (n_factors by n_items) are exchanged, the ratings and mask never leave
+        the workers, and W is gathered (subjects by factors) at the end.  A
+        block is given as arrays, as paths of .npy files, which the worker
+        memory-maps, or as a function the worker calls to load its block, so
+        the ratings do not need to fit in the memory of the calling process.
+        The updates are the same as the dense updates of NNMF_multiplicative.fit().
+
+        Args:
+            blocks: (list) row blocks of the ratings, each a tuple (masked_X, mask, W) of the
+                    block's ratings (0 where masked), training mask and initial factors, as
+                    np.arrays or .npy paths, or a picklable function returning such a tuple
+            H: (np.array) initial factor by item matrix
+            max_iterations (int): maximum number of interations (default=100)
+            fit_error_limit (float): stop once the change in fit falls below it (default=1e-6)
+            client: dask.distributed Client to run the workers as actors on
+                    (default: one local process per block)
+            callback: function(iteration, duration, fit_residual) called after every iteration
+            verbose (bool): print the fit residual every 10 iterations
+            eps: (float) lower bound of W and H
+
+        Returns:
+            W: (np.array) fitted subject by factor matrix, the blocks stacked in order
+            H: (np.array) fitted factor by item matrix
+
+    '''
+
+    if client is None:
+        workers = [_ProcessActor(b, eps) for b in blocks]
+    else:
+        workers = [_DaskActor(client, b, eps) for b in blocks]
+
+    H = np.array(H, dtype=float)
+    try:
+        converged = False
+        ctr = 1
+        while ctr <= max_iterations:
+            tic = timer()
+            # Update W of each block, and the residual of the previous iteration
+            results = _gather([w.call('step', H) for w in workers])
+            if ctr > 1:
+                fit_residual = np.sqrt(sum(r[0] for r in results))
+                _report(ctr - 1, duration, fit_residual, callback, verbose)
+                if fit_residual < fit_error_limit:
+                    # stop after the previous iteration, as the dense updates do
+                    _gather([w.call('rollback') for w in workers])
+                    converged = True
+                    break
+
+            # Update H from the summed partial products
+            H *= sum(r[1] for r in results) / sum(r[2] for r in results)
+            H = np.maximum(H, eps)
+            duration = timer() - tic
+            ctr += 1
+
+        results = _gather([w.call('finish', H) for w in workers])
+        if not converged and ctr > 1:
+            _report(ctr - 1, duration, np.sqrt(sum(r[0] for r in results)), callback, verbose)
+        W = np.vstack([r[1] for r in results])
+    finally:
+        for w in workers:
+            w.close()
+    return W, H
+
+
+def _report(iteration, duration, fit_residual, callback, verbose):
+    if iteration % 10 == 0 and verbose:
+        print('\tCurrent Iteration {}:'.format(iteration))
+        print('\tfit residual', np.round(fit_residual, 4))
+    if callback is not None:
+        callback(iteration, duration, fit_residual)
+
+
+def _load_block(block):
+    ''' Arrays of a block given as arrays, .npy paths or a loading function.'''
+
+    if callable(block):
+        block = block()
+    masked_X, mask, W = block
+    if isinstance(masked_X, str):
+        masked_X = np.load(masked_X, mmap_mode='r')
+    if isinstance(mask, str):
+        mask = np.load(mask, mmap_mode='r')
+    if isinstance(W, str):
+        W = np.load(W)
+    return masked_X, mask, np.array(W, dtype=float)
+
+
+class _BlockWorker(object):
+
+    ''' Row block of the ratings, mask and W.'''
+
+    def __init__(self, block, eps):
+        self.X, self.mask, self.W = _load_block(block)
+        self.eps = eps
+        self._W_prev = None
+        self._estimate = None
+
+    def _residual(self, H):
+        estimate = np.dot(self.W, H)
+        residual = None
+        if self._estimate is not None:
+            residual = np.sum((self.mask * (self._estimate - estimate))**2)
+        self._estimate = estimate
+        return residual
+
+    def step(self, H):
+        residual = self._residual(H)
+        self._W_prev = self.W
+        self.W = self.W * np.dot(self.X, H.T) / np.dot(self.mask * np.dot(self.W, H), H.T)
+        self.W = np.maximum(self.W, self.eps)
+        WH = self.mask * np.dot(self.W, H)
+        return residual, np.dot(self.W.T, self.X), np.dot(self.W.T, WH)
+
+    def rollback(self):
+        self.W = self._W_prev
+
+    def finish(self, H):
+        return self._residual(H), self.W
+
+
+def _gather(futures):
+    return [f.result() for f in futures]
+
+
+def _actor_loop(conn, args):
+    ''' Serve method calls on a _BlockWorker until None is received.'''
+
+    try:
+        worker, error = _BlockWorker(*args), None
+    except Exception as e:
+        # e.g., the block can not be loaded, raised by every call
+        worker, error = None, e
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        name, call_args = message
+        try:
+            if error is not None:
+                raise error
+            conn.send((True, getattr(worker, name)(*call_args)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+
+class _ProcessActor(object):
+
+    ''' _BlockWorker in its own local process.  call() sends a request and
+        returns a handle, so requests to several actors run in parallel.'''
+
+    def __init__(self, *args):
+        from multiprocessing import Process, Pipe
+        self._conn, child = Pipe()
+        self._process = Process(target=_actor_loop, args=(child, args))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+
+    def call(self, name, *args):
+        self._conn.send((name, args))
+        return self
+
+    def result(self):
+        ok, value = self._conn.recv()
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except (OSError, EOFError):
+            pass
+        self._process.join()
+
+
+class _DaskActor(object):
+
+    ''' _BlockWorker as an actor on a dask.distributed cluster.'''
+
+    def __init__(self, client, *args):
+        self._future = client.submit(_BlockWorker, *args, actor=True)
+        self._actor = self._future.result()
+
+    def call(self, name, *args):
+        return getattr(self._actor, name)(*args)
+
+    def close(self):
+        # cancelling the key deletes the actor on its worker, even if a handle is still referenced
+        self._future.cancel()
+        self._future = self._actor = None
@@ -0,0 +1,194 @@
+from __future__ import division
+import os
+import shutil
+import tempfile
+import numpy as np
+from timeit import default_timer as timer
+from .cf import BaseCF, NNMF_multiplicative
+from .data import Ratings
+
+__all__ = ['Ensemble']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+# Read-only data of a replica worker process, set once by the pool initializer
+_shared = {}
+
+
+class Ensemble(BaseCF):
+
+    ''' Ensemble of seeded replicas of a cf model, e.g., NNMF_multiplicative or
+        NNMF_sgd whose fits depend on random initialization and shuffle order.
+
+        Replicas are fit in a process pool.  The ratings and masks are written
+        once to temporary .npy files that every worker memory-maps read-only,
+        so only the file paths are sent to the workers and the operating
+        system shares one copy between them.  Replicas read these arrays
+        without copying them; each replica only allocates the arrays derived
+        during its fit (e.g., its masked ratings and factors).  Predictions
+        are averaged with a running mean as replicas finish, so only the mean
+        and variance are kept rather than one matrix per replica.  The
+        standard deviation across replicas of every cell is kept in
+        `prediction_std` and its mean in `disagreement`.
+
+        Args:
+            ratings: (pd.DataFrame) subject by item ratings
+            model: cf class of the replicas (default=NNMF_multiplicative)
+            mask: (pd.DataFrame) training mask
+            n_train_items: (int) number of items per subject to use for training
+
+    '''
+
+    def __init__(self, ratings, model=NNMF_multiplicative, mask=None, n_train_items=None):
+        if not (isinstance(model, type) and issubclass(model, BaseCF)):
+            raise ValueError('model must be a cf class, e.g., NNMF_multiplicative')
+        super(Ensemble, self).__init__(ratings, mask, n_train_items)
+        self.model = model
+        self.seeds = None
+        self.disagreement = None
+        self._mean = None
+        self._std = None
+
+    def __repr__(self):
+        return '%s(model=%s, rating=%s)' % (
+            self.__class__.__name__,
+            self.model.__name__,
+            self._data.shape
+            )
+
+    @property
+    def prediction_std(self):
+        if self._std is None:
+            return None
+        return self._data.to_dataframe(self._std)
+
+    def fit(self, n_models=10, n_jobs=1, seed=None, temp_folder=None, **kwargs):
+
+        ''' Fit n_models replicas of the model, each with its own random seed.
+
+        Args:
+            n_models: (int) number of replicas
+            n_jobs: (int) number of worker processes, -1 uses all cores (default=1)
+            seed: (int) seed used to draw the seed of every replica (stored in `seeds`)
+            temp_folder: (str) folder of the memory-mapped ratings shared with the worker
+                         processes, removed after fitting (default: system temp folder)
+            kwargs: arguments passed to the fit() of every replica, e.g., n_factors or n_iterations
+
+        '''
+
+        if n_models < 1:
+            raise ValueError('n_models must be at least 1')
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+
+        self._fit_begin()
+        if kwargs.get('dilate_ts_n_samples') is not None:
+            # evaluate on the same dilated training cells as the replicas
+            self._dilate_ts_rating_samples(n_samples=kwargs['dilate_ts_n_samples'])
+
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        self.seeds = rng.randint(np.iinfo(np.int32).max, size=n_models)
+        train_mask = self._train_mask if self.is_mask else None
+        shared = (self._data.values, self._data.mask, self._data.index, self._data.columns, train_mask)
+        tasks = [(s, kwargs) for s in self.seeds]
+
+        mean = np.zeros(self._data.shape)
+        m2 = np.zeros(self._data.shape)
+        with self._phase('replicas'):
+            if n_jobs == 1 or n_models == 1:
+                _init_worker(self.model, *shared)
+                # the replicas seed the global random state, restore the caller's
+                state = np.random.get_state()
+                try:
+                    results = (_fit_replica(t) for t in tasks)
+                    for n, (pred, duration) in enumerate(results, 1):
+                        mean, m2 = self._accumulate(n, pred, duration, mean, m2)
+                finally:
+                    np.random.set_state(state)
+                    _shared.clear()
+            else:
+                from multiprocessing import Pool
+                folder = tempfile.mkdtemp(prefix='emotioncf_', dir=temp_folder)
+                try:
+                    paths = []
+                    for name, values in zip(['ratings', 'mask', None, None, 'train_mask'], shared):
+                        if name is None or values is None:
+                            paths.append(values) # labels, or no training mask
+                        else:
+                            paths.append(os.path.join(folder, name + '.npy'))
+                            np.save(paths[-1], values)
+                    pool = Pool(processes=min(n_jobs, n_models), initializer=_init_worker,
+                                initargs=(self.model,) + tuple(paths))
+                    try:
+                        for n, (pred, duration) in enumerate(pool.imap_unordered(_fit_replica, tasks), 1):
+                            mean, m2 = self._accumulate(n, pred, duration, mean, m2)
+                    finally:
+                        pool.terminate()
+                        pool.join()
+                finally:
+                    shutil.rmtree(folder, ignore_errors=True)
+
+        self._mean = mean
+        self._std = np.sqrt(m2/(n_models - 1)) if n_models > 1 else np.zeros(self._data.shape)
+        self.disagreement = np.nanmean(self._std)
+        self._record_arrays(predicted_ratings=mean, prediction_std=self._std)
+        self.is_fit = True
+
+    def _accumulate(self, n, pred, duration, mean, m2):
+        ''' Welford update of the running mean and sum of squared deviations with replica n.'''
+
+        delta = pred - mean
+        mean += delta/n
+        m2 += delta*(pred - mean)
+        if self._callbacks:
+            self._record_iteration(n, duration)
+        return mean, m2
+
+    def predict(self):
+
+        ''' Predict missing items with the mean prediction of the replicas.
+
+            Returns:
+                predicted_rating: (pd.DataFrame instance) adds field to object instance
+
+        '''
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+
+        self._predicted = self._mean.copy()
+        self.is_predict = True
+
+
+def _init_worker(model, values, mask, index, columns, train_mask):
+    ''' Set the shared data of a replica worker.  values, mask and train_mask are
+        arrays or paths of .npy files, both are shared as read-only arrays.'''
+
+    _shared['model'] = model
+    _shared['ratings'] = Ratings(_read_only(values), mask=_read_only(mask), index=index, columns=columns)
+    _shared['mask'] = None if train_mask is None else _read_only(train_mask)
+
+
+def _read_only(values):
+    ''' Read-only view of an array, or of a memory-mapped .npy file.'''
+
+    if isinstance(values, str):
+        return np.load(values, mmap_mode='r')
+    values = np.asarray(values).view()
+    values.flags.writeable = False
+    return values
+
+
+def _fit_replica(task):
+    ''' Fit and predict one replica of the shared ratings with its own seed.  The
+        replica reads the shared read-only arrays without copying them.'''
+
+    seed, kwargs = task
+    tic = timer()
+    np.random.seed(seed)
+    cf = _shared['model'](_shared['ratings'])
+    if _shared['mask'] is not None:
+        cf._set_train_mask(_shared['mask'])
+    cf.fit(**kwargs)
+    cf.predict()
+    return cf._predicted, timer() - tic
@@ -0,0 +1,217 @@
+from __future__ import division
+import numpy as np
+
+__all__ = ['mean_impute',
+           'randomized_svd',
+           'nndsvd',
+           'estimate_rank',
+           'fold_in_multiplicative',
+           'fold_in_biased']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+def mean_impute(values, mask):
+
+    ''' Fill the unobserved cells of a ratings matrix with the item (column) means
+        of the observed cells.  Items without any observed cell get the overall mean.
+
+        Args:
+            values: (np.array) subject by item ratings
+            mask: (np.array) boolean mask of observed (e.g., training) cells
+
+        Returns:
+            imputed: (np.array) subject by item ratings without missing values
+
+    '''
+
+    mask = mask & ~np.isnan(values)
+    filled = np.where(mask, values, 0)
+    n = mask.sum(axis=0)
+    overall = filled.sum()/max(mask.sum(), 1)
+    item_mean = np.divide(filled.sum(axis=0), n, out=np.full(len(n), overall), where=n > 0)
+    return np.where(mask, values, item_mean)
+
+
+def randomized_svd(X, n_components, n_oversamples=10, n_iter=4):
+
+    ''' Truncated singular value decomposition using randomized range finding
+        (Halko, Martinsson & Tropp, 2011).
+
+        Args:
+            X: (np.array) matrix to decompose
+            n_components: (int) number of singular values and vectors to keep
+            n_oversamples: (int) additional random vectors to improve accuracy (default=10)
+            n_iter: (int) number of power iterations (default=4)
+
+        Returns:
+            U: (np.array) left singular vectors, n_rows by n_components
+            S: (np.array) singular values
+            Vt: (np.array) right singular vectors, n_components by n_columns
+
+    '''
+
+    n_random = min(n_components + n_oversamples, min(X.shape))
+    Q = np.dot(X, np.random.normal(size=(X.shape[1], n_random)))
+    for _ in range(n_iter):
+        # Re-orthonormalize between multiplications to keep small singular values
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(np.dot(X.T, Q))
+        Q = np.dot(X, Q)
+    Q, _ = np.linalg.qr(Q)
+    U, S, Vt = np.linalg.svd(np.dot(Q.T, X), full_matrices=False)
+    return np.dot(Q, U[:, :n_components]), S[:n_components], Vt[:n_components]
+
+
+def nndsvd(X, n_components, variant='nndsvd', eps=1e-6):
+
+    ''' Nonnegative Double Singular Value Decomposition initialization of X ~= WH
+        (Boutsidis & Gallopoulos, 2008).
+
+        Args:
+            X: (np.array) nonnegative matrix without missing values
+            n_components: (int) number of factors
+            variant: (str) 'nndsvd' keeps zeros, 'nndsvda' fills zeros with the mean of X
+            eps: (float) values below eps are set to zero
+
+        Returns:
+            W: (np.array) n_rows by n_components
+            H: (np.array) n_components by n_columns
+
+    '''
+
+    if variant not in ['nndsvd', 'nndsvda']:
+        raise ValueError("variant must be ['nndsvd','nndsvda']")
+
+    U, S, Vt = randomized_svd(X, n_components)
+    W = np.zeros((X.shape[0], n_components))
+    H = np.zeros((n_components, X.shape[1]))
+
+    # The leading singular vectors of a nonnegative matrix can be chosen nonnegative
+    W[:, 0] = np.sqrt(S[0])*np.abs(U[:, 0])
+    H[0] = np.sqrt(S[0])*np.abs(Vt[0])
+    for j in range(1, len(S)):
+        x, y = U[:, j], Vt[j]
+        x_p, y_p = np.maximum(x, 0), np.maximum(y, 0)
+        x_n, y_n = np.abs(np.minimum(x, 0)), np.abs(np.minimum(y, 0))
+        norms_p = np.linalg.norm(x_p), np.linalg.norm(y_p)
+        norms_n = np.linalg.norm(x_n), np.linalg.norm(y_n)
+
+        # keep the dominating positive or negative part of the singular vector pair
+        if norms_p[0]*norms_p[1] > norms_n[0]*norms_n[1]:
+            (u, v), (u_norm, v_norm) = (x_p, y_p), norms_p
+        else:
+            (u, v), (u_norm, v_norm) = (x_n, y_n), norms_n
+        if u_norm*v_norm == 0:
+            continue
+        scale = np.sqrt(S[j]*u_norm*v_norm)
+        W[:, j] = scale*u/u_norm
+        H[j] = scale*v/v_norm
+
+    W[W < eps] = 0
+    H[H < eps] = 0
+    if variant == 'nndsvda':
+        avg = X.mean()
+        W[W == 0] = avg
+        H[H == 0] = avg
+    return W, H
+
+
+def estimate_rank(X, max_rank=50):
+
+    ''' Estimate the number of factors of a noisy low-rank matrix by hard thresholding
+        its singular values (Gavish & Donoho, 2014).  Only the top max_rank singular
+        values are computed with randomized_svd(), so the cost is that of a truncated
+        SVD rather than a full one.  If these are all singular values of X they are
+        thresholded at the optimal threshold for unknown noise, otherwise the noise
+        level is estimated from the energy of X outside the top components and the
+        optimal threshold for known noise is used.  On mean-imputed ratings with many
+        missing cells the imputation error tends to add components, so this is an
+        upper estimate rather than an exact rank.
+
+        Args:
+            X: (np.array) matrix without missing values
+            max_rank: (int) largest rank that can be estimated (default=50)
+
+        Returns:
+            rank: (int) number of singular values above the threshold (at least 1, at most max_rank)
+
+    '''
+
+    k = min(max_rank, min(X.shape))
+    S = randomized_svd(X, k)[1]
+    beta = min(X.shape)/max(X.shape)
+    if k == min(X.shape):
+        omega = 0.56*beta**3 - 0.95*beta**2 + 1.82*beta + 1.43
+        threshold = omega*np.median(S)
+    else:
+        sigma = np.sqrt(max(np.sum(X**2) - np.sum(S**2), 0)/((X.shape[0] - k)*(X.shape[1] - k)))
+        lam = np.sqrt(2*(beta + 1) + 8*beta/(beta + 1 + np.sqrt(beta**2 + 14*beta + 1)))
+        threshold = lam*np.sqrt(max(X.shape))*sigma
+    return max(1, int(np.sum(S > threshold)))
+
+
+def fold_in_multiplicative(masked_X, mask, H, W=None, n_iterations=50, eps=1e-5):
+
+    ''' Fit the subject factors W of X ~= WH with the item factors H held fixed,
+        using the masked multiplicative updates of NNMF_multiplicative.
+
+        Args:
+            masked_X: (np.array) subject by item ratings, 0 where masked
+            mask: (np.array) subject by item mask of observed cells
+            H: (np.array) factor by item matrix
+            W: (np.array) initial subject by factor matrix (default: constant)
+            n_iterations: (int) number of updates (default=50)
+            eps: (float) lower bound of W
+
+        Returns:
+            W: (np.array) subject by factor matrix
+
+    '''
+
+    if W is None:
+        observed = mask.sum()
+        avg = np.sqrt((masked_X.sum()/observed if observed else 1)/H.shape[0])
+        W = np.full((masked_X.shape[0], H.shape[0]), max(avg, eps))
+    else:
+        W = W.copy()
+    for _ in range(n_iterations):
+        W *= np.dot(masked_X, H.T) / np.dot(mask * np.dot(W, H), H.T)
+        W = np.maximum(W, eps)
+    return W
+
+
+def fold_in_biased(residual, mask, item_vecs, reg_vecs=0.0, reg_bias=0.0):
+
+    ''' Least squares subject bias and latent vector of r - b - b_i ~= b_u + u.v_i
+        with the item vectors held fixed, one subject at a time.  Regularization is
+        added as in NNMF_sgd; rank deficient systems (e.g., few rated items) get
+        the minimum norm solution.
+
+        Args:
+            residual: (np.array) subject by item ratings minus global and item biases
+            mask: (np.array) subject by item mask of observed cells
+            item_vecs: (np.array) item by factor matrix
+            reg_vecs: (float) regularization of the subject vectors
+            reg_bias: (float) regularization of the subject biases
+
+        Returns:
+            user_bias: (np.array) bias of each subject
+            user_vecs: (np.array) subject by factor matrix
+
+    '''
+
+    n_factors = item_vecs.shape[1]
+    design = np.hstack([np.ones((item_vecs.shape[0], 1)), item_vecs])
+    penalty = np.sqrt(np.diag(np.r_[reg_bias, np.full(n_factors, reg_vecs)]))
+    user_bias = np.zeros(residual.shape[0])
+    user_vecs = np.zeros((residual.shape[0], n_factors))
+    for s in range(residual.shape[0]):
+        observed = mask[s]
+        if not observed.any():
+            continue
+        A = np.vstack([design[observed], penalty])
+        b = np.r_[residual[s, observed], np.zeros(n_factors + 1)]
+        x = np.linalg.lstsq(A, b, rcond=None)[0]
+        user_bias[s], user_vecs[s] = x[0], x[1:]
+    return user_bias, user_vecs
@@ -0,0 +1,214 @@
+'''
+Predict-only models that depend on NumPy alone.
+
+A fitted cf model is exported with its save() method (or to_predictor()) and
+loaded here without importing pandas, scipy or the plotting libraries, e.g.,
+to serve predictions:
+
+    from emotioncf.predictor import Predictor
+    model = Predictor.load('model.npz')
+    model.predict_cells([0, 1], [5, 5])
+
+'''
+
+from __future__ import division
+import numpy as np
+from .factorization import fold_in_multiplicative, fold_in_biased
+
+__all__ = ['Predictor']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+# arrays required by each kind of exported model
+_KINDS = {'table': ['predicted'],
+          'mean': ['item_mean'],
+          'knn_item': ['ratings', 'item_neighbors', 'item_weights', 'item_mean'],
+          'nnmf': ['W', 'H'],
+          'sgd': ['global_bias', 'user_bias', 'item_bias', 'user_vecs', 'item_vecs',
+                  'user_fact_reg', 'user_bias_reg']}
+
+
+class Predictor(object):
+
+    ''' Predictions of a fitted cf model from its exported arrays.
+
+        Args:
+            kind: (str) type of model {'table','mean','knn_item','nnmf','sgd'}
+            index: (np.array) subject labels
+            columns: (np.array) item labels
+            arrays: model arrays of the kind, see BaseCF.to_predictor()
+
+    '''
+
+    def __init__(self, kind, index, columns, **arrays):
+        if kind not in _KINDS:
+            raise ValueError('kind must be %s' % sorted(_KINDS))
+        missing = [a for a in _KINDS[kind] if a not in arrays]
+        if missing:
+            raise ValueError('Missing arrays for %s model: %s' % (kind, missing))
+        self.kind = kind
+        self.index = _labels(index)
+        self.columns = _labels(columns)
+        self.arrays = dict((a, np.asarray(arrays[a])) for a in _KINDS[kind])
+        self._subjects = dict((s, i) for i, s in enumerate(self.index.tolist()))
+        self._items = dict((s, i) for i, s in enumerate(self.columns.tolist()))
+
+    def __repr__(self):
+        return '%s(kind=%s, shape=%s)' % (
+            self.__class__.__name__,
+            self.kind,
+            self.shape
+            )
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def save(self, path):
+        ''' Save the model to a .npz file (the extension is added if missing).
+
+            Args:
+                path: (str) file name
+
+        '''
+
+        np.savez(path, kind=np.array(self.kind), index=self.index, columns=self.columns, **self.arrays)
+
+    @classmethod
+    def load(cls, path):
+        ''' Load a model saved with save().
+
+            Args:
+                path: (str) .npz file name
+
+            Returns:
+                model: Predictor instance
+
+        '''
+
+        with np.load(path, allow_pickle=False) as f:
+            arrays = dict((k, f[k]) for k in f.files)
+        return cls(str(arrays.pop('kind')), arrays.pop('index'), arrays.pop('columns'), **arrays)
+
+    def subject_positions(self, subjects):
+        ''' Positions of subject labels in the ratings.'''
+        return _positions(self._subjects, subjects, 'Subject')
+
+    def item_positions(self, items):
+        ''' Positions of item labels in the ratings.'''
+        return _positions(self._items, items, 'Item')
+
+    def predict(self, subjects=None, items=None):
+        ''' Predicted ratings of the fitted subjects.
+
+            Args:
+                subjects: subject labels (default: all subjects)
+                items: item labels (default: all items)
+
+            Returns:
+                predicted: (np.array) subject by item predicted ratings
+
+        '''
+
+        rows = np.arange(self.shape[0]) if subjects is None else self.subject_positions(subjects)
+        cols = np.arange(self.shape[1]) if items is None else self.item_positions(items)
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+        return self.predict_cells(rows.ravel(), cols.ravel()).reshape(rows.shape)
+
+    def predict_cells(self, rows, cols):
+        ''' Predicted ratings of the fitted subjects for arrays of subject and item positions.
+
+            Args:
+                rows: (np.array) subject positions
+                cols: (np.array) item positions
+
+            Returns:
+                predicted: (np.array) predicted rating of every (row, col) cell
+
+        '''
+
+        rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        a = self.arrays
+        if self.kind == 'table':
+            return a['predicted'][rows, cols]
+        elif self.kind == 'mean':
+            return a['item_mean'][cols]
+        elif self.kind == 'knn_item':
+            return self._neighbor_mean(a['ratings'], rows, cols)
+        elif self.kind == 'nnmf':
+            return np.sum(a['W'][rows] * a['H'][:, cols].T, axis=1)
+        else:
+            return (a['global_bias'] + a['user_bias'][rows] + a['item_bias'][cols] +
+                    np.sum(a['user_vecs'][rows] * a['item_vecs'][cols], axis=1))
+
+    def predict_new(self, ratings, n_iterations=50):
+        ''' Predict all items of new subjects from their observed ratings, without refitting.
+            Item-based KNN uses the new subject's ratings of each item's neighbors, the
+            factorization models fold the subject into the fitted item factors.
+
+            Args:
+                ratings: (np.array) new subject by item ratings, NaN if unrated
+                n_iterations: (int) number of multiplicative updates of an 'nnmf' fold-in
+
+            Returns:
+                predicted: (np.array) new subject by item predicted ratings
+
+        '''
+
+        ratings = np.atleast_2d(np.asarray(ratings, dtype=float))
+        if ratings.shape[1] != self.shape[1]:
+            raise ValueError('ratings must have %s items' % self.shape[1])
+        observed = ~np.isnan(ratings)
+        a = self.arrays
+        if self.kind == 'table':
+            raise ValueError('New subjects can not be predicted from a table of predictions.')
+        elif self.kind == 'mean':
+            return np.tile(a['item_mean'], (ratings.shape[0], 1))
+        elif self.kind == 'knn_item':
+            rows, cols = np.meshgrid(np.arange(ratings.shape[0]), np.arange(ratings.shape[1]), indexing='ij')
+            return self._neighbor_mean(ratings, rows.ravel(), cols.ravel()).reshape(ratings.shape)
+        elif self.kind == 'nnmf':
+            W = fold_in_multiplicative(np.where(observed, ratings, 0), observed, a['H'],
+                                       n_iterations=n_iterations)
+            return np.dot(W, a['H'])
+        else:
+            residual = ratings - a['global_bias'] - a['item_bias']
+            user_bias, user_vecs = fold_in_biased(residual, observed, a['item_vecs'],
+                                                  reg_vecs=float(a['user_fact_reg']),
+                                                  reg_bias=float(a['user_bias_reg']))
+            return (a['global_bias'] + user_bias[:, np.newaxis] + a['item_bias'][np.newaxis, :] +
+                    np.dot(user_vecs, a['item_vecs'].T))
+
+    def _neighbor_mean(self, ratings, rows, cols, max_elements=2**22):
+        ''' Similarity weighted mean of the subject's ratings of the item's neighbors for
+            every (row, col) cell, the item mean if the subject rated none of them.  Same
+            as KNN._predict_items() for single cells.'''
+
+        a = self.arrays
+        pred = np.empty(len(rows))
+        chunk = max(1, max_elements//max(a['item_neighbors'].shape[1], 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for start in range(0, len(rows), chunk):
+                r, c = rows[start:start + chunk], cols[start:start + chunk]
+                neighbors, weights = a['item_neighbors'][c], a['item_weights'][c]
+                neighbor_ratings = ratings[r[:, np.newaxis], neighbors]
+                rated = ~np.isnan(neighbor_ratings)
+                pred[start:start + chunk] = ((np.where(rated, neighbor_ratings, 0)*weights).sum(axis=1) /
+                                             (rated*np.abs(weights)).sum(axis=1))
+        return np.where(np.isfinite(pred), pred, a['item_mean'][cols])
+
+
+def _labels(labels):
+    ''' Labels as an array that can be saved without pickling.'''
+
+    labels = np.asarray(labels)
+    if labels.dtype == object:
+        labels = labels.astype(str)
+    return labels
+
+
+def _positions(lookup, labels, name):
+    try:
+        return np.array([lookup[l] for l in np.atleast_1d(labels).tolist()], dtype=int)
+    except KeyError as e:
+        raise ValueError('%s %s is not in the ratings of the model.' % (name, e.args[0]))
@@ -0,0 +1,142 @@
+from __future__ import division
+from collections import OrderedDict
+from timeit import default_timer as timer
+import numpy as np
+
+__all__ = ['Callback',
+           'Timings']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+class Callback(object):
+
+    ''' Base class for cf instrumentation hooks.
+
+        Subclass and override any of the hooks, then pass an instance to
+        `BaseCF.instrument()`.  Hooks are only called on instrumented models.
+
+    '''
+
+    def on_fit_begin(self, model):
+        pass
+
+    def on_phase(self, model, phase, duration):
+        ''' Called when a named phase (e.g. 'mask', 'dilation', 'similarity') ends.
+
+            Args:
+                model: cf instance being fit
+                phase: (str) name of phase
+                duration: (float) wall time in seconds
+
+        '''
+        pass
+
+    def on_iteration(self, model, iteration, duration, loss=None):
+        ''' Called at the end of every iteration (or epoch) of an iterative fit.
+
+            Args:
+                model: cf instance being fit
+                iteration: (int) iteration number starting at 1
+                duration: (float) wall time of iteration in seconds
+                loss: (float) loss or residual for this iteration, if available
+
+        '''
+        pass
+
+    def on_array(self, model, name, nbytes):
+        ''' Called with the size of a main array allocated during fit/predict.'''
+        pass
+
+
+class Timings(Callback):
+
+    ''' Callback recording per-phase wall time, per-iteration duration,
+        array sizes and the loss trace.  Available as `timings_` on an
+        instrumented cf instance.
+
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return '%s(phases=%s, n_iterations=%s)' % (
+            self.__class__.__name__,
+            dict(self.phases),
+            len(self.iterations)
+            )
+
+    def reset(self):
+        self.phases = OrderedDict()
+        self.iterations = []
+        self.loss = []
+        self.nbytes = OrderedDict()
+
+    def on_fit_begin(self, model):
+        self.reset()
+
+    def on_phase(self, model, phase, duration):
+        self.phases[phase] = self.phases.get(phase, 0.) + duration
+
+    def on_iteration(self, model, iteration, duration, loss=None):
+        self.iterations.append(duration)
+        if loss is not None:
+            self.loss.append(loss)
+
+    def on_array(self, model, name, nbytes):
+        self.nbytes[name] = nbytes
+
+    def to_dict(self):
+        ''' Flatten timings into a {metric_name: number} dictionary for metric exporters.'''
+
+        out = OrderedDict()
+        for phase, duration in self.phases.items():
+            out['phase.%s.seconds' % phase] = duration
+        out['iterations.count'] = len(self.iterations)
+        if self.iterations:
+            out['iterations.total_seconds'] = float(np.sum(self.iterations))
+            out['iterations.mean_seconds'] = float(np.mean(self.iterations))
+        if self.loss:
+            out['loss.final'] = float(self.loss[-1])
+        for name, nbytes in self.nbytes.items():
+            out['nbytes.%s' % name] = nbytes
+        out['nbytes.total'] = int(np.sum(list(self.nbytes.values()))) if self.nbytes else 0
+        return out
+
+
+class _Phase(object):
+
+    ''' Context manager timing a phase and reporting it to a model's callbacks.'''
+
+    __slots__ = ('model', 'name', 'start')
+
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        duration = timer() - self.start
+        for callback in self.model._callbacks:
+            callback.on_phase(self.model, self.name, duration)
+        return False
+
+
+class _NullPhase(object):
+
+    ''' Shared no-op context manager used when instrumentation is disabled.'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PHASE = _NullPhase()
@@ -0,0 +1,299 @@
+'''
+Asyncio prediction service for fitted models.
+
+Concurrent requests are collected for a few milliseconds and scored as one
+vectorized batch with emotioncf.predictor.Predictor, so the service only
+depends on NumPy and the standard library.  Run a saved model with
+
+    python -m emotioncf.server model.npz --port 8000
+
+and POST JSON to it:
+
+    /predict      {"subject": "s1", "item": 5} or {"cells": [["s1", 5], ["s2", 6]]}
+    /predict_new  {"ratings": [1.5, null, 3.0, ...]} or a list of rating lists
+    /stats        (GET) throughput and latency counters
+
+'''
+
+from __future__ import division
+import asyncio
+import json
+from collections import deque
+from timeit import default_timer as timer
+import numpy as np
+from .predictor import Predictor
+
+__all__ = ['PredictionBatcher',
+           'PredictionServer',
+           'serve']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+class PredictionBatcher(object):
+
+    ''' Batch concurrent prediction requests.  The first request of a batch opens
+        a window of `window` seconds, all requests arriving in the window (or
+        until max_batch requests are pending) are scored with one call of
+        Predictor.predict_cells() for (subject, item) cells and one call of
+        Predictor.predict_new() for new subjects.  Results are returned to the
+        requests in the order they arrived; a bad request (e.g., an unknown
+        subject) only fails itself.
+
+        Args:
+            model: Predictor or fitted cf instance (exported with to_predictor())
+            window: (float) seconds to collect requests before scoring (default=0.002)
+            max_batch: (int) score immediately once this many requests are pending
+            n_latencies: (int) number of recent request latencies kept for the counters
+
+    '''
+
+    def __init__(self, model, window=0.002, max_batch=1024, n_latencies=10000):
+        if not isinstance(model, Predictor):
+            model = model.to_predictor()
+        self.predictor = model
+        self.window = window
+        self.max_batch = max_batch
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=n_latencies)
+        self._pending = []
+        self._handle = None
+        self._start = None
+
+    def __repr__(self):
+        return '%s(model=%s, window=%s, requests=%s, batches=%s)' % (
+            self.__class__.__name__,
+            self.predictor,
+            self.window,
+            self.n_requests,
+            self.n_batches
+            )
+
+    async def predict(self, subject, item):
+        ''' Predicted rating of a fitted subject for an item (labels).'''
+        return await self._submit('cell', (subject, item))
+
+    async def predict_new(self, ratings):
+        ''' Predicted ratings of all items for a new subject's ratings (NaN if unrated).'''
+        return await self._submit('new', ratings)
+
+    def _submit(self, kind, request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self._start is None:
+            self._start = timer()
+        self._pending.append((kind, request, future, timer()))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(self.window, self.flush)
+        return future
+
+    def flush(self):
+        ''' Score all pending requests now.'''
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        cells, new = [], []
+        for kind, request, future, _ in batch:
+            try:
+                if kind == 'cell':
+                    subject, item = request
+                    cells.append((future, self.predictor.subject_positions(subject)[0],
+                                  self.predictor.item_positions(item)[0]))
+                else:
+                    ratings = np.asarray(request, dtype=float)
+                    if ratings.shape != (self.predictor.shape[1],):
+                        raise ValueError('ratings must have %s items' % self.predictor.shape[1])
+                    new.append((future, ratings))
+            except Exception as e:
+                _set_exception(future, e)
+
+        if cells:
+            futures, rows, cols = zip(*cells)
+            self._resolve(futures, lambda: self.predictor.predict_cells(np.array(rows), np.array(cols)))
+        if new:
+            futures, ratings = zip(*new)
+            self._resolve(futures, lambda: self.predictor.predict_new(np.vstack(ratings)))
+
+        done = timer()
+        self.n_batches += 1
+        self.n_requests += len(batch)
+        for _, _, future, tic in batch:
+            if future.cancelled() or future.exception() is not None:
+                self.n_errors += 1
+            self.latencies.append(done - tic)
+
+    def _resolve(self, futures, score):
+        try:
+            predicted = score()
+        except Exception as e:
+            for future in futures:
+                _set_exception(future, e)
+            return
+        for future, p in zip(futures, predicted):
+            if not future.cancelled():
+                future.set_result(p)
+
+    @property
+    def stats(self):
+        ''' Request, batch and error counts, throughput (requests per second since the
+            first request) and latency percentiles (ms) of the recent requests.'''
+
+        elapsed = timer() - self._start if self._start is not None else 0
+        latencies = 1000*np.array(self.latencies)
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            mean = latencies.mean()
+        else:
+            p50 = p95 = p99 = mean = None
+        return {'requests': self.n_requests,
+                'batches': self.n_batches,
+                'errors': self.n_errors,
+                'mean_batch_size': self.n_requests/self.n_batches if self.n_batches else None,
+                'throughput': self.n_requests/elapsed if elapsed else None,
+                'latency_ms': {'mean': mean, 'p50': p50, 'p95': p95, 'p99': p99}}
+
+
+class PredictionServer(object):
+
+    ''' Minimal HTTP/1.1 JSON server (keep-alive, no TLS) around a PredictionBatcher,
+        meant to run on localhost or behind a reverse proxy.  Requests on one
+        connection are answered in order; requests of concurrent connections are
+        batched together.
+
+        Args:
+            model: Predictor or fitted cf instance
+            host: (str) interface to listen on (default='127.0.0.1')
+            port: (int) port, 0 picks a free port (see `port` after start())
+            window: (float) batching window in seconds (default=0.002)
+            max_batch: (int) maximum number of requests per batch
+
+    '''
+
+    def __init__(self, model, host='127.0.0.1', port=8000, window=0.002, max_batch=1024):
+        self.batcher = PredictionBatcher(model, window=window, max_batch=max_batch)
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def __repr__(self):
+        return '%s(host=%s, port=%s, batcher=%s)' % (
+            self.__class__.__name__,
+            self.host,
+            self.port,
+            self.batcher
+            )
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = header.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._route(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %d\r\n\r\n' % (status, len(data))).encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        try:
+            if method == 'GET' and path == '/stats':
+                return '200 OK', self.batcher.stats
+            if method != 'POST' or path not in ('/predict', '/predict_new'):
+                return '404 Not Found', {'error': 'unknown endpoint %s %s' % (method, path)}
+            request = json.loads(body.decode() or 'null')
+            if path == '/predict':
+                if 'cells' in request:
+                    predicted = await asyncio.gather(*[self.batcher.predict(s, i) for s, i in request['cells']])
+                    return '200 OK', {'predictions': _to_json(predicted)}
+                return '200 OK', {'prediction': _to_json(await self.batcher.predict(request['subject'], request['item']))}
+            ratings = np.array(request['ratings'], dtype=float) # null is NaN
+            if ratings.ndim == 2:
+                predicted = await asyncio.gather(*[self.batcher.predict_new(r) for r in ratings])
+            else:
+                predicted = await self.batcher.predict_new(ratings)
+            return '200 OK', {'predictions': _to_json(predicted)}
+        except (ValueError, KeyError, TypeError) as e:
+            return '400 Bad Request', {'error': str(e)}
+
+
+def _set_exception(future, e):
+    if not future.cancelled():
+        future.set_exception(e)
+
+
+def _to_json(values):
+    ''' Predictions as JSON values, NaN as null.'''
+
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def serve(model, host='127.0.0.1', port=8000, window=0.002, max_batch=1024):
+
+    ''' Serve predictions of a model until interrupted.
+
+        Args:
+            model: Predictor, fitted cf instance or path of a model saved with save()
+            host: (str) interface to listen on (default='127.0.0.1')
+            port: (int) port (default=8000)
+            window: (float) batching window in seconds (default=0.002)
+            max_batch: (int) maximum number of requests per batch
+
+    '''
+
+    if isinstance(model, str):
+        model = Predictor.load(model)
+    server = PredictionServer(model, host=host, port=port, window=window, max_batch=max_batch)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve predictions of a saved emotioncf model.')
+    parser.add_argument('model', help='.npz file written by save()')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--window', type=float, default=0.002, help='batching window in seconds')
+    parser.add_argument('--max-batch', type=int, default=1024)
+    args = parser.parse_args()
+    serve(args.model, host=args.host, port=args.port, window=args.window, max_batch=args.max_batch)
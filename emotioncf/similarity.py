@@ -0,0 +1,165 @@
+from __future__ import division
+import os
+import numpy as np
+
+__all__ = ['similarity']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+METRICS = ['pearson', 'spearman', 'kendall', 'correlation', 'cosine']
+
+
+def similarity(values, metric='pearson', block_size=None, n_jobs=1, out=None):
+
+    ''' Blocked pairwise similarity between the rows of a ratings matrix using
+        pairwise-complete observations (i.e., only items rated in both rows).
+
+        The row by row output is split into tiles which are computed with
+        BLAS-backed matrix products, optionally in a thread pool.  Only the
+        upper triangle of tiles is computed and mirrored.
+
+        Args:
+            values: (np.array) row by item ratings, NaN where missing
+            metric: (str) {'pearson', 'spearman', 'kendall', 'correlation', 'cosine'}.
+                    'correlation' is an alias of 'pearson'.  For 'spearman' each row
+                    is ranked once over its observed items, so rows with different
+                    missing items are not re-ranked over their overlap.
+            block_size: (int) number of rows per tile (default=256)
+            n_jobs: (int) number of threads, -1 uses all cores (default=1)
+            out: (np.array or str) array to write into or path of a .npy file
+                 to memory-map the output to, bounding memory to the tiles
+
+        Returns:
+            sim: (np.array) row by row similarity matrix, NaN where undefined
+
+    '''
+
+    if metric not in METRICS:
+        raise NotImplementedError("%s is not implemented yet. Try %s" % (metric, METRICS))
+
+    values = np.asarray(values, dtype=float)
+    n_rows = values.shape[0]
+    if block_size is None:
+        block_size = 256
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    if out is None:
+        out = np.empty((n_rows, n_rows))
+    elif not isinstance(out, np.ndarray):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=float, shape=(n_rows, n_rows))
+    if out.shape != (n_rows, n_rows):
+        raise ValueError('out must have shape %s' % ((n_rows, n_rows),))
+
+    if metric == 'kendall':
+        tile = _kendall_tile
+        data = (values, ~np.isnan(values))
+    else:
+        if metric == 'spearman':
+            values = _rank_rows(values)
+        tile = _cosine_tile if metric == 'cosine' else _pearson_tile
+        data = _moments(values, center=(metric != 'cosine'))
+
+    blocks = [slice(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+    tiles = [(blocks[i], blocks[j]) for i in range(len(blocks)) for j in range(i, len(blocks))]
+
+    def compute(rows_cols):
+        rows, cols = rows_cols
+        sim = tile(data, rows, cols)
+        out[rows, cols] = sim
+        out[cols, rows] = sim.T
+
+    if n_jobs == 1 or len(tiles) == 1:
+        for t in tiles:
+            compute(t)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(compute, tiles))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _rank_rows(values):
+    ''' Rank each row over its observed items (average ranks for ties).'''
+
+    from scipy.stats import rankdata
+
+    observed = ~np.isnan(values)
+    ranks = rankdata(np.where(observed, values, np.inf), axis=1)
+    ranks[~observed] = np.nan
+    return ranks
+
+
+def _moments(values, center=True):
+    ''' Per-row arrays reused by every tile: values filled with 0, their squares and the mask.'''
+
+    observed = ~np.isnan(values)
+    mask = observed.astype(float)
+    if center:
+        # Correlation is shift invariant, centering each row limits cancellation error
+        n = observed.sum(axis=1)
+        mean = np.divide(np.where(observed, values, 0).sum(axis=1), n,
+                         out=np.zeros(len(n)), where=n > 0)
+        values = values - mean[:, np.newaxis]
+    filled = np.where(observed, values, 0)
+    return filled, filled**2, mask
+
+
+def _pearson_tile(data, rows, cols):
+    filled, squared, mask = data
+    n = np.dot(mask[rows], mask[cols].T)
+    sx = np.dot(filled[rows], mask[cols].T)
+    sy = np.dot(mask[rows], filled[cols].T)
+    sxx = np.dot(squared[rows], mask[cols].T)
+    syy = np.dot(mask[rows], squared[cols].T)
+    sxy = np.dot(filled[rows], filled[cols].T)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vx = sxx - sx**2/n
+        vy = syy - sy**2/n
+        r = (sxy - sx*sy/n)/np.sqrt(vx*vy)
+    r[(n < 2) | (vx <= 1e-10*sxx) | (vy <= 1e-10*syy)] = np.nan
+    return np.clip(r, -1, 1)
+
+
+def _cosine_tile(data, rows, cols):
+    filled, squared, mask = data
+    sxx = np.dot(squared[rows], mask[cols].T)
+    syy = np.dot(mask[rows], squared[cols].T)
+    sxy = np.dot(filled[rows], filled[cols].T)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sxy/np.sqrt(sxx*syy)
+
+
+def _pair_signs(values, observed, first, second):
+    ''' Sign of differences for item pairs, 0 for ties or missing, and pair observed mask.'''
+
+    both = observed[:, first] & observed[:, second]
+    with np.errstate(invalid='ignore'):
+        signs = np.where(both, np.sign(values[:, first] - values[:, second]), 0)
+    return signs.astype(np.float32), both.astype(np.float32)
+
+
+def _kendall_tile(data, rows, cols, max_elements=2**22):
+    ''' Kendall's tau-b with concordance counts accumulated over chunks of item pairs.'''
+
+    values, observed = data
+    first, second = np.triu_indices(values.shape[1], 1)
+    n_rows = max(rows.stop - rows.start, cols.stop - cols.start)
+    chunk = max(1, max_elements//n_rows)
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
+    concordance = np.zeros(shape)
+    untied_x = np.zeros(shape)
+    untied_y = np.zeros(shape)
+    for start in range(0, len(first), chunk):
+        pairs = slice(start, start + chunk)
+        s_x, o_x = _pair_signs(values[rows], observed[rows], first[pairs], second[pairs])
+        s_y, o_y = _pair_signs(values[cols], observed[cols], first[pairs], second[pairs])
+        concordance += np.dot(s_x, s_y.T)
+        untied_x += np.dot(np.abs(s_x), o_y.T)
+        untied_y += np.dot(o_x, np.abs(s_y).T)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tau = concordance/np.sqrt(untied_x*untied_y)
+    tau[(untied_x == 0) | (untied_y == 0)] = np.nan
+    return np.clip(tau, -1, 1)
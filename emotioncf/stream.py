@@ -0,0 +1,227 @@
+from __future__ import division
+import numpy as np
+from .data import downsample_n_samples
+
+__all__ = ['RingBuffer',
+           'RatingStream']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+class RingBuffer(object):
+
+    ''' Fixed-size first-in first-out buffer of (time, rating) samples.  If more
+        samples are pushed than fit before they are read, the oldest unread
+        samples are dropped and counted in `dropped`.
+
+        Args:
+            size: (int) maximum number of unread samples
+
+    '''
+
+    def __init__(self, size=1024):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.size = int(size)
+        self.times = np.zeros(self.size, dtype=np.int64)
+        self.values = np.zeros(self.size)
+        self.head = 0 # total samples written
+        self.tail = 0 # total samples read
+        self.dropped = 0
+
+    def __repr__(self):
+        return '%s(size=%s, unread=%s, dropped=%s)' % (
+            self.__class__.__name__,
+            self.size,
+            len(self),
+            self.dropped
+            )
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def extend(self, times, values):
+        ''' Append samples to the buffer.
+
+            Args:
+                times: (np.array) sample index of each rating at the original sampling frequency
+                values: (np.array) ratings
+
+        '''
+
+        times = np.atleast_1d(np.asarray(times, dtype=np.int64))
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        if times.shape != values.shape:
+            raise ValueError('times and values must have the same length')
+        if len(times) > self.size:
+            self.head += len(times) - self.size
+            times, values = times[-self.size:], values[-self.size:]
+        positions = np.arange(self.head, self.head + len(times)) % self.size
+        self.times[positions] = times
+        self.values[positions] = values
+        self.head += len(times)
+        overflow = len(self) - self.size
+        if overflow > 0:
+            self.dropped += overflow
+            self.tail += overflow
+
+    def read(self):
+        ''' Read all unread samples in the order they arrived.
+
+            Returns:
+                times: (np.array) sample index of each rating
+                values: (np.array) ratings
+
+        '''
+
+        positions = np.arange(self.tail, self.head) % self.size
+        self.tail = self.head
+        return self.times[positions], self.values[positions]
+
+
+class RatingStream(object):
+
+    ''' Stream time-series rating samples into a fitted cf model.
+
+        Samples are pushed into a ring buffer per subject.  Each update() reads
+        only the newly arrived samples, averages them into the downsampled
+        item bins they fall into, re-dilates only the window around those bins
+        and updates the model's predictions for the affected cells, without
+        reprocessing the whole recording.
+
+        The items of the model are the downsampled time bins: a sample at
+        index t (at sampling_freq) falls into item t // n_samples, where
+        n_samples is derived from target and target_type as in downsample().
+        Bins of a subject that receive streamed samples are set to the mean of
+        all samples streamed into that bin and become training cells.
+
+        Args:
+            model: fitted cf instance (e.g., Mean, KNN, NNMF_multiplicative, NNMF_sgd)
+            sampling_freq: sampling frequency of the streamed samples
+            target: downsampling target (default: no downsampling)
+            target_type: type of target can be [samples,seconds,hz]
+            dilate_ts_n_samples: (int) number of samples the model's masked ratings
+                                 were dilated by at fit()
+            buffer_size: (int) maximum number of unread samples per subject
+
+    '''
+
+    def __init__(self, model, sampling_freq=None, target=None, target_type='samples',
+                 dilate_ts_n_samples=None, buffer_size=1024):
+        if not model.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+        if len(model._data.shape) != 2:
+            raise ValueError('RatingStream requires a subject by item cf instance, not a tensor model.')
+        if model.is_mask_dilated and dilate_ts_n_samples is None:
+            raise ValueError('Masked ratings are dilated, please specify dilate_ts_n_samples.')
+        if target is None:
+            self.n_samples = 1
+        else:
+            if sampling_freq is None:
+                raise ValueError('Please specify the sampling frequency of the ratings data.')
+            self.n_samples = downsample_n_samples(sampling_freq, target, target_type)
+
+        self.model = model
+        self.dilate_ts_n_samples = dilate_ts_n_samples
+        n_subjects, self.n_items = model._data.shape
+        self._subjects = dict((s, i) for i, s in enumerate(model._data.index))
+        self.buffers = [RingBuffer(buffer_size) for _ in range(n_subjects)]
+        self._sums = np.zeros((n_subjects, self.n_items))
+        self._counts = np.zeros((n_subjects, self.n_items), dtype=int)
+
+    def __repr__(self):
+        return '%s(model=%s, n_samples=%s, unread=%s)' % (
+            self.__class__.__name__,
+            self.model,
+            self.n_samples,
+            sum(len(b) for b in self.buffers)
+            )
+
+    def push(self, subject, time, value):
+        ''' Add samples of a subject to its buffer.  Samples with a negative time, or past
+            the end of the model's ratings, are rejected (the whole call) with a ValueError.
+
+            Args:
+                subject: subject label (index of the model's ratings)
+                time: (int or np.array) sample index at the original sampling frequency
+                value: (float or np.array) ratings
+
+        '''
+
+        if subject not in self._subjects:
+            raise ValueError('Subject %s is not in the ratings of the model.' % (subject,))
+        # reject bad samples here, so the buffers only hold samples update() can fold in
+        times = np.asarray(time)
+        if np.any(times < 0):
+            raise ValueError('Sample times must not be negative.')
+        n_times = self.n_items*self.n_samples
+        if np.any(times >= n_times):
+            raise ValueError('Sample times must be smaller than the %s samples of the ratings.' % n_times)
+        self.buffers[self._subjects[subject]].extend(time, value)
+
+    def update(self):
+        ''' Fold all unread samples into the model.
+
+            Returns:
+                items: (np.array) positions of the updated (downsampled) items
+
+        '''
+
+        rows, cols = [], []
+        for s, buffer in enumerate(self.buffers):
+            if not len(buffer):
+                continue
+            times, values = buffer.read()
+            bins = (times//self.n_samples).astype(int)
+            np.add.at(self._sums[s], bins, values)
+            np.add.at(self._counts[s], bins, 1)
+            bins = np.unique(bins)
+            rows.append(np.full(len(bins), s))
+            cols.append(bins)
+        if not rows:
+            return np.array([], dtype=int)
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        self.model._update_ratings(rows, cols, self._sums[rows, cols]/self._counts[rows, cols],
+                                   dilate_ts_n_samples=self.dilate_ts_n_samples)
+        return np.unique(cols)
+
+    def consume(self, samples, update_every=None):
+        ''' Push (subject, time, value) samples from an iterable and update the model.
+
+            Args:
+                samples: iterable of (subject, time, value) tuples
+                update_every: (int) update the model every n samples (default: once at the end)
+
+        '''
+
+        for n, (subject, time, value) in enumerate(samples, 1):
+            self.push(subject, time, value)
+            if update_every is not None and n % update_every == 0:
+                self.update()
+        self.update()
+
+    async def consume_queue(self, queue, update_every=None):
+        ''' Push (subject, time, value) samples from an asyncio.Queue until None is
+            received.  The model is updated whenever the queue runs empty, or every
+            update_every samples, so bursts of samples are folded in together.
+
+            Args:
+                queue: (asyncio.Queue) queue of (subject, time, value) tuples, None to stop
+                update_every: (int) also update the model every n samples
+
+        '''
+
+        n = 0
+        while True:
+            sample = await queue.get()
+            try:
+                if sample is None:
+                    break
+                self.push(*sample)
+                n += 1
+                if queue.empty() or (update_every is not None and n % update_every == 0):
+                    self.update()
+            finally:
+                queue.task_done()
+        self.update()
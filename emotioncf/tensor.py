@@ -0,0 +1,647 @@
+from __future__ import division
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from timeit import default_timer as timer
+from .cf import BaseCF, _nanmean, _row_corr, _row_mse, _top_neighbors, _neighbor_predictions
+from .data import RatingsTensor, dilate_samples
+from .similarity import similarity
+
+__all__ = ['TensorMean',
+           'TensorKNN',
+           'TensorNNMF_multiplicative',
+           'TensorNNMF_sgd']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+
+class BaseTensorCF(BaseCF):
+
+    ''' Base class for collaborative filtering of several rating dimensions at once
+        (e.g., 22 emotions rated for the same subjects and items).
+
+        Ratings are held in a subject by item by dimension RatingsTensor.  The
+        train/test split, masking and dilation are computed once for all
+        dimensions, and models fit every dimension in one batched pass.
+        Evaluation methods return one value per dimension.  plot_predictions(),
+        bootstrap(), to_long_df(), to_predictor() and save() work on every
+        dimension (or the given one) as a single dimension cf instance would;
+        downsample() and _update_ratings() update all dimensions at once.
+
+        Args:
+            ratings: (dict or RatingsTensor) {dimension: pd.DataFrame} of subject by item ratings
+            mask: (pd.DataFrame or np.array) subject by item training mask shared by all
+                  dimensions, or a subject by item by dimension mask
+            n_train_items: (int) number of items per subject to use for training
+
+    '''
+
+    def _from_ratings(self, ratings):
+        ''' Ratings tensor of a {dimension: pd.DataFrame} dictionary (or a copy of a RatingsTensor).'''
+
+        if isinstance(ratings, RatingsTensor):
+            return ratings.copy()
+        if not isinstance(ratings, dict):
+            raise ValueError('ratings must be a dictionary of pandas dataframes or a RatingsTensor')
+        return RatingsTensor.from_dataframes(ratings)
+
+    @property
+    def dimensions(self):
+        return self._data.dimensions
+
+    @property
+    def ratings(self):
+        return self._data.to_dataframes()
+
+    @property
+    def train_mask(self):
+        if self._train_mask is None:
+            return None
+        return self._data.to_dataframes(self._train_mask)
+
+    @train_mask.setter
+    def train_mask(self, mask):
+        if isinstance(mask, pd.DataFrame):
+            mask = mask.reindex(index=self._data.index, columns=self._data.columns).fillna(False)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim == 2:
+            mask = np.repeat(mask[:, :, np.newaxis], self._data.shape[2], axis=2)
+        if mask.shape != self._data.shape:
+            raise ValueError('mask must have shape %s or %s' % (self._data.shape[:2], self._data.shape))
+        self._set_train_mask(mask)
+
+    @property
+    def masked_ratings(self):
+        if self._masked is None:
+            return None
+        return self._data.to_dataframes(self._masked)
+
+    @property
+    def dilated_mask(self):
+        if self._dilated_mask is None:
+            return None
+        return self._data.to_dataframes(self._dilated_mask)
+
+    @property
+    def predicted_ratings(self):
+        if self._predicted is None:
+            return None
+        return self._data.to_dataframes(self._predicted)
+
+    def _set_train_mask(self, mask):
+        self._train_mask = mask & self._data.mask
+        self._masked = np.where(self._train_mask, self._data.values, np.nan)
+        self.is_mask = True
+
+    def split_train_test(self, n_train_items=20):
+        ''' Split ratings into train and test items.  The same items are used for
+            training in every dimension.
+
+        Args:
+            n_train_items: (int) number of items per subject to use for training
+
+        '''
+
+        self.n_train_items = int(n_train_items)
+        n_subjects, n_items, n_dimensions = self._data.shape
+        if self.n_train_items > n_items:
+            raise ValueError('n_train_items must not be larger than the number of items.')
+
+        train_items = np.argsort(np.random.rand(n_subjects, n_items), axis=1)[:, :self.n_train_items]
+        mask = np.zeros((n_subjects, n_items), dtype=bool)
+        mask[np.arange(n_subjects)[:, np.newaxis], train_items] = True
+        self.train_mask = mask
+
+    def _dilate_ts_rating_samples(self, n_samples=None):
+        ''' Dilate sparse time-series ratings of every dimension by n_samples.
+            Overlapping ratings will be averaged.
+
+            Args:
+                n_samples:  Number of samples to dilate ratings
+
+        '''
+
+        if n_samples is None:
+            raise ValueError('Please specify number of samples to dilate.')
+        if not self.is_mask:
+            raise ValueError('Make sure cf instance has been masked.')
+
+        with self._phase('dilation'):
+            n_subjects, n_items, n_dimensions = self._data.shape
+            # dilate along items for every subject and dimension at once
+            rows = np.moveaxis(np.where(self._train_mask, self._data.values, np.nan), 2, 1).reshape(-1, n_items)
+            self._masked = np.moveaxis(dilate_samples(rows, n_samples).reshape(n_subjects, n_dimensions, n_items), 1, 2)
+            self._dilated_mask = ~np.isnan(self._masked)
+            self.is_mask_dilated = True
+
+    def _training_cells(self):
+        ''' Training ratings (NaN elsewhere) and the mask of training cells.'''
+
+        if self.is_mask:
+            select = self._dilated_mask if self.is_mask_dilated else self._train_mask
+            return np.where(select, self._masked, np.nan), select
+        return self._data.values, self._data.mask
+
+    def _retrieve_cells(self, data):
+        ''' Actual values and boolean mask of the cells to evaluate for each dimension.'''
+
+        if data not in ['all', 'training', 'test']:
+            raise ValueError("data must be ['all','training','test']")
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+        if not self.is_predict:
+            raise ValueError('You must predict() model first before using this method.')
+        return self._cached(('cells', data), self._select_cells, data)
+
+    def _select_cells(self, data):
+        ''' Uncached _retrieve_cells().'''
+
+        actual = self._data.values
+        if data == 'all':
+            select = self._data.mask
+        elif self.is_mask:
+            if data == 'training':
+                actual, select = self._training_cells()
+            else: # test
+                select = self._data.mask & ~self._train_mask
+                if not select.any():
+                    raise ValueError("No test data available. Use data='all' or 'training'")
+        else:
+            raise ValueError('Must run split_train_test() before using this option.')
+        return actual, select & ~np.isnan(self._predicted)
+
+    def get_mse(self, data='all'):
+        ''' Get mean squared error for predicted compared to actual ratings of each dimension.
+
+            Args:
+                data: (str) Get mse on 'all' data, the 'training' data, or the 'test' data
+
+            Returns:
+                mse: (pd.Series) mean squared error of each dimension
+
+        '''
+
+        actual, select = self._retrieve_cells(data)
+        return pd.Series(_row_mse(actual, self._predicted, select, axis=(0, 1)), index=self.dimensions)
+
+    def get_corr(self, data='all'):
+        ''' Get correlation for predicted compared to actual ratings of each dimension.
+
+            Args:
+                data: (str) Get correlation on 'all' data, the 'training' data, or the 'test' data
+
+            Returns:
+                r: (pd.Series) correlation of each dimension
+
+        '''
+
+        actual, select = self._retrieve_cells(data)
+        return pd.Series(_row_corr(actual, self._predicted, select, axis=(0, 1)), index=self.dimensions)
+
+    def get_sub_corr(self, data='all'):
+        ''' Calculate observed/predicted correlation for each subject and dimension.
+
+            Args:
+                data: (str) Get correlation on 'all' data, the 'training' data, or the 'test' data
+
+            Returns:
+                r: (pd.DataFrame) subject by dimension correlations
+
+        '''
+
+        actual, select = self._retrieve_cells(data)
+        return pd.DataFrame(_row_corr(actual, self._predicted, select, axis=1),
+                            index=self._data.index, columns=self.dimensions)
+
+    def get_sub_mse(self, data='all'):
+        ''' Calculate observed/predicted mse for each subject and dimension.
+
+            Args:
+                data: (str) Get mse on 'all' data, the 'training' data, or the 'test' data
+
+            Returns:
+                mse: (pd.DataFrame) subject by dimension mean squared error
+
+        '''
+
+        actual, select = self._retrieve_cells(data)
+        return pd.DataFrame(_row_mse(actual, self._predicted, select, axis=1),
+                            index=self._data.index, columns=self.dimensions)
+
+    def plot_predictions(self, data='training', heatmapkwargs={}, dimension=None):
+        ''' Create plots of actual and predicted ratings of every dimension
+
+            Args:
+                data: (str) plot 'all' data, the 'training' data, or the 'test' data
+                dimension: plot only this dimension (default: all dimensions)
+
+            Returns:
+                f: (dict) {dimension: figure}, or the figure of the given dimension
+                r: (pd.Series) correlation of each dimension, or the correlation of the given dimension
+
+        '''
+
+        if dimension is not None:
+            return self._dimension_cf(dimension).plot_predictions(data=data, heatmapkwargs=dict(heatmapkwargs))
+        figures, r = OrderedDict(), OrderedDict()
+        for d in self.dimensions:
+            figures[d], r[d] = self._dimension_cf(d).plot_predictions(data=data, heatmapkwargs=dict(heatmapkwargs))
+        return figures, pd.Series(r)
+
+    def bootstrap(self, metric=('mse', 'corr'), data='all', unit='cells', n_boot=1000, ci=95,
+                  seed=None, return_samples=False, max_elements=2**22):
+        ''' Bootstrap confidence intervals of model metrics of every dimension, see
+            BaseCF.bootstrap() for the arguments.  With a seed every dimension
+            uses the same resampling stream.
+
+            Returns:
+                stats: (pd.DataFrame) estimate, lower and upper bound, and bootstrap standard
+                       error indexed by (dimension, metric)
+                samples: (pd.DataFrame) n_boot by (dimension, metric) values, if return_samples
+
+        '''
+
+        results = [self._dimension_cf(d).bootstrap(metric=metric, data=data, unit=unit, n_boot=n_boot, ci=ci,
+                                                   seed=seed, return_samples=True, max_elements=max_elements)
+                   for d in self.dimensions]
+        stats = pd.concat([r[0] for r in results], keys=self.dimensions)
+        if return_samples:
+            return stats, pd.concat([r[1] for r in results], axis=1, keys=self.dimensions)
+        return stats
+
+    def to_long_df(self):
+        ''' Create a long format pandas dataframe with observed, predicted, and mask
+            of every dimension (see RatingsTensor.from_long_df()).'''
+
+        dfs = []
+        for d in self.dimensions:
+            df = self._dimension_cf(d).to_long_df()
+            df['Dimension'] = d
+            dfs.append(df)
+        return pd.concat(dfs)
+
+    def to_predictor(self, dimension=None):
+        ''' Export the fitted model of every dimension as a predict-only
+            emotioncf.predictor.Predictor.
+
+            Args:
+                dimension: export only this dimension (default: all dimensions)
+
+            Returns:
+                predictor: (OrderedDict) {dimension: Predictor}, or the Predictor of the given dimension
+
+        '''
+
+        from .predictor import Predictor
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+        if dimension is not None:
+            i = list(self.dimensions).index(dimension)
+            kind, arrays = self._export_dimension(i)
+            return Predictor(kind, np.asarray(self._data.index), np.asarray(self._data.columns), **arrays)
+        return OrderedDict((d, self.to_predictor(d)) for d in self.dimensions)
+
+    def save(self, path, dimension=None):
+        ''' Save the fitted model of every dimension to '<path>_<dimension>.npz' files, or
+            the given dimension to path, which can be loaded with
+            emotioncf.predictor.Predictor.load().
+
+            Args:
+                path: (str) file name
+                dimension: save only this dimension (default: all dimensions)
+
+        '''
+
+        if dimension is not None:
+            self.to_predictor(dimension).save(path)
+            return
+        if path.endswith('.npz'):
+            path = path[:-len('.npz')]
+        for d, predictor in self.to_predictor().items():
+            predictor.save('%s_%s' % (path, d))
+
+    def _export_dimension(self, i):
+        ''' Kind and arrays of dimension i of the model for a Predictor, see BaseCF._export().'''
+
+        if not self.is_predict:
+            raise ValueError('You must predict() model first before using this method.')
+        return 'table', {'predicted': self._predicted[:, :, i]}
+
+    def _dimension_cf(self, dimension):
+        ''' Single dimension cf instance holding this model's ratings, masks and
+            predictions of the dimension.'''
+
+        i = list(self.dimensions).index(dimension)
+        cf = BaseCF(self._data.dimension(dimension))
+        if self.is_mask:
+            cf._set_train_mask(self._train_mask[:, :, i])
+            cf._masked = self._masked[:, :, i]
+        if self.is_mask_dilated:
+            cf._dilated_mask = self._dilated_mask[:, :, i]
+            cf.is_mask_dilated = True
+        if self.is_predict:
+            cf._predicted = self._predicted[:, :, i]
+        cf.is_fit = self.is_fit
+        cf.is_predict = self.is_predict
+        return cf
+
+
+class TensorMean(BaseTensorCF):
+
+    ''' CF using Item Mean across subjects for every dimension'''
+
+    def fit(self, dilate_ts_n_samples=None):
+        ''' Fit item means of every dimension.
+
+        Args:
+            dilate_ts_n_samples: will dilate masked samples by n_samples to leverage auto-correlation
+                                in estimating time-series ratings
+
+        '''
+
+        self._fit_begin()
+        if self.is_mask and dilate_ts_n_samples is not None:
+            self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+        with self._phase('mean'):
+            self.mean = _nanmean(self._training_cells()[0], axis=0)
+        self.is_fit = True
+
+    def predict(self):
+        ''' Predict missing items using other subject's item means.'''
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+
+        with self._phase('predict'):
+            self._predicted = np.repeat(self.mean[np.newaxis], self._data.shape[0], axis=0)
+        self._record_arrays(predicted_ratings=self._predicted)
+        self.is_predict = True
+
+    def _update_predictions(self, rows, cols):
+        ''' Recompute the means of the updated items.'''
+
+        cols = np.unique(cols)
+        self.mean[cols] = _nanmean(self._training_cells()[0][:, cols], axis=0)
+        self._predicted[:, cols] = self.mean[cols]
+
+    def _export_dimension(self, i):
+        return 'mean', {'item_mean': self.mean[:, i]}
+
+
+class TensorKNN(BaseTensorCF):
+
+    ''' K-Nearest Neighbors CF algorithm for every dimension.  A single subject
+        similarity is computed over the ratings of all dimensions and is shared
+        by every dimension.  Predictions follow the rules of KNN, so a single
+        dimension predicts the same as KNN with the same training mask.
+
+    '''
+
+    def fit(self, metric='pearson', dilate_ts_n_samples=None, n_jobs=1, block_size=None):
+        ''' Fit subject similarity across the items of all dimensions.
+
+        Args:
+            metric: type of similarity {"pearson","spearman","kendall","correlation","cosine"}
+            dilate_ts_n_samples: will dilate masked samples by n_samples to leverage auto-correlation
+                                in estimating time-series ratings
+            n_jobs: (int) number of threads used to compute similarity tiles (default=1)
+            block_size: (int) number of subjects per similarity tile (default=256)
+
+        '''
+
+        self._fit_begin()
+        if self.is_mask and dilate_ts_n_samples is not None:
+            self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+        ratings = self._training_cells()[0]
+        with self._phase('similarity'):
+            self.subject_similarity = similarity(ratings.reshape(ratings.shape[0], -1), metric=metric,
+                                                 block_size=block_size, n_jobs=n_jobs)
+        self._record_arrays(ratings=ratings, subject_similarity=self.subject_similarity)
+        self.is_fit = True
+
+    def predict(self, k=None):
+        ''' Predict every dimension as the similarity weighted sum of the k most
+            similar subjects' ratings divided by the number of neighbors, NaN if
+            any neighbor is missing a rating (as KNN.predict()).
+
+            Args:
+                k: number of closest neighbors to use
+
+        '''
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+
+        with self._phase('neighbors'):
+            neighbors, weights, valid = _top_neighbors(self.subject_similarity, k)
+        with self._phase('predict'):
+            # the items of all dimensions at once
+            n_subjects = self._data.shape[0]
+            pred = _neighbor_predictions(self._data.values.reshape(n_subjects, -1), neighbors, weights, valid)
+            self._predicted = pred.reshape(self._data.shape)
+        self._record_arrays(predicted_ratings=self._predicted)
+        self.is_predict = True
+
+
+class TensorNNMF_multiplicative(BaseTensorCF):
+
+    ''' Non negative matrix factorization with multiplicative updates for every
+        dimension.  Each dimension has its own factors, but all dimensions are
+        updated together with stacked matrix products.
+
+    '''
+
+    def fit(self,
+            n_factors=None,
+            max_iterations=100,
+            fit_error_limit=1e-6,
+            verbose=False,
+            dilate_ts_n_samples=None):
+        ''' Fit NNMF models of every dimension using multiplicative updating.
+
+        Args:
+            n_factors (int): Number of factors or components (default=n_items)
+            max_iterations (int):  maximum number of interations (default=100)
+            fit_error_limit (float): stop once the fit residual of every dimension is below (default=1e-6)
+            verbose (bool): verbose output during fitting procedure (default=False)
+            dilate_ts_n_samples (int): will dilate masked samples by n_samples to leverage auto-correlation
+                                        in estimating time-series ratings
+
+        '''
+
+        eps = 1e-5
+
+        self._fit_begin()
+        n_users, n_items, n_dimensions = self._data.shape
+        if n_factors is None:
+            n_factors = n_items
+        if self.is_mask and dilate_ts_n_samples is not None:
+            self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+
+        with self._phase('mask'):
+            ratings, select = self._training_cells()
+            # dimension by subject by item
+            mask = np.ascontiguousarray(np.moveaxis(select, 2, 0), dtype=float)
+            masked_X = np.moveaxis(np.where(select, ratings, 0), 2, 0)
+
+        with self._phase('init'):
+            avg = np.sqrt(_nanmean(ratings.reshape(-1, n_dimensions), axis=0)/n_factors)[:, np.newaxis, np.newaxis]
+            self.W = avg*np.random.rand(n_dimensions, n_users, n_factors)
+            self.H = avg*np.random.rand(n_dimensions, n_factors, n_items)
+        self._record_arrays(masked_X=masked_X, mask=mask, W=self.W, H=self.H)
+
+        X_est_prev = np.matmul(self.W, self.H)
+        ctr = 1
+        while ctr <= max_iterations:
+            tic = timer()
+            with self._phase('update_W'):
+                self.W *= np.matmul(masked_X, self.H.transpose(0, 2, 1)) / np.matmul(mask * np.matmul(self.W, self.H), self.H.transpose(0, 2, 1))
+                self.W = np.maximum(self.W, eps)
+
+            with self._phase('update_H'):
+                self.H *= np.matmul(self.W.transpose(0, 2, 1), masked_X) / np.matmul(self.W.transpose(0, 2, 1), mask * np.matmul(self.W, self.H))
+                self.H = np.maximum(self.H, eps)
+
+            with self._phase('residual'):
+                X_est = np.matmul(self.W, self.H)
+                fit_residual = np.sqrt(np.sum((mask * (X_est_prev - X_est))**2, axis=(1, 2)))
+                X_est_prev = X_est
+            if ctr % 10 == 0 and verbose:
+                print('\tCurrent Iteration {}:'.format(ctr))
+                print('\tmax fit residual', np.round(fit_residual.max(), 4))
+            if self._callbacks:
+                self._record_iteration(ctr, timer() - tic, fit_residual.max())
+            if np.all(fit_residual < fit_error_limit):
+                break
+            ctr += 1
+        self.is_fit = True
+
+    def predict(self):
+        ''' Predict ratings of every dimension from the factors.'''
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+
+        with self._phase('predict'):
+            self._predicted = np.ascontiguousarray(np.moveaxis(np.matmul(self.W, self.H), 0, 2))
+        self._record_arrays(predicted_ratings=self._predicted)
+        self.is_predict = True
+
+    def _export_dimension(self, i):
+        return 'nnmf', {'W': self.W[i], 'H': self.H[i]}
+
+
+class TensorNNMF_sgd(BaseTensorCF):
+
+    ''' Matrix factorization with stochastic gradient descent for every dimension.
+        Each dimension has its own biases and factors, but every training sample
+        (subject, item) updates all of its dimensions in one vectorized step.
+
+    '''
+
+    def fit(self,
+            n_factors=None,
+            item_fact_reg=0.0,
+            user_fact_reg=0.0,
+            item_bias_reg=0.0,
+            user_bias_reg=0.0,
+            learning_rate=0.001,
+            n_iterations=10,
+            verbose=False,
+            dilate_ts_n_samples=None):
+        ''' Fit models of every dimension using stochastic gradient descent.
+
+        Args:
+            n_factors (int): Number of factors or components (default=n_items)
+            item_fact_reg (float): item factor regularization
+            user_fact_reg (float): user factor regularization
+            item_bias_reg (float): item bias regularization
+            user_bias_reg (float): user bias regularization
+            learning_rate (float): learning rate of the updates
+            n_iterations (int): number of epochs (default=10)
+            verbose (bool): verbose output during fitting procedure (default=False)
+            dilate_ts_n_samples (int): will dilate masked samples by n_samples to leverage auto-correlation
+                                        in estimating time-series ratings
+
+        '''
+
+        self._fit_begin()
+        n_users, n_items, n_dimensions = self._data.shape
+        if n_factors is None:
+            n_factors = n_items
+        self.user_fact_reg = user_fact_reg
+        self.user_bias_reg = user_bias_reg
+        if self.is_mask and dilate_ts_n_samples is not None:
+            self._dilate_ts_rating_samples(n_samples=dilate_ts_n_samples)
+
+        with self._phase('mask'):
+            ratings, select = self._training_cells()
+            # a sample is any subject/item with at least one rated dimension
+            sample_row, sample_col = select.any(axis=2).nonzero()
+            filled = np.where(select, ratings, 0)
+            observed = select.astype(float)
+            # mean of item means
+            self.global_bias = _nanmean(_nanmean(ratings, axis=0), axis=0)
+
+        with self._phase('init'):
+            self.user_vecs = np.random.normal(scale=1./n_factors, size=(n_users, n_dimensions, n_factors))
+            self.item_vecs = np.random.normal(scale=1./n_factors, size=(n_items, n_dimensions, n_factors))
+        self.user_bias = np.zeros((n_users, n_dimensions))
+        self.item_bias = np.zeros((n_items, n_dimensions))
+        self._record_arrays(ratings=ratings, user_vecs=self.user_vecs, item_vecs=self.item_vecs)
+
+        ctr = 1
+        while ctr <= n_iterations:
+            tic = timer()
+            if ctr % 10 == 0 and verbose:
+                print('\tCurrent Iteration: {}'.format(ctr))
+
+            training_indices = np.arange(len(sample_row))
+            np.random.shuffle(training_indices)
+
+            with self._phase('updates'):
+                for idx in training_indices:
+                    u = sample_row[idx]
+                    i = sample_col[idx]
+                    o = observed[u, i]
+                    prediction = (self.global_bias + self.user_bias[u] + self.item_bias[i] +
+                                  np.sum(self.user_vecs[u] * self.item_vecs[i], axis=1))
+                    e = (filled[u, i] - prediction) * o # error, 0 for unrated dimensions
+
+                    # Update biases
+                    self.user_bias[u] += learning_rate * (e - user_bias_reg * self.user_bias[u]) * o
+                    self.item_bias[i] += learning_rate * (e - item_bias_reg * self.item_bias[i]) * o
+
+                    # Update latent factors
+                    self.user_vecs[u] += learning_rate * (e[:, np.newaxis] * self.item_vecs[i] - user_fact_reg * self.user_vecs[u]) * o[:, np.newaxis]
+                    self.item_vecs[i] += learning_rate * (e[:, np.newaxis] * self.user_vecs[u] - item_fact_reg * self.item_vecs[i]) * o[:, np.newaxis]
+
+            if self._callbacks:
+                with self._phase('residual'):
+                    e = (ratings - self._predict_all())[select]
+                    rmse = np.sqrt(np.mean(e**2))
+                self._record_iteration(ctr, timer() - tic, rmse)
+            ctr += 1
+        self.is_fit = True
+
+    def predict(self):
+        ''' Predict ratings of every dimension from the biases and factors.'''
+
+        if not self.is_fit:
+            raise ValueError('You must fit() model first before using this method.')
+
+        with self._phase('predict'):
+            self._predicted = self._predict_all()
+        self._record_arrays(predicted_ratings=self._predicted)
+        self.is_predict = True
+
+    def _export_dimension(self, i):
+        return 'sgd', {'global_bias': self.global_bias[i], 'user_bias': self.user_bias[:, i],
+                       'item_bias': self.item_bias[:, i], 'user_vecs': self.user_vecs[:, i],
+                       'item_vecs': self.item_vecs[:, i], 'user_fact_reg': self.user_fact_reg,
+                       'user_bias_reg': self.user_bias_reg}
+
+    def _predict_all(self):
+        return (self.global_bias + self.user_bias[:, np.newaxis, :] + self.item_bias[np.newaxis, :, :] +
+                np.einsum('udk,idk->uid', self.user_vecs, self.item_vecs))
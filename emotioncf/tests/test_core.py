@@ -1,7 +1,24 @@
+import asyncio
+import functools
+import json
+import subprocess
+import sys
+import time
 import numpy as np
 import pandas as pd
-from emotioncf.cf import Mean, KNN, NNMF_multiplicative, NNMF_sgd
-from emotioncf.data import create_sub_by_item_matrix
+import pytest
+from scipy.stats import pearsonr, spearmanr
+from emotioncf.cf import Mean, KNN, NNMF_multiplicative, NNMF_sgd, TemporalMF
+from emotioncf.data import create_sub_by_item_matrix, Ratings, RatingsTensor
+from emotioncf.tensor import TensorMean, TensorKNN, TensorNNMF_multiplicative, TensorNNMF_sgd
+from emotioncf.profiling import Callback, Timings
+from emotioncf.similarity import similarity
+from emotioncf.stream import RingBuffer, RatingStream
+from emotioncf.ensemble import Ensemble, _init_worker, _shared
+from emotioncf.factorization import mean_impute, randomized_svd, nndsvd, estimate_rank
+from emotioncf.distributed import multiplicative_updates, multiplicative_updates_blocks
+from emotioncf.predictor import Predictor
+from emotioncf.server import PredictionBatcher, PredictionServer
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.use('TkAgg')
@@ -143,6 +160,14 @@ def test_cf_nnmf_sgd():
             item_bias_reg=0,
             learning_rate=.001)
     basecf_method_all_tests(cf=cf)
+    assert len(cf.history['train_rmse']) == 20
+    assert len(cf.history['validation_rmse']) == 20
+
+    cf.fit(n_iterations=100, n_factors=20, learning_rate=.003, learning_rate_decay=.95, patience=3)
+    assert len(cf.history['validation_rmse']) == min(100, cf.best_iteration + 3)
+    assert np.isclose(cf.history['learning_rate'][1], .00285)
+    val_row, val_col = (~cf.train_mask.values).nonzero()
+    assert np.isclose(cf._rmse(cf.ratings.values, val_row, val_col), min(cf.history['validation_rmse']))
 
     cf.fit(n_iterations = 20,
             user_fact_reg=0,
@@ -154,6 +179,29 @@ def test_cf_nnmf_sgd():
     cf.predict()
     basecf_method_all_tests(cf=cf)
 
+def test_cf_temporal_mf():
+    cf = TemporalMF(simulate_data(data_type='data_wide'))
+    cf.fit(n_factors=5)
+    cf.predict()
+
+    cf.split_train_test(n_train_items=20)
+    cf.fit(n_factors=5, n_iterations=30)
+    basecf_method_all_tests(cf=cf)
+    assert cf.item_vecs.shape == (100, 5)
+    assert np.all(np.diff(cf.history['loss']) <= 1e-9*cf.history['loss'][0])
+
+    # items without training ratings are interpolated from their neighbors
+    mask = cf.train_mask.copy()
+    mask.iloc[:, 40:45] = False
+    roughness = []
+    for smoothness in [0, 100]:
+        cf = TemporalMF(simulate_data(data_type='data_wide'), mask=mask)
+        cf.fit(n_factors=5, smoothness=smoothness, order=2)
+        cf.predict()
+        assert np.all(np.isfinite(cf.predicted_ratings.values))
+        roughness.append(np.sum(np.diff(cf.item_vecs, n=2, axis=0)**2))
+    assert roughness[1] < roughness[0]
+
 def test_downsample():
     cf = Mean(simulate_data(data_type = 'data_wide'))
     cf.downsample(sampling_freq=10, target=2, target_type='samples')
@@ -181,3 +229,550 @@ def test_downsample():
     assert cf.dilated_mask.shape == (50, 50)
     assert cf.train_mask.shape == (50, 50)
     assert cf.predicted_ratings.shape == (50, 50)
+
+def test_instrument():
+    cf = NNMF_multiplicative(simulate_data(data_type='data_wide'))
+    cf.split_train_test(n_train_items=50)
+    cf.fit(max_iterations=5)
+    assert cf.timings_ is None
+
+    class Exporter(Callback):
+        def __init__(self):
+            self.iterations = 0
+        def on_iteration(self, model, iteration, duration, loss=None):
+            self.iterations += 1
+
+    exporter = Exporter()
+    cf.instrument(callbacks=[exporter])
+    cf.fit(max_iterations=5)
+    cf.predict()
+    assert isinstance(cf.timings_, Timings)
+    for phase in ['init', 'mask', 'update_W', 'update_H', 'residual', 'predict']:
+        assert phase in cf.timings_.phases
+    assert len(cf.timings_.iterations) == 5
+    assert len(cf.timings_.loss) == 5
+    assert exporter.iterations == 5
+    assert cf.timings_.nbytes['W'] == cf.W.nbytes
+    assert cf.timings_.to_dict()['iterations.count'] == 5
+
+    cf = NNMF_sgd(simulate_data(data_type='data_wide'))
+    cf.split_train_test(n_train_items=50)
+    cf.instrument()
+    cf.fit(n_iterations=2, dilate_ts_n_samples=2)
+    assert 'dilation' in cf.timings_.phases
+    assert len(cf.timings_.loss) == 2
+
+def test_ratings():
+    df = simulate_data(data_type='data_wide')
+    df.iloc[0, 0] = np.nan
+    rating = Ratings.from_dataframe(df)
+    assert rating.shape == (50, 100)
+    assert rating.values.flags['C_CONTIGUOUS']
+    assert rating.mask.dtype == bool
+    assert not rating.mask[0, 0]
+    assert rating.to_dataframe().equals(df)
+
+    cf = Mean(df)
+    assert cf.is_mask
+    mask = cf.train_mask
+    with pytest.raises(ValueError):
+        mask.iloc[1, :] = False
+    mask = mask.copy()
+    mask.iloc[1, :] = False
+    cf.train_mask = mask
+    assert not cf.train_mask.iloc[1, :].any()
+    assert cf.masked_ratings.iloc[1, :].isnull().all()
+    cf.fit()
+    cf.predict()
+    with pytest.raises(ValueError):
+        cf.predicted_ratings.iloc[0, 0] = 0
+
+    other = Mean(cf.ratings)
+    other.train_mask = cf.train_mask
+    assert not np.shares_memory(other._data.values, cf._data.values)
+    assert not np.shares_memory(other._train_mask, cf._train_mask)
+
+def test_similarity(tmpdir):
+    ratings = simulate_data(data_type='data_wide')
+    ratings[np.random.rand(*ratings.shape) < .3] = np.nan
+    for metric in ['pearson', 'kendall']:
+        sim = similarity(ratings.values, metric=metric, block_size=16, n_jobs=2)
+        assert np.allclose(sim, ratings.T.corr(method=metric).values, equal_nan=True)
+    sim = similarity(ratings.values, metric='correlation', block_size=16)
+    assert np.allclose(sim, ratings.T.corr().values, equal_nan=True)
+
+    # spearman ranks each row once over its observed items
+    complete = simulate_data(data_type='data_wide')
+    sim = similarity(complete.values, metric='spearman', block_size=16)
+    assert np.allclose(sim, spearmanr(complete.values, axis=1)[0])
+    ranks = ratings.rank(axis=1)
+    sim = similarity(ratings.values, metric='spearman', block_size=16)
+    assert np.allclose(sim, ranks.T.corr().values, equal_nan=True)
+
+    sim = similarity(ratings.values, metric='cosine', block_size=16)
+    values = ratings.values
+    for i, j in [(0, 1), (3, 40), (49, 10), (7, 7)]:
+        both = ~np.isnan(values[i]) & ~np.isnan(values[j])
+        x, y = values[i, both], values[j, both]
+        assert np.isclose(sim[i, j], np.dot(x, y)/np.sqrt(np.dot(x, x)*np.dot(y, y)))
+
+    cf = KNN(ratings)
+    path = str(tmpdir.join('sim.npy'))
+    cf.fit(metric='spearman', block_size=16, n_jobs=2, memmap=path)
+    assert isinstance(cf._similarity, np.memmap)
+    assert cf.subject_similarity.shape == (50, 50)
+    cf.predict(k=10)
+    assert cf.predicted_ratings.shape == (50, 100)
+    assert cf._neighbor_index.shape == (50, 10)
+    assert np.allclose(np.diag(np.load(path)), 1) # similarity file is not modified
+
+    # every prediction is the weighted sum over the 10 most similar other subjects
+    sim = np.array(cf._similarity)
+    np.fill_diagonal(sim, -np.inf)
+    top = np.argsort(-sim[0], kind='mergesort')[:10]
+    observed = ~np.isnan(ratings.values[top]).any(axis=0)
+    expected = np.dot(sim[0, top], ratings.values[top][:, observed])/10
+    assert np.allclose(cf.predicted_ratings.values[0, observed], expected)
+    assert np.isnan(cf.predicted_ratings.values[0, ~observed]).all()
+
+def test_cf_knn_item(tmpdir):
+    cf = KNN(simulate_data(data_type='data_wide'))
+    cf.split_train_test(n_train_items=50)
+    cf.fit(mode='item', n_item_neighbors=10)
+    assert cf.subject_similarity is None
+    assert cf.item_neighbors.shape == (100, 10)
+    assert not np.any(cf.item_neighbors == np.arange(100)[:, np.newaxis])
+    cf.predict()
+    basecf_method_all_tests(cf=cf)
+
+    # new subjects: weighted mean of their ratings of each item's 5 most similar items
+    train = cf.masked_ratings.values
+    sim = pd.DataFrame(train).corr().values
+    np.fill_diagonal(sim, -np.inf)
+    new = cf.masked_ratings.iloc[:3]
+    predicted = cf.predict_new(new, k=5).values
+    for s, i in [(0, 0), (1, 50), (2, 99), (0, 37)]:
+        top = np.argsort(-sim[i], kind='mergesort')[:5]
+        rated = ~np.isnan(new.values[s, top])
+        if rated.any():
+            w = sim[i, top][rated]
+            expected = np.dot(w, new.values[s, top][rated])/np.abs(w).sum()
+        else:
+            expected = np.nanmean(train[:, i])
+        assert np.isclose(predicted[s, i], expected)
+    assert cf.predict_new(new.iloc[0]).shape == (1, 100)
+    unrated = pd.DataFrame(np.nan, index=['new'], columns=new.columns)
+    assert np.allclose(cf.predict_new(unrated).values[0], np.nanmean(train, axis=0))
+
+    path = str(tmpdir.join('item_sim.npy'))
+    cf.fit(mode='item', n_item_neighbors=10, memmap=path)
+    assert np.allclose(np.diag(np.load(path)), 1) # similarity file is not modified
+
+def test_cf_tensor(tmpdir):
+    ratings = dict((d, simulate_data(data_type='data_wide')) for d in ['valence', 'arousal', 'fear'])
+    tensor = RatingsTensor.from_dataframes(ratings)
+    assert tensor.shape == (50, 100, 3)
+    assert tensor.dimension('arousal').to_dataframe().equals(ratings['arousal'])
+
+    # a single dimension matches the matrix model
+    np.random.seed(0)
+    cf = NNMF_sgd(ratings['fear'], n_train_items=50)
+    mask = cf.train_mask
+    np.random.seed(0)
+    cf.fit(n_iterations=2, n_factors=5)
+    cf.predict()
+    cf_tensor = TensorNNMF_sgd({'fear': ratings['fear']}, mask=mask)
+    np.random.seed(0)
+    cf_tensor.fit(n_iterations=2, n_factors=5)
+    cf_tensor.predict()
+    assert np.allclose(cf.predicted_ratings, cf_tensor.predicted_ratings['fear'])
+
+    # ...and so does knn, including its NaN predictions
+    ratings['fear'].iloc[:5, :10] = np.nan
+    cf = KNN(ratings['fear'], n_train_items=50)
+    cf.fit()
+    cf.predict(k=10)
+    cf_tensor = TensorKNN({'fear': ratings['fear']}, mask=cf.train_mask)
+    cf_tensor.fit()
+    cf_tensor.predict(k=10)
+    assert np.isnan(cf.predicted_ratings.values).any()
+    assert np.allclose(cf.predicted_ratings, cf_tensor.predicted_ratings['fear'], equal_nan=True)
+    ratings['fear'] = simulate_data(data_type='data_wide')
+
+    for model in [TensorMean, TensorKNN, TensorNNMF_multiplicative, TensorNNMF_sgd]:
+        cf = model(ratings)
+        cf.split_train_test(n_train_items=50)
+        cf.fit()
+        cf.predict()
+        assert set(cf.predicted_ratings.keys()) == set(ratings.keys())
+        for data in ['all', 'training', 'test']:
+            mse = cf.get_mse(data=data)
+            assert isinstance(mse, pd.Series)
+            assert len(mse) == 3
+            assert np.all(cf.get_corr(data=data) > 0)
+            assert cf.get_sub_corr(data=data).shape == (50, 3)
+            assert cf.get_sub_mse(data=data).shape == (50, 3)
+        cf.fit(dilate_ts_n_samples=2)
+        cf.predict()
+        assert cf.dilated_mask['valence'].shape == (50, 100)
+
+    # single dimension methods work on every dimension
+    cf = TensorNNMF_sgd(ratings, n_train_items=50)
+    cf.fit(n_iterations=2, n_factors=5, user_fact_reg=.1)
+    cf.predict()
+    predictors = cf.to_predictor()
+    for d in ratings:
+        assert np.allclose(predictors[d].predict(), cf.predicted_ratings[d])
+        assert predictors[d].kind == 'sgd'
+        assert cf._dimension_cf(d).get_mse(data='test') > 0
+    cf.save(str(tmpdir.join('tensor.npz')))
+    assert np.allclose(Predictor.load(str(tmpdir.join('tensor_arousal.npz'))).predict(),
+                       cf.predicted_ratings['arousal'])
+    stats, samples = cf.bootstrap(data='test', n_boot=20, seed=0, return_samples=True)
+    assert stats.index.tolist() == [(d, m) for d in ratings for m in ['mse', 'corr']]
+    assert samples.shape == (20, 6)
+    assert np.allclose(stats.loc['fear'], cf._dimension_cf('fear').bootstrap(data='test', n_boot=20, seed=0))
+    df = cf.to_long_df()
+    assert df.shape[0] == 50*100*2*3
+    assert RatingsTensor.from_long_df(df[df['Condition'] == 'Observed']).shape == (50, 100, 3)
+    figures, r = cf.plot_predictions(data='test')
+    assert set(figures) == set(ratings) and np.allclose(r, cf.get_corr(data='test').loc[list(ratings)])
+    plt.close('all')
+
+    cf = TensorMean(ratings)
+    cf.split_train_test(n_train_items=50)
+    cf.fit(dilate_ts_n_samples=3)
+    cf.predict()
+    rows, cols = cf._update_ratings([0, 0], [97, 98], np.array([[1., 2., 3.], [4., 5., 6.]]), dilate_ts_n_samples=3)
+    assert np.array_equal(np.unique(cols), [96, 97, 98, 99])
+    assert np.allclose(cf.ratings['fear'].iloc[0, [97, 98]], [3, 6])
+    assert cf.dilated_mask['fear'].iloc[0, 96:].all()
+    assert np.allclose(cf.predicted_ratings['valence'].iloc[1], cf.mean[:, 0])
+    assert np.allclose(cf.mean[97, 2], np.nanmean(np.where(cf.dilated_mask['fear'], cf.masked_ratings['fear'], np.nan)[:, 97]))
+    assert cf.to_predictor('valence').kind == 'mean'
+    cf.downsample(sampling_freq=10, target=2, target_type='samples')
+    assert cf._data.shape == (50, 50, 3)
+    assert cf.predicted_ratings['arousal'].shape == (50, 50)
+    assert cf.train_mask['fear'].shape == (50, 50)
+
+def test_stream():
+    buffer = RingBuffer(size=4)
+    buffer.extend(np.arange(6), np.arange(6.))
+    assert buffer.dropped == 2
+    times, values = buffer.read()
+    assert np.array_equal(times, [2, 3, 4, 5])
+    assert len(buffer) == 0
+
+    ratings = simulate_data(data_type='data_wide')
+    raw = np.repeat(ratings.values, 2, axis=1)
+    for dilate in [None, 5]:
+        cf = KNN(ratings)
+        cf.split_train_test(n_train_items=20)
+        cf.fit(dilate_ts_n_samples=dilate)
+        cf.predict(k=10)
+        stream = RatingStream(cf, sampling_freq=2, target=1, target_type='seconds', dilate_ts_n_samples=dilate)
+        stream.consume(((0, t, raw[0, t]) for t in range(40, 60)), update_every=7)
+        assert cf.train_mask.iloc[0, 20:30].all()
+        assert np.allclose(cf.ratings.iloc[0, 20:30], ratings.iloc[0, 20:30])
+        predicted = cf.predicted_ratings
+        cf.predict(k=10)
+        assert np.allclose(predicted.fillna(0), cf.predicted_ratings.fillna(0))
+
+    # samples past the end of the ratings are rejected, not folded into the last item,
+    # and valid samples pushed before them are kept
+    stream.push(1, [198, 199], [1., 2.])
+    with pytest.raises(ValueError):
+        stream.push(0, [199, 200], [1., 2.])
+    with pytest.raises(ValueError):
+        stream.push(0, -1, 1.)
+    assert np.array_equal(stream.update(), [99])
+    assert cf.ratings.iloc[1, 99] == 1.5
+    assert np.allclose(cf.ratings.iloc[0, 99], ratings.iloc[0, 99])
+
+    # tensor models are rejected
+    cf = TensorMean({'valence': ratings, 'arousal': ratings})
+    cf.fit()
+    with pytest.raises(ValueError, match='tensor'):
+        RatingStream(cf)
+
+def test_eval_cache():
+    cf = Mean(simulate_data(data_type='data_wide'), n_train_items=50)
+    cf.fit()
+    cf.predict()
+    mse = cf.get_mse(data='test')
+    actual, predicted = cf._retrieve_predictions('test')
+    assert cf._retrieve_predictions('test')[0] is actual
+    assert cf.get_mse(data='test') == mse
+    cf.split_train_test(n_train_items=20)
+    assert cf._retrieve_predictions('test')[0] is not actual
+    actual = cf._retrieve_predictions('test')[0]
+    cf.fit()
+    cf.predict()
+    assert cf._retrieve_predictions('test')[0] is not actual
+    cf.predicted_ratings = cf.predicted_ratings + 1
+    actual, predicted = cf._retrieve_predictions('test')
+    assert np.allclose(predicted, cf.predicted_ratings.values[~cf.train_mask.values])
+
+def test_factorization_init():
+    X = np.dot(np.random.rand(50, 3), np.random.rand(3, 100))
+    U, S, Vt = randomized_svd(X, 3)
+    assert np.allclose(np.dot(U*S, Vt), X)
+    assert estimate_rank(X + 0.01*np.random.randn(50, 100)) == 3
+    X_large = np.dot(np.random.rand(500, 10), np.random.rand(10, 400))
+    assert estimate_rank(X_large + 0.1*np.random.randn(500, 400), max_rank=30) == 10
+    for variant in ['nndsvd', 'nndsvda']:
+        W, H = nndsvd(X, 3, variant=variant)
+        assert W.shape == (50, 3) and H.shape == (3, 100)
+        assert np.all(W >= 0) and np.all(H >= 0)
+    mask = np.random.rand(50, 100) > 0.5
+    assert np.allclose(mean_impute(X, mask)[mask], X[mask])
+
+    ratings = simulate_data(data_type='data_wide')
+    for init in ['nndsvd', 'nndsvda']:
+        cf = NNMF_multiplicative(ratings, n_train_items=50)
+        cf.fit(n_factors='auto', init=init, max_iterations=20)
+        assert cf.H.shape == (cf.n_factors, 100)
+        cf.predict()
+        assert np.all(np.isfinite(cf.predicted_ratings))
+    cf = NNMF_sgd(ratings, n_train_items=50)
+    cf.fit(n_factors=5, init='svd', n_iterations=2)
+    assert cf.user_vecs.shape == (50, 5)
+    cf.predict()
+    assert np.all(np.isfinite(cf.predicted_ratings))
+
+    # svd based initialization reaches a tolerance in fewer iterations than random
+    class Error(Callback):
+        def __init__(self):
+            self.error = []
+        def on_iteration(self, model, iteration, duration, loss=None):
+            self.error.append(np.linalg.norm(X - np.dot(model.W, model.H))/np.linalg.norm(X))
+
+    def first_below(error, tolerance):
+        return np.append(np.flatnonzero(np.array(error) < tolerance), len(error))[0]
+
+    np.random.seed(0)
+    X = np.dot(np.random.rand(100, 3), np.random.rand(3, 80))
+    n_iterations = {}
+    for init in ['random', 'nndsvd', 'nndsvda']:
+        error = Error()
+        cf = NNMF_multiplicative(pd.DataFrame(X))
+        cf.instrument([error])
+        cf.fit(n_factors=3, init=init, max_iterations=100, fit_error_limit=0)
+        n_iterations[init] = first_below(error.error, .1)
+    assert n_iterations['random'] > 2*max(n_iterations['nndsvd'], n_iterations['nndsvda'])
+    for init in ['random', 'svd']:
+        cf = NNMF_sgd(pd.DataFrame(X[:, :50]), n_train_items=25)
+        cf.instrument()
+        cf.fit(n_factors=3, init=init, n_iterations=20, learning_rate=.01)
+        n_iterations[init] = first_below(cf.timings_.loss, .12)
+    assert n_iterations['svd'] < n_iterations['random']
+
+def test_ensemble(tmpdir):
+    ratings = simulate_data(data_type='data_wide')
+    for model, kwargs in [(NNMF_multiplicative, {'max_iterations': 10}),
+                          (NNMF_sgd, {'n_iterations': 2, 'n_factors': 5})]:
+        cf = Ensemble(ratings, model=model, n_train_items=50)
+        cf.fit(n_models=3, n_jobs=2, seed=0, temp_folder=str(tmpdir), **kwargs)
+        assert tmpdir.listdir() == [] # shared ratings are removed
+        cf.predict()
+        basecf_method_all_tests(cf=cf)
+        assert cf.prediction_std.shape == (50, 100)
+        assert cf.disagreement > 0
+
+        predicted = []
+        for seed in cf.seeds:
+            np.random.seed(seed)
+            replica = model(ratings, mask=cf.train_mask)
+            replica.fit(**kwargs)
+            replica.predict()
+            predicted.append(replica.predicted_ratings.values)
+        assert np.allclose(cf.predicted_ratings.values, np.mean(predicted, axis=0))
+        assert np.allclose(cf.prediction_std.values, np.std(predicted, axis=0, ddof=1))
+
+    cf = Ensemble(ratings, model=NNMF_sgd, n_train_items=50)
+    cf.fit(n_models=2, seed=1, n_iterations=2, n_factors=5, dilate_ts_n_samples=2)
+    cf.predict()
+    assert cf.is_mask_dilated
+
+    # fitting in process leaves the caller's random state alone
+    np.random.seed(3)
+    expected = np.random.rand()
+    np.random.seed(3)
+    cf = Ensemble(ratings, model=NNMF_sgd, mask=cf.train_mask)
+    cf.fit(n_models=2, seed=1, n_iterations=1, n_factors=5)
+    assert np.random.rand() == expected
+
+    # workers memory-map the shared ratings read-only and replicas do not copy them
+    np.save(str(tmpdir.join('ratings.npy')), ratings.values)
+    np.save(str(tmpdir.join('train_mask.npy')), cf._train_mask)
+    _init_worker(NNMF_sgd, str(tmpdir.join('ratings.npy')), ~np.isnan(ratings.values), ratings.index,
+                 ratings.columns, str(tmpdir.join('train_mask.npy')))
+    shared = _shared['ratings'].values
+    assert not shared.flags.writeable and isinstance(shared.base, np.memmap)
+    replica = NNMF_sgd(_shared['ratings'])
+    replica._set_train_mask(_shared['mask'])
+    assert replica._data.values is shared and replica._train_mask is _shared['mask']
+    replica.fit(n_iterations=1, n_factors=5)
+    with pytest.raises(ValueError, match='read-only'):
+        replica._update_ratings([0], [0], [1.])
+    _shared.clear()
+
+def test_bootstrap():
+    cf = Mean(simulate_data(data_type='data_wide'), n_train_items=50)
+    cf.fit()
+    cf.predict()
+    stats, samples = cf.bootstrap(data='test', n_boot=50, seed=0, return_samples=True)
+    assert list(stats.index) == ['mse', 'corr']
+    assert np.isclose(stats.loc['mse', 'estimate'], cf.get_mse(data='test'))
+    assert np.isclose(stats.loc['corr', 'estimate'], cf.get_corr(data='test'))
+    assert np.all(stats['lower'] <= stats['upper'])
+
+    actual, predicted = cf._retrieve_predictions('test')
+    index = np.random.RandomState(0).randint(len(actual), size=(50, len(actual)))
+    assert np.allclose(samples['mse'], [np.mean((predicted[i] - actual[i])**2) for i in index])
+    assert np.allclose(samples['corr'], [pearsonr(actual[i], predicted[i])[0] for i in index])
+
+    stats = cf.bootstrap(metric=['mse', 'sub_corr'], unit='subjects', n_boot=20, max_elements=100)
+    assert np.isclose(stats.loc['sub_corr', 'estimate'], np.nanmean(cf.get_sub_corr()))
+
+def test_nnmf_blocked(tmpdir, capsys):
+    ratings = simulate_data(data_type='data_wide')
+    predicted = []
+    for n_blocks in [None, 3]:
+        np.random.seed(0)
+        cf = NNMF_multiplicative(ratings, n_train_items=50)
+        cf.instrument()
+        cf.fit(n_factors=10, max_iterations=30, fit_error_limit=1, n_blocks=n_blocks)
+        cf.predict()
+        predicted.append(cf.predicted_ratings.values)
+        assert cf.W.shape == (50, 10)
+    assert np.allclose(predicted[0], predicted[1])
+    assert len(cf.timings_.loss) <= 30
+
+    # blocks loaded by the workers from .npy files or a loading function
+    masked_X = np.where(cf._train_mask, cf._data.values, 0)
+    np.random.seed(0)
+    W, H = np.random.rand(50, 10), np.random.rand(10, 100)
+    blocks = []
+    for b, rows in enumerate([slice(0, 20), slice(20, 35)]):
+        for name, values in [('X', masked_X), ('mask', cf._train_mask), ('W', W)]:
+            np.save(str(tmpdir.join('%s_%d.npy' % (name, b))), values[rows])
+        blocks.append(tuple(str(tmpdir.join('%s_%d.npy' % (name, b))) for name in ['X', 'mask', 'W']))
+    blocks.append(functools.partial(_load_rows, masked_X, cf._train_mask, W, slice(35, 50)))
+    losses = []
+    W_blocks, H_blocks = multiplicative_updates_blocks(blocks, H, max_iterations=20, fit_error_limit=0,
+                                                       callback=lambda i, d, loss: losses.append(loss))
+    W_dense, H_dense = multiplicative_updates(masked_X, cf._train_mask, W, H, max_iterations=20,
+                                              fit_error_limit=0, n_blocks=1)
+    assert len(losses) == 20
+    assert np.allclose(W_blocks, W_dense) and np.allclose(H_blocks, H_dense)
+    with pytest.raises(IOError):
+        multiplicative_updates_blocks([(str(tmpdir.join('missing.npy')), None, W)], H)
+
+    multiplicative_updates_blocks(blocks, H, max_iterations=10, fit_error_limit=0, verbose=True)
+    assert 'fit residual' in capsys.readouterr().out
+
+    distributed = pytest.importorskip('distributed')
+    with distributed.Client(distributed.LocalCluster(n_workers=1, processes=False, dashboard_address=None)) as client:
+        W_dask, H_dask = multiplicative_updates_blocks(blocks, H, max_iterations=20, fit_error_limit=0, client=client)
+        assert np.allclose(W_dask, W_dense) and np.allclose(H_dask, H_dense)
+        # the actors are released once the fit returns
+        for _ in range(50):
+            n_actors = sum(client.run(lambda dask_worker: len(dask_worker.state.actors)).values())
+            if not n_actors:
+                break
+            time.sleep(.1)
+        assert n_actors == 0
+
+def _load_rows(masked_X, mask, W, rows):
+    return masked_X[rows], mask[rows], W[rows]
+
+
+def test_predictor(tmpdir):
+    ratings = simulate_data(data_type='data_wide')
+    for cf, kind in [(Mean(ratings, n_train_items=50), 'mean'),
+                     (KNN(ratings, n_train_items=50), 'table'),
+                     (NNMF_multiplicative(ratings, n_train_items=50), 'nnmf'),
+                     (NNMF_sgd(ratings, n_train_items=50), 'sgd')]:
+        cf.fit()
+        cf.predict()
+        path = str(tmpdir.join(kind))
+        cf.save(path)
+        p = Predictor.load(path + '.npz')
+        assert p.kind == kind
+        assert p.shape == ratings.shape
+        assert np.allclose(p.predict(), cf.predicted_ratings.values, equal_nan=True)
+        assert np.allclose(p.predict(subjects=[3, 1], items=[0, 7]),
+                           cf.predicted_ratings.values[[3, 1]][:, [0, 7]], equal_nan=True)
+        if kind != 'table':
+            new = cf.masked_ratings.values[:4]
+            assert p.predict_new(new).shape == new.shape
+
+    cf = KNN(ratings, n_train_items=50)
+    cf.fit(mode='item')
+    cf.predict(k=10)
+    p = cf.to_predictor()
+    assert p.kind == 'knn_item'
+    assert np.allclose(p.predict(), cf.predicted_ratings.values)
+    new = cf.masked_ratings.iloc[:4]
+    assert np.allclose(p.predict_new(new.values), cf.predict_new(new, k=10).values)
+
+def test_import_time():
+    # the package and the predictor load without pandas or scipy
+    code = ('import sys; from timeit import default_timer as timer; tic = timer(); '
+            'import emotioncf; from emotioncf.predictor import Predictor; print(timer() - tic); '
+            'assert "pandas" not in sys.modules and "scipy" not in sys.modules, sorted(sys.modules); '
+            'assert "matplotlib" not in sys.modules and "seaborn" not in sys.modules; '
+            'emotioncf.Mean; assert "pandas" in sys.modules')
+    duration = subprocess.check_output([sys.executable, '-c', code]).decode()
+    assert float(duration) < 5
+
+def test_server():
+    cf = NNMF_sgd(simulate_data(data_type='data_wide'), n_train_items=50)
+    cf.fit(n_factors=5, n_iterations=2)
+    cf.predict()
+    new = cf.masked_ratings.values[:3]
+
+    async def batched():
+        batcher = PredictionBatcher(cf, window=.01)
+        cells = [(s, i) for s in range(5) for i in range(0, 100, 10)]
+        results = await asyncio.gather(*([batcher.predict(s, i) for s, i in cells] +
+                                         [batcher.predict_new(r) for r in new]))
+        assert np.allclose(results[:len(cells)], [cf.predicted_ratings.iloc[s, i] for s, i in cells])
+        assert np.allclose(results[len(cells):], cf.to_predictor().predict_new(new))
+        assert batcher.stats['batches'] == 1
+        assert batcher.stats['requests'] == len(cells) + len(new)
+        try:
+            await batcher.predict('unknown', 0)
+            assert False
+        except ValueError:
+            pass
+        assert batcher.stats['errors'] == 1
+
+    async def http():
+        server = PredictionServer(cf, port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        responses = []
+        for method, path, payload in [('POST', '/predict', {'cells': [[1, 2], [3, 4]]}),
+                                      ('POST', '/predict_new', {'ratings': [None]*99 + [3.]}),
+                                      ('GET', '/stats', None)]:
+            body = b'' if payload is None else json.dumps(payload).encode()
+            writer.write(('%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (method, path, len(body))).encode() + body)
+            await writer.drain()
+            assert b'200' in await reader.readline()
+            headers = {}
+            line = await reader.readline()
+            while line.strip():
+                key, value = line.decode().split(':', 1)
+                headers[key.lower()] = value
+                line = await reader.readline()
+            responses.append(json.loads(await reader.readexactly(int(headers['content-length']))))
+        writer.close()
+        await server.close()
+        assert np.allclose(responses[0]['predictions'], cf.predicted_ratings.values[[1, 3], [2, 4]])
+        assert len(responses[1]['predictions']) == 100
+        assert responses[2]['requests'] == 3
+
+    asyncio.run(batched())
+    asyncio.run(http())
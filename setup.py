@@ -8,7 +8,9 @@ with open('requirements.txt') as f:
     requirements = f.read().splitlines()
 
 extra_setuptools_args = dict(
-    tests_require=['pytest']
+    tests_require=['pytest'],
+    extras_require={'plots': ['matplotlib', 'seaborn'],
+                    'distributed': ['dask[distributed]']}
 )
 
 setup(
@@ -19,12 +21,17 @@ setup(
     maintainer_email='luke.j.chang@dartmouth.edu',
     url='http://github.com/ljchang/emotionCF',
     install_requires=requirements,
-    packages=find_packages(exclude=['emotioncf/tests']),
+    packages=find_packages(exclude=['emotioncf/tests', 'benchmarks']),
     license='MIT',
     keywords = ['emotion', 'collaborative filtering', 'recommender','machine-learning'],
+    python_requires='>=3.7',
     classifiers = [
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Operating System :: OS Independent",
         "Intended Audience :: Science/Research",
         "License :: OSI Approved :: MIT License"